@@ -37,8 +37,17 @@ if [ ${PIPESTATUS[0]} -eq 0 ]; then
     # データベースの統計情報を取得
     echo "" | tee -a "$LOG_FILE"
     echo "--- データベース統計 ---" | tee -a "$LOG_FILE"
-    sqlite3 "$PROJECT_DIR/data/stock_data.db" "SELECT '企業数: ' || COUNT(*) FROM companies;" | tee -a "$LOG_FILE"
-    sqlite3 "$PROJECT_DIR/data/stock_data.db" "SELECT '最新データ: ' || MAX(date) FROM daily_prices;" | tee -a "$LOG_FILE"
+    # バッチが記録した table_stats を読む（全件走査しない）
+    sqlite3 "$PROJECT_DIR/data/stock_data.db" "SELECT '企業数: ' || row_count FROM table_stats WHERE table_name = 'companies';" | tee -a "$LOG_FILE"
+    sqlite3 "$PROJECT_DIR/data/stock_data.db" "SELECT '最新データ: ' || max_date FROM table_stats WHERE table_name = 'daily_prices';" | tee -a "$LOG_FILE"
+
+    # 分析履歴の日次集計と、保持期間を過ぎた履歴の削除
+    echo "" | tee -a "$LOG_FILE"
+    PYTHONPATH="$PROJECT_DIR" python src/core/analysis_rollup.py 2>&1 | tee -a "$LOG_FILE"
+
+    # データベースのメンテナンス (統計更新・空きページ解放・WALチェックポイント・整合性チェック)
+    echo "" | tee -a "$LOG_FILE"
+    PYTHONPATH="$PROJECT_DIR" python src/core/db_maintenance.py --incremental 2>&1 | tee -a "$LOG_FILE"
 else
     echo "" | tee -a "$LOG_FILE"
     echo "❌ データ更新でエラーが発生しました" | tee -a "$LOG_FILE"
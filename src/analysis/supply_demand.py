@@ -12,11 +12,12 @@ import sys
 
 # プロジェクトルートへのパスを追加
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
-from src.core.db_manager import get_connection, get_margin_balance
+from src.core.db_manager import get_read_connection, get_margin_balance, get_sector_daily
+from src.core.company_master import get_company_master
 
 class SupplyDemandAnalyzer:
     def __init__(self):
-        self.conn = get_connection()
+        self.conn = get_read_connection()
         self.font_family = self._setup_font()
         
         # デザインテーマ設定
@@ -478,10 +479,9 @@ class SupplyDemandAnalyzer:
     def load_stock_data(self, code: str):
         """データロード (前回と同様)"""
         # 1. 基本情報
-        companies_df = pd.read_sql_query("SELECT * FROM companies WHERE code = ?", self.conn, params=[code])
-        if companies_df.empty:
+        company_info = get_company_master().get(code)
+        if company_info is None:
             raise ValueError(f"Code {code} not found in companies table.")
-        company_info = companies_df.iloc[0]
 
         # 2. 日足データ (直近1.5年分 - 期日通過ライン用)
         end_date = datetime.now()
@@ -530,23 +530,10 @@ class SupplyDemandAnalyzer:
 
     def analyze_sector(self, target_industry: str):
         """セクター分析"""
-        last_date_df = pd.read_sql_query("SELECT MAX(date) as date FROM daily_prices", self.conn)
-        if last_date_df.empty or last_date_df.iloc[0]['date'] is None:
-            return None
-        last_date = last_date_df.iloc[0]['date']
-        start_date = (datetime.strptime(last_date, '%Y%m%d') - timedelta(days=100)).strftime('%Y%m%d') # 100日分（約60営業日確保のため）
-
-        # セクターデータ
-        query = """
-        SELECT p.date, SUM(p.trading_value) as section_trading_value, AVG((p.close - p.open)/p.open) as avg_change_rate
-        FROM daily_prices p JOIN companies c ON p.code = c.code
-        WHERE c.industry = ? AND p.date >= ? GROUP BY p.date ORDER BY p.date
-        """
-        sector_df = pd.read_sql_query(query, self.conn, params=[target_industry, start_date])
-        
+        # 構成銘柄の日次集計（同じ業種は次のバッチまでキャッシュから返る）
+        sector_df = get_sector_daily(target_industry, days=100) # 100日分（約60営業日確保のため）
         if sector_df.empty: return None
-        sector_df['date'] = pd.to_datetime(sector_df['date'], format='%Y%m%d')
-        sector_df = sector_df.set_index('date')
+        start_date = sector_df.index[0].strftime('%Y%m%d')
 
         # モメンタム
         sector_df['TV_MA5'] = sector_df['section_trading_value'].rolling(5).mean()
@@ -717,10 +704,9 @@ class SupplyDemandAnalyzer:
     def load_stock_data(self, code: str):
         """データロード (V2.1: Margin Limit=60)"""
         # 1. 基本情報
-        companies_df = pd.read_sql_query("SELECT * FROM companies WHERE code = ?", self.conn, params=[code])
-        if companies_df.empty:
+        company_info = get_company_master().get(code)
+        if company_info is None:
             raise ValueError(f"Code {code} not found in companies table.")
-        company_info = companies_df.iloc[0]
 
         # 2. 日足データ (直近1.5年分 - 期日通過ライン用)
         end_date = datetime.now()
@@ -7,7 +7,9 @@ from dotenv import load_dotenv
 
 # 新しいプロジェクト構造に基づくインポート
 from src.core.data_loader import fetch_data
-from src.core.db_manager import log_analysis_history, get_analysis_history  # 履歴機能
+from src.core.async_db import AsyncDB  # DBアクセスはイベントループ外のスレッドで実行
+from src.core.table_stats import format_table_stats
+from src.core.query_cache import get_query_cache, format_cache_stats
 from src.analysis.technical_chart import generate_charts
 from src.analysis.supply_demand import SupplyDemandAnalyzer
 # from src.analysis.company_overview import CompanyOverviewGenerator  # 未使用
@@ -17,13 +19,35 @@ from src.utils.pdf_generator import generate_pdf_report
 load_dotenv()
 TOKEN = os.getenv('DISCORD_BOT_TOKEN')
 
+class StockBotClient(discord.Client):
+    """終了時に非同期DBを閉じるクライアント"""
+
+    async def close(self):
+        # キューに残った分析履歴を書き込み、DBスレッドプールを止めてから切断する
+        # （client.run は Ctrl+C やエラーでの終了時にも close() を呼ぶ）
+        await db.close()
+        await super().close()
+
+
 # Discord Botの設定
 intents = discord.Intents.default()
 intents.message_content = True 
-client = discord.Client(intents=intents)
+client = StockBotClient(intents=intents)
+
+# 非同期DBファサード（履歴の読み書き・データ取得）
+db = AsyncDB()
+# レポート生成は1件ずつ（matplotlibのグローバル状態をスレッド間で共有しないため）
+analysis_lock = asyncio.Lock()
+
+def run_supply_demand(code: str, save_path: str):
+    """需給分析をDBスレッド上で実行する（接続はスレッドごとに保持されるため、Analyzerもスレッド内で生成）"""
+    sda = SupplyDemandAnalyzer()
+    return sda.plot_analysis(code, save_path=save_path)
 
 @client.event
 async def on_ready():
+    await db.start()
+    await db.refresh_snapshot()
     print(f'✅ Bot Login Successful: {client.user} としてログインしました。')
     print("--- 動作確認用: Discordで /analyze <証券コード> を試してください ---")
 
@@ -37,7 +61,7 @@ async def on_message(message):
 
     # /analyze コマンドの処理
     if message.content.startswith('/analyze'):
-        async with message.channel.typing():
+        async with message.channel.typing(), analysis_lock:
             try:
                 parts = message.content.split(' ')
                 if len(parts) < 2:
@@ -51,8 +75,10 @@ async def on_message(message):
                 status_msg = await message.channel.send(f'🔍 **{code}** を分析中...')
 
                 # --- 1. データ取得 ---
+                # このジョブは開始時点の最新スナップショットだけを読む（途中でバッチが公開しても混ざらない）
+                await db.refresh_snapshot()
                 print(f"[STEP 1/5] Fetching data for {code}...")
-                data = fetch_data(code)
+                data = await db.run(fetch_data, code)
                 print(f"[STEP 1/5] Data fetch completed for {code}")
                 if data.get("error"):
                     await message.channel.send(f"❌ エラー: {data['error']}")
@@ -77,10 +103,9 @@ async def on_message(message):
 
                 # --- 4. 需給分析 & メタデータ取得 ---
                 print(f"[STEP 3/5] Analyzing supply/demand for {code}...")
-                sda = SupplyDemandAnalyzer()
                 temp_dash_path = f"temp_dash_{code}_{datetime.now().timestamp()}.png"
                 
-                meta_data = sda.plot_analysis(code, save_path=temp_dash_path)
+                meta_data = await db.run(run_supply_demand, code, temp_dash_path)
                 print(f"[STEP 3/5] Supply/demand analysis completed for {code}")
                 
                 if not meta_data:
@@ -119,7 +144,7 @@ async def on_message(message):
                 # 履歴を記録（エラーを無視）
                 try:
                     user_name = f"{message.author.name}#{message.author.discriminator}"
-                    log_analysis_history(code, company_name, user_name, success=True)
+                    await db.log_analysis_history(code, company_name, user_name, success=True)
                 except Exception as log_err:
                     print(f"⚠️  History logging failed (harmless): {log_err}")
                 
@@ -135,14 +160,24 @@ async def on_message(message):
     # /history コマンドの処理
     if message.content.startswith('/history'):
         try:
-            history = get_analysis_history(limit=10)
+            # /history [証券コード | me] で銘柄・自分の履歴に絞り込む（いずれもインデックスで引く）
+            parts = message.content.split()
+            arg = parts[1] if len(parts) > 1 else None
+            if arg == 'me':
+                history = await db.get_analysis_history(
+                    limit=10, user_name=f"{message.author.name}#{message.author.discriminator}")
+            elif arg:
+                history = await db.get_analysis_history(limit=10, code=arg)
+            else:
+                history = await db.get_analysis_history(limit=10)
             
             if not history:
                 await message.channel.send('📊 分析履歴がありません。')
                 return
             
             # 履歴を整形
-            response = "📊 **分析履歴（最新10件）**\n━━━━━━━━━━━━━━━━\n"
+            title = f"分析履歴（{arg} 最新10件）" if arg else "分析履歴（最新10件）"
+            response = f"📊 **{title}**\n━━━━━━━━━━━━━━━━\n"
             for record in history:
                 record_id, stock_code, company_name, analyzed_at, user_name, success = record
                 
@@ -160,6 +195,13 @@ async def on_message(message):
                 user_display = f" - {user_name}" if user_name else ""
                 
                 response += f"{status_icon} {date_str} - {stock_code}{company_display}{user_display}\n"
+
+            # 直近7日間のよく分析された銘柄（日次集計から）
+            if not arg:
+                popular = await db.get_analysis_daily_stats(days=7, group_by='stock_code', limit=5)
+                if popular:
+                    response += "\n🔥 **直近7日間の人気銘柄**\n"
+                    response += " / ".join(f"{code} ({requests}回)" for code, requests, _ in popular)
             
             await message.channel.send(response)
             
@@ -168,6 +210,22 @@ async def on_message(message):
             traceback.print_exc()
             await message.channel.send(f'❌ 履歴の取得に失敗しました: {str(e)}')
 
+    # /dbstatus コマンドの処理
+    if message.content.startswith('/dbstatus'):
+        try:
+            # バッチが記録した統計を読むだけなので、DBの大きさによらずすぐ返る
+            await db.refresh_snapshot()
+            stats = await db.get_table_stats()
+            response = "🗄️ **データベース状況**\n━━━━━━━━━━━━━━━━\n"
+            response += "\n".join(format_table_stats(stats))
+            response += "\n" + format_cache_stats(get_query_cache().stats())
+            await message.channel.send(response)
+
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            await message.channel.send(f'❌ DB状況の取得に失敗しました: {str(e)}')
+
 if __name__ == '__main__':
     if TOKEN:
         client.run(TOKEN)
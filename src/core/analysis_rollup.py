@@ -0,0 +1,85 @@
+"""
+分析履歴 (analysis_history) の日次集計と保持期間による削除
+
+analysis_history は /analyze のたびに1行増え続けるため、夜間バッチで以下を行う。
+    1. 前日までの未集計の日を analysis_daily_stats (日 × 銘柄 × ユーザー) に集計
+    2. 集計済みで保持期間 (DEFAULT_RETENTION_DAYS) を過ぎた生の履歴を削除
+
+集計済みの範囲は db_metadata の history_rolled_up_until (この日付より前は集計済み) で管理する。
+集計は日単位の INSERT OR REPLACE なので、同じ日を再集計しても結果は変わらない。
+
+Usage:
+    PYTHONPATH=. python src/core/analysis_rollup.py [--retention-days 90] [--dry-run]
+"""
+import os
+import sys
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from src.core.db_manager import get_connection, get_metadata, set_metadata
+
+# 生の履歴を残す日数
+DEFAULT_RETENTION_DAYS = 90
+
+
+def rollup_analysis_history(retention_days: int = DEFAULT_RETENTION_DAYS, dry_run: bool = False) -> dict:
+    """
+    前日までの履歴を日次集計し、保持期間を過ぎた集計済みの履歴を削除する
+
+    Args:
+        retention_days: 生の履歴を残す日数
+        dry_run: Trueの場合、件数を数えるだけで書き込まない
+
+    Returns:
+        {'rolled_up_rows': 集計した履歴の行数, 'stats_rows': 書き込んだ集計行数, 'pruned': 削除した行数}
+    """
+    today = datetime.now().strftime('%Y-%m-%d')
+    cutoff = (datetime.now() - timedelta(days=retention_days)).strftime('%Y-%m-%d')
+
+    conn = get_connection()
+    try:
+        since = get_metadata(conn, 'history_rolled_up_until', '')
+        # analyzed_at は ISO形式なので、日付文字列との比較で日単位の範囲になる
+        rolled_up_rows = conn.execute(
+            "SELECT COUNT(*) FROM analysis_history WHERE analyzed_at >= ? AND analyzed_at < ?", (since, today)
+        ).fetchone()[0]
+        # 削除対象は集計済みの範囲に限る
+        prune_before = min(cutoff, today)
+        pruned = conn.execute(
+            "SELECT COUNT(*) FROM analysis_history WHERE analyzed_at < ?", (prune_before,)
+        ).fetchone()[0]
+
+        if dry_run:
+            return {'rolled_up_rows': rolled_up_rows, 'stats_rows': 0, 'pruned': pruned}
+
+        stats_rows = conn.execute("""
+            INSERT OR REPLACE INTO analysis_daily_stats (day, stock_code, user_name, requests, successes)
+            SELECT substr(analyzed_at, 1, 10), stock_code, COALESCE(user_name, ''), COUNT(*), SUM(success)
+            FROM analysis_history
+            WHERE analyzed_at >= ? AND analyzed_at < ?
+            GROUP BY 1, 2, 3
+        """, (since, today)).rowcount
+        set_metadata(conn, 'history_rolled_up_until', today)
+        conn.execute("DELETE FROM analysis_history WHERE analyzed_at < ?", (prune_before,))
+        conn.commit()
+        return {'rolled_up_rows': rolled_up_rows, 'stats_rows': stats_rows, 'pruned': pruned}
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Roll up analysis_history into daily stats and prune old rows')
+    parser.add_argument('--retention-days', type=int, default=DEFAULT_RETENTION_DAYS,
+                        help=f'Days of raw history to keep (default: {DEFAULT_RETENTION_DAYS})')
+    parser.add_argument('--dry-run', action='store_true', help='Only count rows')
+    args = parser.parse_args()
+
+    print(f"=== 分析履歴の集計 (保持 {args.retention_days}日) ===")
+    result = rollup_analysis_history(args.retention_days, args.dry_run)
+    print(f"  -> 集計: {result['rolled_up_rows']}件 → {result['stats_rows']}行, 削除: {result['pruned']}件"
+          f"{' (dry-run)' if args.dry_run else ''}")
@@ -0,0 +1,259 @@
+"""
+市場全体の集計クエリ用の分析エンジン（DuckDB・任意依存）
+
+騰落数・業種合計・横断的な順位付けのような全銘柄を走査する集計は、行指向の SQLite では遅い。
+duckdb がインストールされていれば、同じデータを列指向の DuckDB で集計する。
+データソースは次のいずれか（読み取り専用）。
+    parquet: parquet_export.py の出力 (data/parquet)。エクスポート時の data_version が
+             現在のDBと一致する場合のみ使う
+    sqlite:  公開中のスナップショット（未公開なら本体DB）を DuckDB の sqlite 拡張で ATTACH
+
+duckdb が無い・拡張を読み込めない・クエリが失敗した場合は None を返し、
+呼び出し側 (db_manager) は従来の SQLite のクエリで集計する。
+
+環境変数:
+    STOCK_ANALYTICS_ENGINE  auto (既定: duckdb があれば使う) / duckdb / sqlite
+    STOCK_ANALYTICS_SOURCE  auto (既定: parquet が最新なら parquet、それ以外は sqlite) / parquet / sqlite
+
+Usage:
+    df = analytics.query("SELECT ...", params)   # DuckDB が使えなければ None
+    PYTHONPATH=. python src/core/analytics.py bench [--repeat 5] [--market 東証PR] [--industry 電気機器]
+"""
+import os
+import sys
+import glob
+import json
+import time
+import threading
+
+try:
+    import duckdb
+except ImportError:  # duckdb は任意依存（無ければ SQLite で集計する）
+    duckdb = None
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from src.core import db_manager
+
+PARQUET_DIR = os.path.join(os.path.dirname(os.path.abspath(db_manager.DB_PATH)), 'parquet')
+
+# DuckDB から参照するテーブル（companies はインメモリ企業マスタで代替するため含めない）
+ANALYTICS_TABLES = ['daily_prices', 'daily_financials', 'weekly_margin', 'daily_indices']
+
+_thread_local = threading.local()
+_warned = set()
+
+
+class AnalyticsUnavailable(Exception):
+    """DuckDB で集計できない（呼び出し側は SQLite にフォールバックする）"""
+
+
+def _warn_once(message: str):
+    if message not in _warned:
+        _warned.add(message)
+        print(f"⚠️  {message} (SQLiteで集計します)")
+
+
+def engine_enabled() -> bool:
+    """DuckDB で集計するか"""
+    setting = os.getenv('STOCK_ANALYTICS_ENGINE', 'auto').lower()
+    if setting == 'sqlite':
+        return False
+    if duckdb is None:
+        if setting == 'duckdb':
+            _warn_once("duckdb がインストールされていません (pip install duckdb)")
+        return False
+    return True
+
+
+def _current_data_version() -> str:
+    with db_manager.get_read_connection() as conn:
+        return db_manager.get_metadata(conn, 'data_version', '0')
+
+
+def _parquet_data_version():
+    """Parquet エクスポート時の data_version（未エクスポートなら None）"""
+    path = os.path.join(PARQUET_DIR, '_export_state.json')
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f).get('_data_version')
+
+
+def _select_source(data_version: str):
+    """(種類, 場所) を返す"""
+    setting = os.getenv('STOCK_ANALYTICS_SOURCE', 'auto').lower()
+    if setting in ('auto', 'parquet') and _parquet_data_version() == data_version:
+        return 'parquet', PARQUET_DIR
+    if setting == 'parquet':
+        raise AnalyticsUnavailable("Parquet スナップショットが最新のDBと一致しません (parquet_export.py を実行してください)")
+    return 'sqlite', db_manager.get_snapshot_path() or os.path.abspath(db_manager.DB_PATH)
+
+
+def _open(kind: str, location: str):
+    """データソースのテーブルをビューとして持つ DuckDB のインメモリ接続を作る"""
+    # 拡張の自動ダウンロードはしない（sqlite 拡張は事前に INSTALL sqlite しておく）
+    con = duckdb.connect(config={'autoinstall_known_extensions': False})
+    try:
+        if kind == 'parquet':
+            for table in ANALYTICS_TABLES:
+                pattern = os.path.join(location, table, '*', '*', '*.parquet')
+                if glob.glob(pattern):
+                    con.execute(f"CREATE VIEW {table} AS SELECT * FROM read_parquet('{pattern}')")
+        else:
+            con.execute("LOAD sqlite")
+            con.execute(f"ATTACH '{location}' AS src (TYPE sqlite, READ_ONLY)")
+            for table in ANALYTICS_TABLES:
+                con.execute(f"CREATE VIEW {table} AS SELECT * FROM src.{table}")
+    except Exception as e:
+        con.close()
+        raise AnalyticsUnavailable(f"DuckDB のデータソースを開けません ({kind}: {e})")
+    return con
+
+
+def get_duckdb_connection():
+    """
+    現在のスレッド用の DuckDB 接続を返す
+
+    データソースの場所か data_version が変わったら作り直す。
+    開けなかったデータソースは、変わるまで再試行しない。
+    """
+    data_version = _current_data_version()
+    kind, location = _select_source(data_version)
+    key = (kind, location, data_version)
+    if getattr(_thread_local, 'key', None) != key:
+        if getattr(_thread_local, 'failed_key', None) == key:
+            raise AnalyticsUnavailable(f"DuckDB のデータソースを開けません ({kind})")
+        old = getattr(_thread_local, 'con', None)
+        try:
+            _thread_local.con = _open(kind, location)
+        except AnalyticsUnavailable:
+            _thread_local.failed_key = key
+            raise
+        _thread_local.key = key
+        if old is not None:
+            old.close()
+    return _thread_local.con
+
+
+def query(sql: str, params: list = None):
+    """
+    DuckDB で集計クエリを実行する
+
+    Returns:
+        pandas.DataFrame（DuckDB が使えない・失敗した場合は None）
+    """
+    if not engine_enabled():
+        return None
+    try:
+        return get_duckdb_connection().execute(sql, params or []).df()
+    except AnalyticsUnavailable as e:
+        _warn_once(str(e))
+    except Exception as e:
+        _warn_once(f"DuckDB の集計に失敗しました: {e}")
+    return None
+
+
+# --- 集計クエリ (db_manager の SQLite 版と同じカラムを返す) ---
+
+def market_advance_decline(limit: int = 30, codes: tuple = None):
+    """日付ごとの値上がり・値下がり銘柄数 (date, up_count, down_count)。codes 指定時はその銘柄のみ"""
+    condition = "WHERE list_contains(?::VARCHAR[], code)" if codes is not None else ""
+    params = [list(codes)] if codes is not None else []
+    return query(f"""
+        WITH PriceChanges AS (
+            SELECT date,
+                   close - LAG(close) OVER (PARTITION BY code ORDER BY date) AS change
+            FROM daily_prices
+            {condition}
+        )
+        SELECT date,
+               CAST(SUM(CASE WHEN change > 0 THEN 1 ELSE 0 END) AS BIGINT) AS up_count,
+               CAST(SUM(CASE WHEN change < 0 THEN 1 ELSE 0 END) AS BIGINT) AS down_count
+        FROM PriceChanges
+        WHERE change IS NOT NULL
+        GROUP BY date
+        ORDER BY date DESC
+        LIMIT ?
+    """, params + [limit])
+
+
+def sector_daily(codes: tuple, days: int):
+    """構成銘柄の直近データ日から days 日分の日次の売買代金合計・平均騰落率 (date, section_trading_value, avg_change_rate)"""
+    return query("""
+        WITH start AS (
+            SELECT strftime(strptime(MAX(date), '%Y%m%d') - to_days(CAST(? AS INTEGER)), '%Y%m%d') AS start_date
+            FROM daily_prices
+        )
+        SELECT date, SUM(trading_value) AS section_trading_value, AVG((close - open) / open) AS avg_change_rate
+        FROM daily_prices, start
+        WHERE list_contains(?::VARCHAR[], code) AND date >= start.start_date
+        GROUP BY date
+        ORDER BY date
+    """, [days, list(codes)])
+
+
+def benchmark(repeat: int = 5, market_filter: str = '東証PR', industry: str = None):
+    """SQLite と DuckDB で集計関数の実行時間を比較する（クエリキャッシュは無効化して計測）"""
+    import pandas as pd
+    from src.core.query_cache import get_query_cache
+    from src.core.company_master import get_company_master
+
+    if duckdb is None:
+        print("❌ duckdb がインストールされていません (pip install duckdb)")
+        return
+    if industry is None:
+        by_industry = get_company_master().by_industry
+        industry = max(by_industry, key=lambda k: len(by_industry[k])) if by_industry else ''
+
+    cache = get_query_cache()
+    saved_max = cache.max_bytes
+    saved_engine = os.environ.get('STOCK_ANALYTICS_ENGINE')
+    cache.max_bytes = 0
+    cases = [
+        ('get_market_advance_decline(25)', lambda: db_manager.get_market_advance_decline(25)),
+        (f"get_market_advance_decline(25, '{market_filter}')", lambda: db_manager.get_market_advance_decline(25, market_filter)),
+        (f"get_sector_daily('{industry}')", lambda: db_manager.get_sector_daily(industry)),
+    ]
+    try:
+        print(f"=== 分析エンジンのベンチマーク (各{repeat}回, 中央値) ===")
+        print(f"{'query':<48} {'sqlite_ms':>10} {'duckdb_ms':>10} {'speedup':>8}  same")
+        for label, func in cases:
+            timings, results = {}, {}
+            for engine in ('sqlite', 'duckdb'):
+                os.environ['STOCK_ANALYTICS_ENGINE'] = engine
+                results[engine] = func()   # ウォームアップ（DuckDB 接続の作成を含めない）
+                samples = []
+                for _ in range(repeat):
+                    started = time.perf_counter()
+                    func()
+                    samples.append((time.perf_counter() - started) * 1000)
+                timings[engine] = sorted(samples)[len(samples) // 2]
+            try:
+                pd.testing.assert_frame_equal(results['sqlite'], results['duckdb'], check_dtype=False)
+                same = 'yes'
+            except AssertionError:
+                same = 'NO'
+            speedup = timings['sqlite'] / timings['duckdb'] if timings['duckdb'] else 0.0
+            print(f"{label:<48} {timings['sqlite']:>10.1f} {timings['duckdb']:>10.1f} {speedup:>7.1f}x  {same}")
+        source = getattr(_thread_local, 'key', ('-',))[0]
+        print(f"DuckDB データソース: {source}")
+    finally:
+        if saved_engine is None:
+            os.environ.pop('STOCK_ANALYTICS_ENGINE', None)
+        else:
+            os.environ['STOCK_ANALYTICS_ENGINE'] = saved_engine
+        cache.max_bytes = saved_max
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Analytical engine (DuckDB) utilities')
+    sub = parser.add_subparsers(dest='command', required=True)
+    bench = sub.add_parser('bench', help='Compare SQLite and DuckDB on the aggregate queries')
+    bench.add_argument('--repeat', type=int, default=5, help='Runs per query (default: 5)')
+    bench.add_argument('--market', default='東証PR', help='Market filter for advance/decline')
+    bench.add_argument('--industry', help='Industry for the sector aggregate (default: largest)')
+    args = parser.parse_args()
+
+    benchmark(args.repeat, args.market, args.industry)
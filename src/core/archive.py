@@ -0,0 +1,250 @@
+"""
+ホット/コールド分割: 古い日足データの年別アーカイブ
+
+Botが参照するのは直近約550日分のみなので、それより古い daily_prices の行と、
+それ以前に失効した財務指標の版 (financial_versions) を
+年ごとのSQLiteファイル (data/archive/stock_data_YYYY.db) へ移動し、本体DBを小さく保つ。
+長期間の分析が必要な場合は、必要な年のアーカイブを ATTACH し、
+本体とアーカイブを UNION ALL した一時ビュー (daily_prices_all, daily_financials_all など) から読む。
+
+Usage:
+    PYTHONPATH=. python src/core/archive.py [--horizon-days 550] [--dry-run]
+"""
+import os
+import re
+import sys
+import sqlite3
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from src.core.db_manager import DB_PATH, get_connection, get_metadata, set_metadata
+from src.core.financial_versions import daily_financials_view_sql
+
+ARCHIVE_DIR = os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), 'archive')
+
+# 本体DBに残す日数（SupplyDemandAnalyzer.load_stock_data の参照期間に合わせる）
+DEFAULT_HORIZON_DAYS = 550
+
+# アーカイブ対象テーブル: {テーブル: (年の判定に使うカラム, 移動対象の条件)}
+# 条件中の ? には境界日 (cutoff) が入る
+ARCHIVE_TABLES = {
+    'daily_prices': ('date', 'date < ?'),
+    'financial_versions': ('valid_from', 'valid_to IS NOT NULL AND valid_to <= ?'),
+}
+
+# SQLiteの既定のATTACH上限 (SQLITE_MAX_ATTACHED=10) から main/temp 分を差し引いた数
+# これを超える年数を参照する場合、古い年は一時テーブルへコピーして参照する (attach_archives)
+MAX_ATTACHED_YEARS = 9
+
+
+def archive_path(year: int) -> str:
+    """年別アーカイブファイルのパス"""
+    return os.path.join(ARCHIVE_DIR, f"stock_data_{year}.db")
+
+
+def archived_years() -> list:
+    """存在するアーカイブの年（昇順）"""
+    if not os.path.isdir(ARCHIVE_DIR):
+        return []
+    years = []
+    for name in os.listdir(ARCHIVE_DIR):
+        m = re.fullmatch(r'stock_data_(\d{4})\.db', name)
+        if m:
+            years.append(int(m.group(1)))
+    return sorted(years)
+
+
+def _create_archive_table(conn: sqlite3.Connection, schema: str, table: str):
+    """本体DBと同じ定義のテーブルをアーカイブ側に作成する"""
+    row = conn.execute("SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+    if row is None:
+        raise ValueError(f"テーブルが存在しません: {table}")
+    ddl = re.sub(rf'CREATE TABLE\s+(IF NOT EXISTS\s+)?"?{table}"?',
+                 f'CREATE TABLE IF NOT EXISTS {schema}.{table}', row[0], count=1)
+    conn.execute(ddl)
+
+
+def archive_old_data(horizon_days: int = DEFAULT_HORIZON_DAYS, tables: list = None, dry_run: bool = False) -> dict:
+    """
+    horizon_days より古い行を年別アーカイブへ移動する
+
+    年ごとに「アーカイブへコピー → 本体から削除」を1トランザクションで行う。
+    途中で中断しても INSERT OR REPLACE のため再実行で整合する。
+
+    Args:
+        horizon_days: 本体DBに残す日数
+        tables: 対象テーブル（デフォルト: ARCHIVE_TABLES の全て）
+        dry_run: Trueの場合は移動対象の件数のみ集計する
+
+    Returns:
+        {table: {year: 移動行数}}
+    """
+    cutoff = (datetime.now() - timedelta(days=horizon_days)).strftime('%Y%m%d')
+    tables = tables or list(ARCHIVE_TABLES)
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    summary = {}
+
+    conn = get_connection()
+    try:
+        for table in tables:
+            date_col, condition = ARCHIVE_TABLES[table]
+            where = f"{date_col} >= ? AND {date_col} <= ? AND {condition}"
+            summary[table] = {}
+            years = [row[0] for row in conn.execute(
+                f"SELECT DISTINCT substr({date_col}, 1, 4) FROM {table} WHERE {condition} ORDER BY 1", (cutoff,)
+            )]
+            for year in years:
+                year_start, year_end = f"{year}0101", f"{year}1231"
+                if dry_run:
+                    count = conn.execute(
+                        f"SELECT COUNT(*) FROM {table} WHERE {where}", (year_start, year_end, cutoff)
+                    ).fetchone()[0]
+                    summary[table][year] = count
+                    print(f"  -> [dry-run] {table} {year}: {count}行")
+                    continue
+
+                conn.execute("ATTACH DATABASE ? AS arc", (archive_path(int(year)),))
+                try:
+                    _create_archive_table(conn, 'arc', table)
+                    conn.execute(
+                        f"INSERT OR REPLACE INTO arc.{table} SELECT * FROM main.{table} WHERE {where}",
+                        (year_start, year_end, cutoff)
+                    )
+                    moved = conn.execute(
+                        f"DELETE FROM main.{table} WHERE {where}", (year_start, year_end, cutoff)
+                    ).rowcount
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                finally:
+                    conn.execute("DETACH DATABASE arc")
+
+                summary[table][year] = moved
+                print(f"  -> {table} {year}: {moved}行 → {os.path.basename(archive_path(int(year)))}")
+
+        if not dry_run:
+            # 長期間クエリがアーカイブを参照すべき境界日を記録
+            previous = get_metadata(conn, 'archive_before')
+            set_metadata(conn, 'archive_before', max(cutoff, previous) if previous else cutoff)
+            conn.commit()
+    finally:
+        conn.close()
+
+    return summary
+
+
+def _copy_overflow_years(conn: sqlite3.Connection, table: str, years: list, code: str = None):
+    """
+    ATTACH しきれない年のアーカイブを1年ずつ ATTACH して一時テーブル temp.<table>_overflow にコピーする
+
+    code を指定すると該当銘柄の行だけをコピーする（単一銘柄の長期間取得で全銘柄分を読まないため）。
+    """
+    conn.execute(f"DROP TABLE IF EXISTS temp.{table}_overflow")
+    conn.execute(f"CREATE TEMP TABLE {table}_overflow AS SELECT * FROM main.{table} WHERE 0")
+    where, params = ("WHERE code = ?", (code,)) if code else ("", ())
+    for year in years:
+        conn.execute("ATTACH DATABASE ? AS arc_overflow", (archive_path(year),))
+        try:
+            has_table = conn.execute(
+                "SELECT 1 FROM arc_overflow.sqlite_master WHERE type = 'table' AND name = ?", (table,)
+            ).fetchone()
+            if has_table:
+                conn.execute(f"INSERT INTO temp.{table}_overflow SELECT * FROM arc_overflow.{table} {where}", params)
+                # DETACH はトランザクションの外で行う必要がある
+                conn.commit()
+        finally:
+            conn.execute("DETACH DATABASE arc_overflow")
+
+
+def attach_archives(conn: sqlite3.Connection, start_date: str = None, tables: list = None,
+                    end_date: str = None, code: str = None) -> list:
+    """
+    start_date〜end_date をカバーするアーカイブを ATTACH し、UNION ALL の一時ビューを作成する
+
+    作成されるビュー: <table>_all (例: daily_prices_all)
+    daily_prices と financial_versions の両方が対象の場合は daily_financials_all も作成する。
+    アーカイブが無い場合も本体のみを対象にビューを作るため、呼び出し側は常に <table>_all を参照できる。
+
+    対象の年が ATTACH の上限 (MAX_ATTACHED_YEARS) を超える場合は、新しい年から上限-1年分を ATTACH し、
+    残りの古い年は1年ずつ一時テーブルへコピーしてビューに含める。
+
+    Args:
+        conn: 本体DBへの接続
+        start_date: 取得開始日 (YYYYMMDD)。None の場合は最も古いアーカイブから
+        tables: 対象テーブル（デフォルト: ARCHIVE_TABLES の全て）
+        end_date: 取得終了日 (YYYYMMDD)。None の場合は最新のアーカイブまで
+        code: 証券コード。指定すると上限を超えた年は該当銘柄の行だけをコピーする
+
+    Returns:
+        参照できるようにした年のリスト（昇順）
+    """
+    years = archived_years()
+    if start_date:
+        years = [y for y in years if y >= int(start_date[:4])]
+    if end_date:
+        years = [y for y in years if y <= int(end_date[:4])]
+
+    attached = {row[1] for row in conn.execute("PRAGMA database_list")}
+    # 他の用途で ATTACH 済みのDBと、このあと ATTACH し直す年の分を除いた空き
+    slots = MAX_ATTACHED_YEARS - len({name for name in attached if name not in ('main', 'temp')
+                                      and not name.startswith('arc_')})
+    if len(years) > slots:
+        # 1枠はコピー用に空けておく
+        overflow, direct = years[:len(years) - slots + 1], years[len(years) - slots + 1:]
+    else:
+        overflow, direct = [], years
+
+    # 以前の呼び出しで ATTACH した不要な年は外す（再利用される接続で上限に達しないように）
+    keep = {f"arc_{year}" for year in direct}
+    for schema in sorted(attached):
+        if schema.startswith('arc_') and schema not in keep:
+            conn.execute(f"DETACH DATABASE {schema}")
+    for year in direct:
+        schema = f"arc_{year}"
+        if schema not in attached:
+            conn.execute(f"ATTACH DATABASE ? AS {schema}", (archive_path(year),))
+
+    tables = tables or list(ARCHIVE_TABLES)
+    for table in tables:
+        selects = [f"SELECT * FROM main.{table}"]
+        if overflow:
+            _copy_overflow_years(conn, table, overflow, code)
+            selects.append(f"SELECT * FROM temp.{table}_overflow")
+        for year in direct:
+            has_table = conn.execute(
+                f"SELECT 1 FROM arc_{year}.sqlite_master WHERE type = 'table' AND name = ?", (table,)
+            ).fetchone()
+            if has_table:
+                selects.append(f"SELECT * FROM arc_{year}.{table}")
+        conn.execute(f"DROP VIEW IF EXISTS temp.{table}_all")
+        conn.execute(f"CREATE TEMP VIEW {table}_all AS " + " UNION ALL ".join(selects))
+
+    if 'daily_prices' in tables and 'financial_versions' in tables:
+        conn.execute("DROP VIEW IF EXISTS temp.daily_financials_all")
+        conn.execute(daily_financials_view_sql('daily_financials_all', 'daily_prices_all',
+                                               'financial_versions_all', temp=True))
+
+    return years
+
+
+def get_long_range_connection(start_date: str = None, end_date: str = None) -> sqlite3.Connection:
+    """アーカイブをATTACH済みの接続を返す（<table>_all ビューで長期間を参照できる）"""
+    conn = get_connection()
+    attach_archives(conn, start_date, end_date=end_date)
+    return conn
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Archive old daily rows into per-year SQLite files')
+    parser.add_argument('--horizon-days', type=int, default=DEFAULT_HORIZON_DAYS,
+                        help=f'Days to keep in the main DB (default: {DEFAULT_HORIZON_DAYS})')
+    parser.add_argument('--tables', nargs='+', choices=list(ARCHIVE_TABLES), help='Tables to archive (default: all)')
+    parser.add_argument('--dry-run', action='store_true', help='Only count rows to be archived')
+    args = parser.parse_args()
+
+    print(f"=== アーカイブ開始: {args.horizon_days}日より古いデータ ===")
+    archive_old_data(args.horizon_days, args.tables, args.dry_run)
+    print("=== ✅ アーカイブ完了 (容量の回収には VACUUM を実行してください) ===")
@@ -0,0 +1,133 @@
+"""
+Bot向けの非同期データアクセスAPI
+
+db_manager の同期関数を専用のDBスレッドプールで実行し、awaitable として提供する。
+各ワーカースレッドは bind_thread_connection() で接続を1本ずつ保持して再利用する。
+株価などの読み取りは公開済みのスナップショットから行い、refresh_snapshot() を呼んだ時点
+（ジョブの合間）でのみ新しいスナップショットに切り替える。1つのジョブ内の読み取りは全て同じ版を見る。
+分析履歴の書き込みはキューに積み、単一のライタタスクがまとめて executemany で書き込む。
+これにより、DiscordのイベントループがSQLiteの呼び出しでブロックされることはない。
+
+Usage:
+    db = AsyncDB()
+    await db.start()
+    await db.refresh_snapshot()               # ジョブ開始時に最新のスナップショットへ切り替え
+    history = await db.get_analysis_history(limit=10)
+    await db.log_analysis_history('7203', 'トヨタ自動車', 'user#0001')
+    data = await db.run(fetch_data, '7203')   # 任意の同期関数もDBスレッドで実行可能
+"""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from src.core import db_manager
+
+# 読み取り用ワーカー数
+DEFAULT_READ_WORKERS = 2
+# 1回の書き込みでまとめる最大件数
+WRITE_BATCH_SIZE = 50
+# 書き込みをまとめるために待つ最大時間（秒）
+WRITE_FLUSH_INTERVAL = 0.5
+
+
+class AsyncDB:
+    """db_manager の非同期ファサード"""
+
+    def __init__(self, read_workers: int = DEFAULT_READ_WORKERS,
+                 batch_size: int = WRITE_BATCH_SIZE, flush_interval: float = WRITE_FLUSH_INTERVAL):
+        self._readers = ThreadPoolExecutor(read_workers, thread_name_prefix='db-read',
+                                           initializer=db_manager.bind_thread_connection)
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix='db-write',
+                                          initializer=db_manager.bind_thread_connection)
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._queue = None
+        self._writer_task = None
+        self._snapshot_path = None
+
+    async def start(self):
+        """ライタタスクを起動する（イベントループ上で1回だけ呼ぶ）"""
+        if self._writer_task is None:
+            self._queue = asyncio.Queue()
+            self._writer_task = asyncio.create_task(self._writer_loop())
+
+    async def close(self):
+        """キューに残った書き込みを反映してから停止する"""
+        if self._writer_task is not None:
+            await self._queue.join()
+            self._writer_task.cancel()
+            self._writer_task = None
+        self._readers.shutdown(wait=True)
+        self._writer.shutdown(wait=True)
+
+    async def refresh_snapshot(self) -> str:
+        """以降の読み取りで使うスナップショットを最新の公開版に切り替える（ジョブの合間に呼ぶ）"""
+        self._snapshot_path = db_manager.get_snapshot_path()
+        return self._snapshot_path
+
+    def _call(self, snapshot_path, func, *args, **kwargs):
+        # ワーカーの読み取り接続を、ジョブ開始時に固定したスナップショットに合わせてから実行する
+        db_manager.bind_thread_snapshot(snapshot_path)
+        return func(*args, **kwargs)
+
+    async def run(self, func, *args, **kwargs):
+        """同期関数をDBスレッドプールで実行する"""
+        loop = asyncio.get_running_loop()
+        call = functools.partial(self._call, self._snapshot_path, func, *args, **kwargs)
+        return await loop.run_in_executor(self._readers, call)
+
+    # --- 読み取り ---
+    async def get_analysis_history(self, limit: int = 10, user_name: str = None, code: str = None, before: tuple = None):
+        return await self.run(db_manager.get_analysis_history, limit, user_name, code, before)
+
+    async def get_analysis_daily_stats(self, days: int = 7, group_by: str = 'stock_code', limit: int = 10):
+        return await self.run(db_manager.get_analysis_daily_stats, days, group_by, limit)
+
+    async def get_company_info(self, code: str):
+        return await self.run(db_manager.get_company_info, code)
+
+    async def get_stock_prices(self, code: str, start_date: str = None, end_date: str = None, limit: int = None):
+        return await self.run(db_manager.get_stock_prices, code, start_date, end_date, limit)
+
+    async def get_financial_data(self, code: str, limit: int = 5):
+        return await self.run(db_manager.get_financial_data, code, limit)
+
+    async def get_margin_balance(self, code: str, limit: int = 26):
+        return await self.run(db_manager.get_margin_balance, code, limit)
+
+    async def get_market_advance_decline(self, limit: int = 30, market_filter: str = None):
+        return await self.run(db_manager.get_market_advance_decline, limit, market_filter)
+
+    async def get_table_stats(self):
+        return await self.run(db_manager.get_table_stats)
+
+    # --- 書き込み ---
+    async def log_analysis_history(self, code: str, company_name: str = None, user_name: str = None, success: bool = True):
+        """分析履歴をキューに積む（記録日時は呼び出し時点）"""
+        if self._queue is None:
+            await self.start()
+        await self._queue.put((code, company_name, datetime.now().isoformat(), user_name, success))
+
+    async def _writer_loop(self):
+        """キューから履歴を取り出し、一定件数・一定時間ごとにまとめて書き込む"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self._flush_interval
+            while len(batch) < self._batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                await loop.run_in_executor(self._writer, db_manager.log_analysis_history_many, batch)
+            except Exception as e:
+                print(f"⚠️  History batch write failed ({len(batch)}件): {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
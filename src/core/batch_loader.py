@@ -1,6 +1,6 @@
 import os
+import sys
 import requests
-import pandas as pd
 import sqlite3
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
@@ -9,7 +9,21 @@ import time
 import jpholiday
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
-from src.core.db_manager import get_connection
+from src.core.db_manager import get_connection, create_tables, upsert_companies, bump_version
+from src.core.financial_versions import apply_daily_financials, migrate_daily_financials, FIN_COLUMNS
+from src.core.csv_schema import parse_csv, SCHEMAS
+from src.core.bulk_writer import (bulk_upsert, format_counts, apply_bulk_pragmas, restore_pragmas,
+                                  drop_secondary_indexes, restore_secondary_indexes)
+from src.core.snapshot import publish_snapshot
+from src.core.db_maintenance import run_analyze, run_checkpoint, run_quick_check
+from src.core.ingest_pipeline import IngestPipeline
+from src.core.batch_metrics import BatchMetrics
+from src.core.table_stats import mark_ingested, load_table_stats, refresh_table_stats, format_table_stats
+from src.core.rate_limiter import TokenBucket, ThroughputStats, parse_retry_after
+from src.core.ingest_manifest import (load_manifest, record_ingest, content_hash, is_confirmed_missing,
+                                      STATUS_DONE, STATUS_NOT_FOUND, STATUS_FAILED)
+from src.core.margin_calendar import is_market_day, is_publication_day, learn_publication_offsets, probe_days
+from src.core.raw_archive import archive_path, save_raw, load_raw, conditional_headers
 from typing import Union
 
 # .envファイルを読み込み
@@ -17,206 +31,231 @@ load_dotenv()
 KABU_PLUS_USER = os.getenv('KABU_PLUS_USER')
 KABU_PLUS_PASSWORD = os.getenv('KABU_PLUS_PASSWORD')
 
-# 株・プラスのベースURL
-KABU_PLUS_BASE_URL = 'https://csvex.com/kabu.plus/csv/'
+# 株・プラスのベースURL（KABU_PLUS_BASE_URL でローカルの代替サーバー tools/kabuplus_stub_server.py などに向けられる）
+KABU_PLUS_BASE_URL = (os.getenv('KABU_PLUS_BASE_URL') or 'https://csvex.com/kabu.plus/csv/').rstrip('/') + '/'
 TIMEOUT = 30
-ENCODING = 'cp932'
+
+# 同時ダウンロード数と、サーバーへの平均リクエスト数（件/秒）の上限
+DEFAULT_WORKERS = 4
+DEFAULT_RPS = 2.0
+# 429 Too Many Requests を受けたときの再試行回数
+MAX_THROTTLE_RETRIES = 5
+# バックフィルで何日分ごとにコミットするか（中断時に失うのは最大でこの日数分）
+BACKFILL_COMMIT_DAYS = 20
+
+# データセットごとのCSVの置き場所 (ディレクトリ, ファイル名の接頭辞)
+DATASET_FILES = {
+    'prices': ('japan-all-stock-prices-2/daily', 'japan-all-stock-prices-2'),
+    'financials': ('japan-all-stock-data/daily', 'japan-all-stock-data'),
+    'margin': ('tosho-stock-margin-transactions-2/weekly', 'tosho-stock-margin-transactions-2'),
+    'indices': ('tosho-index-data/daily', 'tosho-index-data'),
+}
+
+def dataset_filename(dataset: str, date_str: str) -> str:
+    """データセット・日付に対応するCSVのファイル名"""
+    return f"{DATASET_FILES[dataset][1]}_{date_str}.csv"
+
+def dataset_url(dataset: str, date_str: str) -> str:
+    """データセット・日付に対応するCSVのURL"""
+    return f"{KABU_PLUS_BASE_URL}{DATASET_FILES[dataset][0]}/{dataset_filename(dataset, date_str)}"
+
+def _log(message: str):
+    """ワーカースレッドからの出力（改行ごと1回で書き込み、他スレッドの出力と行が混ざらないようにする）"""
+    sys.stdout.write(message + '\n')
 
 # --- 接続設定 ---
-def make_session_with_retries():
-    """リトライ機能付きのrequestsセッションを作成"""
+def make_session_with_retries(pool_size: int = DEFAULT_WORKERS):
+    """リトライ機能付きのrequestsセッションを作成（接続プールは同時ダウンロード数に合わせる）"""
     s = requests.Session()
+    # 429 は fetch_csv_bytes でレート制限器ごと停止させるため、ここでは 5xx のみリトライする
+    # （urllib3 は Retry-After 付きの 429 を自前で再試行してしまうので respect_retry_after_header も切る）
     retries = Retry(total=3, backoff_factor=0.5,
-                    status_forcelist=[429, 500, 502, 503, 504],
-                    allowed_methods=["GET"])
-    s.mount("https://", HTTPAdapter(max_retries=retries))
+                    status_forcelist=[500, 502, 503, 504],
+                    allowed_methods=["GET"],
+                    respect_retry_after_header=False)
+    adapter = HTTPAdapter(max_retries=retries, pool_connections=pool_size, pool_maxsize=pool_size)
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
     s.headers.update({
         "User-Agent": "StockAnalysisBot/1.0"
     })
     return s
 
-def fetch_csv_as_dataframe(url: str, session: requests.Session, skiprows: int = 0):
-    """URLからCSVをダウンロードし、Pandas DataFrameとして返す"""
+def download_csv(url: str, session: requests.Session, limiter: TokenBucket = None, stats: ThroughputStats = None,
+                 headers: dict = None, timing: dict = None):
+    """
+    URLからCSVをダウンロードする
+
+    limiter を渡すとリクエストごとにトークンを取得する。429 を受けたら Retry-After の間
+    limiter 全体を停止し（他のワーカーも待つ）、同じURLを再試行する。
+    headers に If-None-Match / If-Modified-Since を渡すと条件付きGETになり、変更が無ければ 304 を返す。
+    timing に dict を渡すと、リクエスト数・再試行数（429 と 5xx）・応答待ちの合計ミリ秒・受信バイト数を書き込む。
+
+    Returns:
+        (HTTPステータス, 本文のバイト列, レスポンスヘッダ)。本文は200のときのみ。通信エラー時のステータスは None
+    """
     auth_tuple = (KABU_PLUS_USER, KABU_PLUS_PASSWORD)
-    
-    try:
-        response = session.get(url, auth=auth_tuple, timeout=TIMEOUT)
-        response.raise_for_status()
-        df = pd.read_csv(io.BytesIO(response.content), encoding=ENCODING, skiprows=skiprows)
-        return df
-
-    except requests.exceptions.HTTPError as e:
-        if response.status_code == 404:
-            print(f"  -> スキップ: {url.split('/')[-1]} (404 Not Found)")
+    filename = url.split('/')[-1]
+    timing = timing if timing is not None else {}
+    timing.update(requests=0, retries=0, latency_ms=0.0, bytes=0)
+
+    for attempt in range(MAX_THROTTLE_RETRIES + 1):
+        if limiter is not None:
+            limiter.acquire()
+        requested = time.perf_counter()
+        try:
+            response = session.get(url, auth=auth_tuple, timeout=TIMEOUT, headers=headers)
+        except Exception as e:
+            _log(f"  -> エラー: {filename}: {e}")
+            if stats: stats.add(requests=1, errors=1)
+            timing['requests'] += 1
+            timing['retries'] += 1 if attempt else 0
+            timing['latency_ms'] += (time.perf_counter() - requested) * 1000
+            return None, None, {}
+        if stats: stats.add(requests=1)
+        # urllib3 が 5xx で再試行した回数も数える
+        urllib3_retries = len(getattr(getattr(response.raw, 'retries', None), 'history', None) or ())
+        timing['requests'] += 1 + urllib3_retries
+        timing['retries'] += urllib3_retries + (1 if attempt else 0)
+        timing['latency_ms'] += (time.perf_counter() - requested) * 1000
+
+        if response.status_code == 429:
+            wait = parse_retry_after(response.headers.get('Retry-After'))
+            _log(f"  -> 429 Too Many Requests: {filename} ({wait:.1f}秒待機)")
+            if stats: stats.add(throttled=1)
+            if limiter is not None:
+                limiter.pause(wait)
+            else:
+                time.sleep(wait)
+            continue
+
+        if response.status_code == 304:
+            if stats: stats.add(not_modified=1)
+        elif response.status_code == 404:
+            _log(f"  -> スキップ: {filename} (404 Not Found)")
+            if stats: stats.add(not_found=1)
         elif response.status_code == 401:
-            print(f"  -> エラー: 401 Unauthorized")
+            _log(f"  -> エラー: 401 Unauthorized")
+            if stats: stats.add(errors=1)
+        elif response.status_code >= 400:
+            _log(f"  -> エラー: HTTP {response.status_code} {filename}")
+            if stats: stats.add(errors=1)
         else:
-            print(f"  -> エラー: HTTP {e}")
+            if stats: stats.add(files=1, bytes=len(response.content))
+            timing['bytes'] = len(response.content)
+            return response.status_code, response.content, response.headers
+        return response.status_code, None, response.headers
+
+    _log(f"  -> エラー: {filename} (429 が続いたため中止)")
+    if stats: stats.add(errors=1)
+    return 429, None, {}
+
+def fetch_csv_bytes(url: str, session: requests.Session, limiter: TokenBucket = None, stats: ThroughputStats = None):
+    """URLからCSVをダウンロードし、本文のバイト列を返す（404などの場合は None）"""
+    status_code, content, _ = download_csv(url, session, limiter, stats)
+    return content if status_code == 200 else None
+
+def parse_dataset(dataset: str, date_str: str, content):
+    """CSV本文（バイト列またはバイナリストリーム）をデータセットのスキーマ (csv_schema) で DataFrame に変換する"""
+    source = io.BytesIO(content) if isinstance(content, (bytes, bytearray)) else content
+    try:
+        return parse_csv(source, SCHEMAS[dataset])
     except Exception as e:
-        print(f"  -> エラー: {e}")
+        _log(f"  -> エラー: {dataset_filename(dataset, date_str)}: {e}")
     return None
 
 
 # --- 1. 日足株価 & 企業マスタ更新 ---
-def insert_daily_prices(date_str: str, conn: sqlite3.Connection, session: requests.Session):
-    filename = f"japan-all-stock-prices-2_{date_str}.csv"
-    url = f"{KABU_PLUS_BASE_URL}japan-all-stock-prices-2/daily/{filename}"
-    
-    df = fetch_csv_as_dataframe(url, session, skiprows=0)
-    if df is None: return
+# 既存カラムに加え、売買代金と時価総額（全銘柄）を追加
+PRICE_COLUMNS = ['code', 'date', 'open', 'high', 'low', 'close', 'volume', 'trading_value', 'market_cap_total']
+
+def parse_daily_prices(date_str: str, content):
+    """日足株価CSVを (企業マスタ, 株価) の DataFrame に変換する（DBには触れない）"""
+    df = parse_dataset('prices', date_str, content)
+    if df is None: return None
 
     try:
-        # DBに格納するカラム（DB名はcamel_case）とCSVヘッダー名のマッピング
-        col_map = {
-            'SC': 'code',
-            '名称': 'name',       # 企業名を保存
-            '市場': 'market',     # 市場区分
-            '業種': 'industry',   # 業種
-            '日付': 'date',
-            '始値': 'open',
-            '高値': 'high',
-            '安値': 'low',
-            '株価': 'close',
-            '出来高': 'volume',
-            '売買代金（千円）': 'trading_value',
-            '時価総額（百万円）': 'market_cap_total'
-        }
-        
-        # 必要なカラムの存在チェック (必須カラムのみ)
-        must_have = ['SC', '名称', '日付', '株価']
-        missing = [c for c in must_have if c not in df.columns]
-        if missing:
-            print(f"  -> デバッグ情報：現在のDFカラム: {list(df.columns)}")
-            raise KeyError(f"CSVに必須カラムが見つかりません: {missing}")
-
-        # リネーム対象のCSVカラムを抽出（存在するもののみ）
-        valid_cols = {csv_name: db_name for csv_name, db_name in col_map.items() if csv_name in df.columns}
-        df.rename(columns=valid_cols, inplace=True)
-        
-        # データ型変換
-        df['date'] = date_str 
-        df['code'] = df['code'].astype(str)
+        df['date'] = date_str
 
         # --- A. 企業マスタ (companies) の更新 ---
-        # 毎日更新することで、社名変更や新規上場に対応
-        companies_df = df[['code', 'name', 'market', 'industry']].copy()
-        companies_df.drop_duplicates(subset=['code'], inplace=True)
-        
-        comp_records = [tuple(x) for x in companies_df.where(pd.notnull(companies_df), None).to_numpy()]
-        conn.executemany("""
-            INSERT OR REPLACE INTO companies (code, name, market, industry)
-            VALUES (?, ?, ?, ?)
-        """, comp_records)
+        # 毎日突き合わせることで、社名変更や新規上場に対応（変更のあった銘柄のみ書き込み）
+        companies_df = df[['code', 'name', 'market', 'industry']].drop_duplicates(subset=['code'])
 
         # --- B. 日足株価 (daily_prices) の更新 ---
-        # 既存カラムに加え、売買代金と時価総額（全銘柄）を追加
-        prices_db_cols = ['code', 'date', 'open', 'high', 'low', 'close', 'volume', 'trading_value', 'market_cap_total']
-        prices_df = df[[c for c in prices_db_cols if c in df.columns]].copy()
-        
-        # DBカラムに不足している場合はNoneを追加
-        for col in prices_db_cols:
-            if col not in prices_df.columns:
-                prices_df[col] = None
+        # 欠損値は NaN のまま渡す（bulk_writer がステージングテーブル経由で NULL として書き込む）
+        return companies_df, df[PRICE_COLUMNS]
+
+    except Exception as e:
+        print(f"  -> エラー(株価): {e}")
+    return None
 
-        price_records = [tuple(row) for row in prices_df.where(pd.notnull(prices_df), None).itertuples(index=False)]
+def store_daily_prices(conn: sqlite3.Connection, date_str: str, payload):
+    try:
+        companies_df, prices_df = payload
+        comp_counts = upsert_companies(conn, companies_df)
+        counts = bulk_upsert(conn, 'daily_prices', prices_df, PRICE_COLUMNS)
 
-        conn.executemany(f"""
-            INSERT OR REPLACE INTO daily_prices ({', '.join(prices_db_cols)}) 
-            VALUES ({', '.join(['?'] * len(prices_db_cols))})
-        """, price_records)
-        
-        print(f"  -> 株価・企業情報: {len(price_records)}件 処理完了")
+        mark_ingested(conn, 'daily_prices', date_str)
+        print(f"  -> 株価: {len(prices_df)}件 処理完了 ({format_counts(counts)}) / "
+              f"企業情報: 新規 {comp_counts['inserted']} / 変更 {comp_counts['updated']}")
+        return counts
 
     except Exception as e:
         print(f"  -> エラー(株価): {e}")
+    return None
+
+def insert_daily_prices(date_str: str, conn: sqlite3.Connection, session: requests.Session):
+    content = fetch_csv_bytes(dataset_url('prices', date_str), session)
+    payload = parse_daily_prices(date_str, content) if content is not None else None
+    if payload is not None:
+        store_daily_prices(conn, date_str, payload)
 
 
 # --- 2. 財務指標 ---
-def insert_daily_financials(date_str: str, conn: sqlite3.Connection, session: requests.Session):
-    filename = f"japan-all-stock-data_{date_str}.csv"
-    url = f"{KABU_PLUS_BASE_URL}japan-all-stock-data/daily/{filename}"
-    
-    # 財務データも1行目がヘッダーなので skiprows=0
-    df = fetch_csv_as_dataframe(url, session, skiprows=0)
-    if df is None: return
+def parse_daily_financials(date_str: str, content):
+    """財務指標CSVを FIN_COLUMNS 順のレコードに変換する（DBには触れない）"""
+    df = parse_dataset('financials', date_str, content)
+    if df is None: return None
     
     try:
-        col_map = {
-            'SC': 'code',
-            '時価総額（百万円）': 'market_cap',
-            '発行済株式数': 'shares_outstanding',
-            '配当利回り（予想）': 'dividend_yield',
-            'PER（予想）': 'per_forecast',
-            'PBR（実績）': 'pbr_actual',
-            'EPS（予想）': 'eps_forecast',
-            'BPS（実績）': 'bps_actual',
-            '最低投資金額': 'min_investment'
-        }
-        
-        # 必要なカラムの存在チェック (必須カラムのみ)
-        must_have = ['SC', 'PER（予想）', 'PBR（実績）']
-        missing = [c for c in must_have if c not in df.columns]
-        if missing:
-            # 時価総額のカラム名が揺れる可能性に対応
-            if '時価総額（全銘柄）' in df.columns:
-                df.rename(columns={'時価総額（全銘柄）': 'market_cap'}, inplace=True)
-                col_map.pop('時価総額（百万円）', None) 
-            else:
-                raise KeyError(f"CSVに必須カラムが見つかりません: {missing}")
-        
-        # リネーム
-        valid_cols = {csv_name: db_name for csv_name, db_name in col_map.items() if csv_name in df.columns}
-        df.rename(columns=valid_cols, inplace=True)
-        
-        # DB挿入カラムのリスト
-        fin_db_cols = ['code', 'date', 'market_cap', 'shares_outstanding', 'per_forecast', 'pbr_actual', 
-                    'eps_forecast', 'bps_actual', 'dividend_yield', 'min_investment']
-
         df['date'] = date_str
-        df['code'] = df['code'].astype(str)
-        
-        # DBカラムに不足している場合はNoneを追加
-        for col in fin_db_cols:
-            if col not in df.columns:
-                df[col] = None
+        # 欠損値 (NaN) は apply_daily_financials が None に揃える
+        return list(df[FIN_COLUMNS].itertuples(index=False, name=None))
         
-        # DB挿入順に並べ替え
-        df = df[fin_db_cols]
-
-        records = [tuple(row) for row in df.where(pd.notnull(df), None).itertuples(index=False)]
+    except Exception as e:
+        print(f"  -> エラー(財務): {e}")
+    return None
 
-        conn.executemany(f"""
-            INSERT OR REPLACE INTO daily_financials ({', '.join(fin_db_cols)}) 
-            VALUES ({', '.join(['?'] * len(fin_db_cols))})
-        """, records)
-        print(f"  -> 財務指標: {len(records)}件 処理完了")
+def store_daily_financials(conn: sqlite3.Connection, date_str: str, records):
+    try:
+        # 基礎値が変わった銘柄だけを変更履歴 (financial_versions) に書き込む
+        # 同日の株価 (store_daily_prices) が先に格納されている必要がある
+        counts = apply_daily_financials(conn, date_str, records)
+        mark_ingested(conn, 'financial_versions', date_str)
+        print(f"  -> 財務指標: {len(records)}件 処理完了 (新規 {counts['new']} / 変更 {counts['changed']} / 変化なし {counts['unchanged']})")
+        return {'inserted': counts['new'], 'updated': counts['changed'], 'unchanged': counts['unchanged']}
         
     except Exception as e:
         print(f"  -> エラー(財務): {e}")
+    return None
+
+def insert_daily_financials(date_str: str, conn: sqlite3.Connection, session: requests.Session):
+    content = fetch_csv_bytes(dataset_url('financials', date_str), session)
+    records = parse_daily_financials(date_str, content) if content is not None else None
+    if records is not None:
+        store_daily_financials(conn, date_str, records)
 
 
 # --- 3. 信用残 ---
-def insert_weekly_margin(date_str: str, conn: sqlite3.Connection, session: requests.Session):
-    # 祝日チェック：週次データが公表される可能性のある市場営業日のみ処理
-    download_date = datetime.strptime(date_str, '%Y%m%d').date()
-    if jpholiday.is_holiday(download_date): # 祝日チェック
-        print(f"  -> スキップ: {date_str} (市場休業日/祝日)")
-        return
-    
-    filename = f"tosho-stock-margin-transactions-2_{date_str}.csv"
-    url = f"{KABU_PLUS_BASE_URL}tosho-stock-margin-transactions-2/weekly/{filename}"
-    
-    df = fetch_csv_as_dataframe(url, session, skiprows=0)
-    if df is None: return
+MARGIN_COLUMNS = ['code', 'date', 'sell_balance_total', 'buy_balance_total', 'ratio',
+                  'sell_balance_ins', 'buy_balance_ins', 'sell_balance_gen', 'buy_balance_gen']
 
-    try:
-        original_cols = ["SC","公表日","信用取引区分","信用売残","信用売残 前週比","信用買残","信用買残 前週比","貸借倍率", "制度信用売残", "制度信用売残 前週比", "制度信用買残", "制度信用買残 前週比", "一般信用売残", "一般信用売残 前週比", "一般信用買残", "一般信用買残 前週比"]
-        
-        if len(df.columns) == len(original_cols):
-            df.columns = original_cols
-        else:
-            raise KeyError(f"カラム数不一致: CSV({len(df.columns)}) vs 期待値({len(original_cols)})")
+def parse_weekly_margin(date_str: str, content):
+    """信用残CSVを (データ日付, DataFrame) に変換する（DBには触れない）"""
+    df = parse_dataset('margin', date_str, content)
+    if df is None: return None
 
+    try:
         # --- 日付計算ロジック（祝日対応版）---
         # 1. 公表日（通常火曜など）から、データが指し示す「前週の金曜日」を計算
         current_date = datetime.strptime(date_str, '%Y%m%d').date()
@@ -234,163 +273,415 @@ def insert_weekly_margin(date_str: str, conn: sqlite3.Connection, session: reque
             data_date -= timedelta(days=1)
             
         found_date_str = data_date.strftime('%Y%m%d')
-        df['date'] = found_date_str 
 
         # 欠損値を含む行を削除 (数値データがない行を除くため)
-        df.dropna(subset=['信用売残', '信用買残'], inplace=True) 
-        
-        # DBに格納するカラムとCSVヘッダー名のマッピング
-        col_map = {
-            'SC': 'code',
-            '信用売残': 'sell_balance_total', '信用買残': 'buy_balance_total',
-            '貸借倍率': 'ratio', '制度信用売残': 'sell_balance_ins', 
-            '制度信用買残': 'buy_balance_ins', '一般信用売残': 'sell_balance_gen', 
-            '一般信用買残': 'buy_balance_gen'
-        }
-        
-        valid_cols = {csv_name: db_name for csv_name, db_name in col_map.items() if csv_name in df.columns}
-        df.rename(columns=valid_cols, inplace=True)
-        
-        margin_db_cols = ['code', 'date', 'sell_balance_total', 'buy_balance_total', 'ratio', 
-                        'sell_balance_ins', 'buy_balance_ins', 'sell_balance_gen', 'buy_balance_gen']
-        
-        df['code'] = df['code'].astype(str)
+        df = df.dropna(subset=['sell_balance_total', 'buy_balance_total'])
+        df['date'] = found_date_str
+        return found_date_str, df[MARGIN_COLUMNS]
         
-        for col in margin_db_cols:
-            if col not in df.columns:
-                df[col] = None
-        
-        df = df[margin_db_cols]
-
-        records = [tuple(row) for row in df.where(pd.notnull(df), None).itertuples(index=False)]
+    except Exception as e:
+        print(f"  -> エラー(信用残): {e}")
+    return None
 
-        conn.executemany(f"""
-            INSERT OR REPLACE INTO weekly_margin ({', '.join(margin_db_cols)}) 
-            VALUES ({', '.join(['?'] * len(margin_db_cols))})
-        """, records)
-        print(f"  -> 信用残: {len(records)}件 処理完了 (データ日付: {found_date_str})")
+def store_weekly_margin(conn: sqlite3.Connection, date_str: str, payload):
+    try:
+        found_date_str, df = payload
+        counts = bulk_upsert(conn, 'weekly_margin', df, MARGIN_COLUMNS)
+        mark_ingested(conn, 'weekly_margin', found_date_str)
+        print(f"  -> 信用残: {len(df)}件 処理完了 ({format_counts(counts)}, データ日付: {found_date_str})")
+        return counts
         
     except Exception as e:
         print(f"  -> エラー(信用残): {e}")
-        print(f"  -> デバッグ情報(信用残): DFカラム: {list(df.columns)}") # オプション
+    return None
+
+def insert_weekly_margin(date_str: str, conn: sqlite3.Connection, session: requests.Session):
+    # 公表日チェック：週次データが公表される可能性のある日（週の2営業日目など）と、
+    # 同じ週の公表日の候補が 404 確定だった日のみ処理
+    offsets = learn_publication_offsets(conn)
+    probes = probe_days(load_manifest(conn, _week_start(date_str), date_str), date_str, date_str, offsets)
+    if not (is_publication_day(date_str, offsets) or probes):
+        print(f"  -> スキップ: {date_str} (信用残の公表日ではありません)")
+        return
+
+    content = fetch_csv_bytes(dataset_url('margin', date_str), session)
+    payload = parse_weekly_margin(date_str, content) if content is not None else None
+    if payload is not None:
+        store_weekly_margin(conn, date_str, payload)
 
 
 # --- 4. 指標データ (東証インデックス、セクター別指数) ---
-def insert_daily_indices(date_str: str, conn: sqlite3.Connection, session: requests.Session):
-    filename = f"tosho-index-data_{date_str}.csv"
-    url = f"{KABU_PLUS_BASE_URL}tosho-index-data/daily/{filename}"
+# 最終的なDB格納カラム (db_managerで定義したカラム名)
+INDEX_COLUMNS = ['code', 'name', 'date', 'close', 'change_ratio', 'market_cap_index', 'volume', '銘柄数']
 
-    df = fetch_csv_as_dataframe(url, session, skiprows=0)
-    if df is None: return
+def parse_daily_indices(date_str: str, content):
+    """指数CSVを DataFrame に変換する（DBには触れない）"""
+    df = parse_dataset('indices', date_str, content)
+    if df is None: return None
 
     try:
-        # 🌟 ご提示いただいた正しい日本語ヘッダー名を使用
-        original_cols = ["SC","指数名","日付","終値","前日比","前日比（％）","前日終値","時価総額（指数用・浮動株ベース）","時価総額前日比（同左）","前日時価総額（同左）","平均時価総額（同左）","基準時価総額","銘柄数","売買単位換算後株式数"]
-
-        # CSVのヘッダー数が合致するか確認
-        if len(df.columns) == len(original_cols):
-            df.columns = original_cols
-        else:
-            # ヘッダーの括弧がない可能性も考慮したチェック
-            alt_original_cols = ["SC","指数名","日付","終値","前日比","前日比（％）","前日終値","時価総額（指数用・浮動株ベース）","時価総額前日比","前日時価総額","平均時価総額","基準時価総額","銘柄数","売買単位換算後株式数"]
-            if len(df.columns) == len(alt_original_cols):
-                df.columns = alt_original_cols
-            else:
-                raise KeyError(f"カラム数不一致: CSV({len(df.columns)}) vs 期待値({len(original_cols)})")
-
-        # DBに格納するカラムとCSVヘッダー名のマッピング
-        col_map = {
-            'SC': 'code',
-            '指数名': 'name',
-            '日付': 'date',
-            '終値': 'close',
-            '前日比（％）': 'change_ratio',
-            '時価総額（指数用・浮動株ベース）': 'market_cap_index',
-            '売買単位換算後株式数': 'volume', # DBカラム: volume
-            '銘柄数': '銘柄数' # DBカラム: 銘柄数
-        }
-
-        # 実際のDataFrameのカラム名とDB名のマッピングを構築
-        valid_cols = {}
-        for csv_name in df.columns:
-            if csv_name in col_map:
-                valid_cols[csv_name] = col_map[csv_name]
-        
-        df.rename(columns=valid_cols, inplace=True)
-        
-        # 最終的なDB格納カラム (db_managerで定義したカラム名)
-        index_db_cols = ['code', 'name', 'date', 'close', 'change_ratio', 'market_cap_index', 'volume', '銘柄数']
-        
         df['date'] = date_str
-        df['code'] = df['code'].astype(str)
-
-        # 欠損値対応
-        for col in index_db_cols:
-            if col not in df.columns:
-                df[col] = None
+        return df[INDEX_COLUMNS]
         
-        # DB挿入順に並べ替え
-        df = df[index_db_cols]
-
-        records = [tuple(row) for row in df.where(pd.notnull(df), None).itertuples(index=False)]
+    except Exception as e:
+        print(f"  -> エラー(業種別指数データ): {e}")
+    return None
 
-        conn.executemany(f"""
-            INSERT OR REPLACE INTO daily_indices ({', '.join(index_db_cols)}) 
-            VALUES ({', '.join(['?'] * len(index_db_cols))})
-        """, records)
-        print(f"  -> 業種別指数データ: {len(records)}件 処理完了")
+def store_daily_indices(conn: sqlite3.Connection, date_str: str, df):
+    try:
+        counts = bulk_upsert(conn, 'daily_indices', df, INDEX_COLUMNS)
+        mark_ingested(conn, 'daily_indices', date_str)
+        print(f"  -> 業種別指数データ: {len(df)}件 処理完了 ({format_counts(counts)})")
+        return counts
         
     except Exception as e:
         print(f"  -> エラー(業種別指数データ): {e}")
+    return None
+
+def insert_daily_indices(date_str: str, conn: sqlite3.Connection, session: requests.Session):
+    content = fetch_csv_bytes(dataset_url('indices', date_str), session)
+    df = parse_daily_indices(date_str, content) if content is not None else None
+    if df is not None:
+        store_daily_indices(conn, date_str, df)
+
 
-def run_daily_batch(start_date_str: str, end_date_str: str):
+# データセットごとの (名前, CSVの変換, DB書き込み)。同じ日付ではこの順に書き込む
+# （財務指標は同日の終値を使うため、株価より後に書き込む必要がある）
+# DB書き込みは {'inserted', 'updated', 'unchanged'} の行数を返す（エラー時は None）
+DATASETS = [
+    ('prices', parse_daily_prices, store_daily_prices),
+    ('financials', parse_daily_financials, store_daily_financials),
+    ('margin', parse_weekly_margin, store_weekly_margin),
+    ('indices', parse_daily_indices, store_daily_indices),
+]
+
+
+def _week_start(date_str: str) -> str:
+    """その日を含む週の月曜日 (YYYYMMDD)"""
+    d = datetime.strptime(date_str, '%Y%m%d')
+    return (d - timedelta(days=d.weekday())).strftime('%Y%m%d')
+
+
+def fetch_file(dataset: str, date_str: str, session: requests.Session,
+               limiter: TokenBucket = None, stats: ThroughputStats = None, known_hash: str = None):
+    """
+    1ファイルをダウンロードする（ダウンロードスレッドで実行、DBには触れない）
+
+    取得したCSVは生のままアーカイブ (raw_archive) に保存する。アーカイブ済みのファイルは
+    条件付きGETで再検証し、304 ならアーカイブの内容を使う。
+
+    Args:
+        known_hash: 取り込み済みファイルのハッシュ。本文が同じなら 'unchanged' を返す（解析しない）
+
+    Returns:
+        (状態, CSV本文, {'byte_size', 'content_hash', 'error', 'download_bytes', 'download_ms', 'requests', 'retries'})
+        状態は STATUS_DONE / STATUS_NOT_FOUND / STATUS_FAILED / 'unchanged'
+    """
+    url = dataset_url(dataset, date_str)
+    path = archive_path(dataset, dataset_filename(dataset, date_str), date_str)
+    timing = {}
+    status_code, content, headers = download_csv(url, session, limiter, stats, conditional_headers(path), timing)
+    download = {'download_bytes': timing['bytes'], 'download_ms': timing['latency_ms'],
+                'requests': timing['requests'], 'retries': timing['retries']}
+    if status_code == 404:
+        return STATUS_NOT_FOUND, None, download
+    if status_code == 304:
+        content = load_raw(path)
+    elif content is not None:
+        save_raw(path, content, headers, url)
+    if content is None:
+        return STATUS_FAILED, None, {**download, 'error': f"HTTP {status_code}" if status_code else 'connection error'}
+
+    meta = {**download, 'byte_size': len(content), 'content_hash': content_hash(content)}
+    if known_hash is not None and known_hash == meta['content_hash']:
+        return 'unchanged', None, meta
+    return STATUS_DONE, content, meta
+
+
+def parse_file(dataset: str, date_str: str, content):
+    """
+    CSV本文をデータセットの変換関数 (DATASETS) で変換する（解析プロセスで実行できるようモジュール直下に置く）
+
+    Returns:
+        変換結果（失敗時 None）
+    """
+    parse = next(parse for name, parse, _ in DATASETS if name == dataset)
+    return parse(date_str, content)
+
+def _ingest_result(conn: sqlite3.Connection, name: str, date_str: str, store, future,
+                   results: dict, parse_times: dict, write_counts: dict, metrics=None) -> int:
+    """
+    1ファイル分のダウンロード・変換結果 (IngestPipeline) をDBに書き込み、マニフェストに記録する（コミットは呼び出し側）
+
+    metrics (batch_metrics.BatchMetrics) を渡すと、ファイルごとの計測値を記録する。
+
+    Returns:
+        書き込み対象の行数（エラー・404・変化なしは 0）
+    """
+    try:
+        status, payload, meta = future.result()
+    except Exception as e:
+        print(f"  -> エラー: {e}")
+        status, payload, meta = STATUS_FAILED, None, {'error': str(e)}
+
+    row_count, counts, write_ms = None, None, None
+    if status == STATUS_DONE:
+        writing = time.perf_counter()
+        counts = store(conn, date_str, payload)
+        write_ms = (time.perf_counter() - writing) * 1000
+        if counts is None:
+            status, meta = STATUS_FAILED, {**meta, 'error': 'store error'}
+        else:
+            row_count = sum(counts.values())
+            total = write_counts.setdefault(name, dict.fromkeys(counts, 0))
+            for key, value in counts.items():
+                total[key] += value
+    results[status] += 1
+    if 'parse_ms' in meta:
+        parse_times.setdefault(name, []).append((meta['parse_ms'], date_str))
+    if status != 'unchanged':
+        record_ingest(conn, name, date_str, status, row_count,
+                      meta.get('byte_size'), meta.get('content_hash'), meta.get('error'), meta.get('parse_ms'))
+    if metrics is not None:
+        metrics.add_file(name, date_str, status, meta, write_ms, counts)
+    return row_count or 0
+
+
+def _finish_backfill(conn: sqlite3.Connection, dropped: list, previous_pragmas: dict):
+    """バックフィルの後始末（インデックスの再作成・統計情報の更新・WALの書き戻し・整合性チェック）"""
+    print("\n--- バックフィルの後処理 ---")
+    started = time.time()
+    if dropped:
+        restore_secondary_indexes(conn)
+        print(f"  -> インデックスを再作成: {', '.join(dropped)} ({time.time() - started:.1f}秒)")
+
+    started = time.time()
+    run_analyze(conn, incremental=False)
+    print(f"  -> ANALYZE/optimize ({time.time() - started:.1f}秒)")
+
+    restore_pragmas(conn, previous_pragmas)
+    if conn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal':
+        checkpoint = run_checkpoint(conn, incremental=False)
+        print(f"  -> wal_checkpoint({checkpoint['mode']}): {checkpoint['checkpointed']}/{checkpoint['log_frames']}フレーム")
+
+    started = time.time()
+    quick_check = run_quick_check(conn)
+    status_icon = "✅" if quick_check == ['ok'] else "❌"
+    print(f"  -> quick_check: {status_icon} {', '.join(quick_check[:5])} ({time.time() - started:.1f}秒)")
+
+
+def run_daily_batch(start_date_str: str, end_date_str: str, workers: int = DEFAULT_WORKERS, rps: float = DEFAULT_RPS,
+                    recheck: bool = False, backfill: bool = False, commit_days: int = None, drop_indexes: bool = False,
+                    parse_workers: int = None, publish: bool = True):
     """
     指定期間の日次/週次データをダウンロードし、データベースに格納するバッチ処理を実行
+
+    取り込みパイプライン (ingest_pipeline) で、ダウンロードは workers 本のスレッド、CSVの変換は parse_workers 個の
+    プロセスで日付・データセットをまたいで並行に行い、サーバーへのリクエストはトークンバケットで平均 rps 件/秒に抑える。
+    DBへの書き込みはメインスレッドが日付・DATASETS の順に行う（SQLiteの書き手は常に1つ）。
+
+    ファイルごとの結果は ingest_manifest に記録し、日付ごとにコミットする。
+    取り込み済み (done) のファイルはダウンロードしないため、中断したバッチは同じ期間で再実行すれば続きから再開する。
+    後日確認した 404 も再取得しない。信用残は公表日カレンダー (margin_calendar) で公表され得る日だけ取得する。
+
+    backfill では数年分の取り込み向けに、一括ロード用の接続設定 (bulk_writer.BULK_PRAGMAS) を使い、
+    commit_days 日ごとにコミットする（中断しても最後にコミットした日付までは記録とデータが一致している）。
+    終了時にインデックスを作り直し、統計情報の更新・WALの書き戻し・整合性チェックまで行う。
+
+    Args:
+        workers: 同時ダウンロード数
+        rps: 1秒あたりのリクエスト数の上限（0以下で無制限）
+        recheck: 取り込み済みのファイルも再取得し、内容（ハッシュ）が変わったものだけ取り込み直す
+        backfill: 一括ロードモード
+        commit_days: 何日分ごとにコミットするか（既定: 通常 1、backfill では BACKFILL_COMMIT_DAYS）
+        drop_indexes: backfill 中は日次データのテーブルの二次インデックスを外し、終了時に作り直す
+        parse_workers: CSVを変換するプロセス数（0 ならダウンロードスレッドで変換。既定: 通常 0、backfill では CPU数 - 1）
+        publish: 完了後にスナップショットを公開する（分割バックフィルのシャードDBでは公開しない）
     """
     if not all([KABU_PLUS_USER, KABU_PLUS_PASSWORD]):
         print("❌ エラー: .envファイルにKABU_PLUS_USERまたはKABU_PLUS_PASSWORDが設定されていません。")
         return
 
-    session = make_session_with_retries()
+    workers = max(workers, 1)
+    commit_days = max(commit_days or (BACKFILL_COMMIT_DAYS if backfill else 1), 1)
+    if parse_workers is None:
+        parse_workers = max((os.cpu_count() or 1) - 1, 1) if backfill else 0
+    session = make_session_with_retries(workers)
+    limiter = TokenBucket(rps)
+    stats = ThroughputStats()
     start_date = datetime.strptime(start_date_str, '%Y%m%d')
     end_date = datetime.strptime(end_date_str, '%Y%m%d')
     
-    print(f"=== バッチ処理開始: {start_date_str} ~ {end_date_str} ===")
+    mode = f", バックフィル: {commit_days}日ごとにコミット" if backfill else ''
+    print(f"=== バッチ処理開始: {start_date_str} ~ {end_date_str} (並列 {workers}, 解析 {parse_workers}プロセス, "
+          f"上限 {rps:g}件/s{mode}) ===")
     
     dates = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
-    
-    with get_connection() as conn:
+    stores = {name: store for name, _, store in DATASETS}
+    metrics = BatchMetrics('backfill' if backfill else 'daily', start_date_str, end_date_str)
+
+    def fetch(dataset, date_str, known_hash):
+        return fetch_file(dataset, date_str, session, limiter, stats, known_hash)
+
+    with get_connection() as conn, IngestPipeline(fetch, parse_file, workers, parse_workers) as pipeline:
+        previous_pragmas = apply_bulk_pragmas(conn) if backfill else None
+        # 新しく追加されたテーブル・ビューを用意し、旧形式の daily_financials が残っていれば移行する
+        create_tables(conn)
+        migrate_daily_financials(conn)
+        # 前回のバックフィルが中断して外れたままのインデックスがあれば戻す
+        restored = restore_secondary_indexes(conn)
+        if restored:
+            print(f"  -> インデックスを復元: {', '.join(restored)}")
+        dropped = drop_secondary_indexes(conn) if backfill and drop_indexes else []
+        if dropped:
+            print(f"  -> インデックスを一時的に削除: {', '.join(dropped)}")
+        stats_before = load_table_stats(conn)
+        manifest = load_manifest(conn, start_date_str, end_date_str)
+        margin_offsets = learn_publication_offsets(conn)
+        # 信用残を取り込み済みの週（週の月曜日）。同じ週の他の日は取得しない
+        margin_weeks = {_week_start(file_date) for (name, file_date), entry in manifest.items()
+                        if name == 'margin' and entry['status'] == STATUS_DONE}
+        # 公表日の候補が 404 確定だった週は、残りの営業日も取得してみる（ずれた公表日を学習できるように）
+        margin_probes = set(probe_days(manifest, start_date_str, end_date_str, margin_offsets))
+
+        tasks = []
+        skipped, known_missing, not_published = 0, 0, 0
         for date in dates:
             date_str = date.strftime('%Y%m%d')
             
             # 土日はスキップ
             if date.weekday() >= 5: continue
             
-            # 祝日もスキップ（無駄なアクセスを防ぐ）
-            if jpholiday.is_holiday(date):
+            # 祝日・年末年始もスキップ（無駄なアクセスを防ぐ）
+            if not is_market_day(date):
                 print(f"Skipping: {date_str} (Holiday)")
                 continue
-                
-            print(f"Processing: {date_str}")
-            insert_daily_prices(date_str, conn, session)
-            insert_daily_financials(date_str, conn, session)
-            insert_weekly_margin(date_str, conn, session)
-            insert_daily_indices(date_str, conn, session)
-            
-            time.sleep(1) # サーバー負荷軽減
-        
+
+            for name, parse, store in DATASETS:
+                entry = manifest.get((name, date_str))
+                known_hash = None
+                if entry and entry['status'] == STATUS_DONE:
+                    if not recheck:
+                        skipped += 1
+                        continue
+                    known_hash = entry['content_hash']
+                elif is_confirmed_missing(entry):
+                    known_missing += 1
+                    continue
+                elif name == 'margin' and (not (is_publication_day(date, margin_offsets) or date_str in margin_probes)
+                                           or _week_start(date_str) in margin_weeks):
+                    not_published += 1
+                    continue
+                tasks.append((name, date_str, known_hash))
+        print(f"  -> 取得対象: {len(tasks)}ファイル (取り込み済み {skipped} / 404確定 {known_missing} / "
+              f"信用残の非公表日 {not_published} をスキップ)")
+
+        results = {STATUS_DONE: 0, STATUS_NOT_FOUND: 0, STATUS_FAILED: 0, 'unchanged': 0}
+        parse_times = {}
+        write_counts = {}
+        current_date = None
+        pending_days, total_rows = 0, 0
+        load_started = time.time()
+        try:
+            tried = set()
+            while tasks:
+                # 先行して処理するファイル数はパイプラインの depth までに抑え、変換済みのCSVがメモリに溜まりすぎないようにする
+                for (name, date_str, _), future in pipeline.run(tasks):
+                    if date_str != current_date:
+                        pending_days += current_date is not None
+                        if pending_days >= commit_days:
+                            # 前の日付までの全ファイルとその記録をまとめて確定する（中断時の再開点）
+                            conn.commit()
+                            pending_days = 0
+                            if backfill:
+                                elapsed = time.time() - load_started
+                                print(f"  [backfill] {current_date} まで確定: {total_rows:,}行, {elapsed:.0f}秒 "
+                                      f"({total_rows / max(elapsed, 1e-9):,.0f}行/s)")
+                        current_date = date_str
+                        print(f"Processing: {date_str}")
+                    total_rows += _ingest_result(conn, name, date_str, stores[name], future, results, parse_times,
+                                                 write_counts, metrics)
+                # この実行で公表日の候補が 404 確定になった週は、同じ週の残りの営業日を続けて取得してみる
+                tried.update((name, date_str) for name, date_str, _ in tasks)
+                probes = probe_days(load_manifest(conn, start_date_str, end_date_str), start_date_str, end_date_str,
+                                    margin_offsets)
+                tasks = [('margin', date_str, None) for date_str in probes if ('margin', date_str) not in tried]
+                if tasks:
+                    print(f"  -> 信用残の公表日を確認: {', '.join(date_str for _, date_str, _ in tasks)}")
+        except BaseException as e:
+            # 未確定の日付は破棄し（次回のバッチで取り込み直す）、外したインデックスを戻す
+            conn.rollback()
+            if dropped:
+                restore_secondary_indexes(conn)
+            metrics.save('interrupted' if isinstance(e, KeyboardInterrupt) else 'failed')
+            raise
+        load_elapsed = time.time() - load_started
+
+        # 書き込んだ行があればデータ版数を進め、各プロセスのクエリキャッシュの古い結果を無効にする
+        if any(c['inserted'] or c['updated'] for c in write_counts.values()):
+            bump_version(conn, 'data_version')
         conn.commit()
-        print("\n=== ✅ 全処理完了 ===")
+
+        print(f"\n--- {stats.summary(limiter)} ---")
+        print(f"--- {pipeline.summary()} ---")
+        print(f"--- マニフェスト: 取込 {results[STATUS_DONE]} / 変化なし {results['unchanged']} / "
+              f"404 {results[STATUS_NOT_FOUND]} / 失敗 {results[STATUS_FAILED]} / "
+              f"スキップ {skipped + known_missing + not_published} ---")
+        for name, counts in write_counts.items():
+            print(f"--- 書き込み {name}: {format_counts(counts)} ---")
+        print(f"--- 書き込み合計: {total_rows:,}行, {load_elapsed:.1f}秒 ({total_rows / max(load_elapsed, 1e-9):,.0f}行/s) ---")
+        for name, times in parse_times.items():
+            slowest_ms, slowest_date = max(times)
+            print(f"--- 解析 {name}: {len(times)}ファイル, 平均 {sum(t for t, _ in times) / len(times):.0f}ms, "
+                  f"最大 {slowest_ms:.0f}ms ({slowest_date}) ---")
+        if backfill:
+            _finish_backfill(conn, dropped, previous_pragmas)
+
+        # テーブル統計を更新し、バッチ前後の増減を記録
+        print("\n--- テーブル統計 ---")
+        for line in format_table_stats(refresh_table_stats(conn), stats_before):
+            print(f"  {line}")
+
+    # 完了した状態をスナップショットとして公開（Botはこちらを読む）
+    if publish:
+        try:
+            publish_snapshot()
+        except Exception as e:
+            print(f"  -> エラー(スナップショット公開): {e}")
+
+    # ファイルごと・実行全体の計測値を batch_runs / JSONL に残す（batch_metrics.py trends で推移を確認できる）
+    run = metrics.save()
+    rss = f", ピークRSS {run['peak_rss_mb']:.0f}MB" if run['peak_rss_mb'] is not None else ''
+    print(f"--- 計測記録: #{run['run_id']} 全体 {run['wall_s']:.1f}秒, 再試行 {run['retries']}{rss} ---")
+    print("\n=== ✅ 全処理完了 ===")
 
 if __name__ == '__main__':
     import argparse
     
     parser = argparse.ArgumentParser(description='Stock Data Batch Loader')
     parser.add_argument('--days', type=int, default=0, help='Past days to fetch (default: 0 = Today only)')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help=f'Concurrent downloads (default: {DEFAULT_WORKERS})')
+    parser.add_argument('--rps', type=float, default=DEFAULT_RPS,
+                        help=f'Max requests per second to the server, 0 = unlimited (default: {DEFAULT_RPS:g})')
+    parser.add_argument('--recheck', action='store_true',
+                        help='Re-download already ingested files and re-ingest those whose content changed')
+    parser.add_argument('--from', dest='start', help='First date YYYYMMDD (overrides --days)')
+    parser.add_argument('--to', dest='end', help='Last date YYYYMMDD (default: today)')
+    parser.add_argument('--backfill', action='store_true',
+                        help='Bulk-load mode for multi-year history (bulk PRAGMAs, periodic commits, final checks)')
+    parser.add_argument('--commit-days', type=int, default=None,
+                        help=f'Commit every N days (default: 1, or {BACKFILL_COMMIT_DAYS} with --backfill)')
+    parser.add_argument('--drop-indexes', action='store_true',
+                        help='With --backfill, drop secondary indexes on the data tables and rebuild them at the end')
+    parser.add_argument('--parse-workers', type=int, default=None,
+                        help='CSV parser processes, 0 = parse in the download threads (default: 0, or CPUs - 1 with --backfill)')
+    parser.add_argument('--no-snapshot', action='store_true', help='Do not publish a read-only snapshot at the end')
     args = parser.parse_args()
 
     # 指定日数分を取得
-    end_date = datetime.now()
-    start_date = end_date - timedelta(days=args.days)
+    end_date = datetime.strptime(args.end, '%Y%m%d') if args.end else datetime.now()
+    start_date = datetime.strptime(args.start, '%Y%m%d') if args.start else end_date - timedelta(days=args.days)
     
-    run_daily_batch(start_date.strftime('%Y%m%d'), end_date.strftime('%Y%m%d'))
+    run_daily_batch(start_date.strftime('%Y%m%d'), end_date.strftime('%Y%m%d'), args.workers, args.rps, args.recheck,
+                    args.backfill, args.commit_days, args.drop_indexes, args.parse_workers, not args.no_snapshot)
@@ -0,0 +1,282 @@
+"""
+バッチの計測記録（ファイルごと・実行ごと）と傾向の表示
+
+run_daily_batch の実行ごとに、ファイル単位の計測値と実行全体の集計をDB (batch_file_metrics / batch_runs) と
+JSONL (logs/batch_metrics.jsonl) に残す。ログの「処理完了」の行を拾わなくても、実行をまたいだ比較ができる。
+
+    ファイルごと: 受信バイト数・応答待ち時間・リクエスト数と再試行数（429 / 5xx）・解析時間・書き込み時間・
+                  新規/更新/変化なしの行数
+    実行ごと:     上記の合計、ピークメモリ (RSS。本体と解析プロセス)、全体の所要時間、終了状態
+
+trends は直近の実行を前半・後半に分け、データセットごとの1ファイルあたりの解析・書き込み時間と行数の変化を比べる。
+データの増加による遅れを、定期バッチ (18:00) の時間枠を超える前に見つけるためのもの。
+
+Usage:
+    PYTHONPATH=. python src/core/batch_metrics.py runs [--limit 20]
+    PYTHONPATH=. python src/core/batch_metrics.py trends [--runs 30] [--mode daily] [--budget-min 30]
+"""
+import os
+import sys
+import json
+import time
+import sqlite3
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from src.core.db_manager import get_connection, DB_PATH
+
+METRICS_LOG = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'logs', 'batch_metrics.jsonl')
+
+# trends で前半より悪化したとみなす比率（1ファイルあたりの時間が 20% 以上増えたら警告）
+TREND_WARN_RATIO = 1.2
+# 1回の実行の所要時間の目安（分）
+DEFAULT_BUDGET_MIN = 30
+
+RUN_COLUMNS = ['started_at', 'finished_at', 'mode', 'status', 'start_date', 'end_date', 'db_path',
+               'files', 'failed', 'download_bytes', 'requests', 'retries', 'download_s', 'parse_s', 'write_s', 'wall_s',
+               'rows_inserted', 'rows_updated', 'rows_unchanged', 'peak_rss_mb', 'peak_child_rss_mb']
+FILE_COLUMNS = ['run_id', 'dataset', 'file_date', 'status', 'bytes', 'download_bytes', 'download_ms', 'requests',
+                'retries', 'parse_ms', 'write_ms', 'rows_inserted', 'rows_updated', 'rows_unchanged']
+
+
+def peak_rss_mb() -> tuple:
+    """(本体, 終了した子プロセスの最大) のピークRSS (MB)。計測できない環境では (None, None)"""
+    if resource is None:
+        return None, None
+    # Linux は KB、macOS はバイト単位
+    unit = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit)
+
+
+class BatchMetrics:
+    """1回の実行の計測値を集める（書き込みスレッドから add_file を呼ぶ）"""
+
+    def __init__(self, mode: str, start_date: str, end_date: str):
+        self.mode = mode
+        self.start_date = start_date
+        self.end_date = end_date
+        self.started_at = datetime.now().isoformat(timespec='seconds')
+        self._started = time.perf_counter()
+        self.files = []
+
+    def add_file(self, dataset: str, file_date: str, status: str, meta: dict, write_ms: float = None,
+                 counts: dict = None):
+        counts = counts or {}
+
+        def ms(value):
+            return round(value, 1) if value is not None else None
+
+        self.files.append({
+            'dataset': dataset,
+            'file_date': file_date,
+            'status': status,
+            'bytes': meta.get('byte_size'),
+            'download_bytes': meta.get('download_bytes'),
+            'download_ms': ms(meta.get('download_ms')),
+            'requests': meta.get('requests'),
+            'retries': meta.get('retries'),
+            'parse_ms': ms(meta.get('parse_ms')),
+            'write_ms': ms(write_ms),
+            'rows_inserted': counts.get('inserted'),
+            'rows_updated': counts.get('updated'),
+            'rows_unchanged': counts.get('unchanged'),
+        })
+
+    def summary(self, status: str) -> dict:
+        """実行全体の集計"""
+        def total(key: str) -> float:
+            return sum(f[key] or 0 for f in self.files)
+
+        rss, child_rss = peak_rss_mb()
+        return {
+            'started_at': self.started_at,
+            'finished_at': datetime.now().isoformat(timespec='seconds'),
+            'mode': self.mode,
+            'status': status,
+            'start_date': self.start_date,
+            'end_date': self.end_date,
+            'db_path': os.path.abspath(DB_PATH),
+            'files': sum(f['status'] == 'done' for f in self.files),
+            'failed': sum(f['status'] == 'failed' for f in self.files),
+            'download_bytes': int(total('download_bytes')),
+            'requests': int(total('requests')),
+            'retries': int(total('retries')),
+            'download_s': round(total('download_ms') / 1000, 3),
+            'parse_s': round(total('parse_ms') / 1000, 3),
+            'write_s': round(total('write_ms') / 1000, 3),
+            'wall_s': round(time.perf_counter() - self._started, 3),
+            'rows_inserted': int(total('rows_inserted')),
+            'rows_updated': int(total('rows_updated')),
+            'rows_unchanged': int(total('rows_unchanged')),
+            'peak_rss_mb': round(rss, 1) if rss is not None else None,
+            'peak_child_rss_mb': round(child_rss, 1) if child_rss is not None else None,
+        }
+
+    def save(self, status: str = 'ok', log_path: str = None) -> dict:
+        """
+        集計を batch_runs / batch_file_metrics と JSONL に書き込む（失敗してもバッチは止めない）
+
+        Args:
+            status: ok / failed / interrupted
+
+        Returns:
+            実行全体の集計（run_id 付き）
+        """
+        run = self.summary(status)
+        try:
+            conn = get_connection()
+            try:
+                cursor = conn.execute(f"INSERT INTO batch_runs ({', '.join(RUN_COLUMNS)}) "
+                                      f"VALUES ({', '.join(['?'] * len(RUN_COLUMNS))})",
+                                      [run[c] for c in RUN_COLUMNS])
+                run['run_id'] = cursor.lastrowid
+                conn.executemany(f"INSERT OR REPLACE INTO batch_file_metrics ({', '.join(FILE_COLUMNS)}) "
+                                 f"VALUES ({', '.join(['?'] * len(FILE_COLUMNS))})",
+                                 [[run['run_id']] + [f[c] for c in FILE_COLUMNS[1:]] for f in self.files])
+                conn.commit()
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            print(f"  -> エラー(計測記録 DB): {e}")
+            run['run_id'] = None
+
+        log_path = log_path or METRICS_LOG
+        try:
+            os.makedirs(os.path.dirname(log_path), exist_ok=True)
+            with open(log_path, 'a', encoding='utf-8') as f:
+                for record in self.files:
+                    f.write(json.dumps({'type': 'file', 'run_id': run['run_id'], 'started_at': self.started_at,
+                                        **record}, ensure_ascii=False) + '\n')
+                f.write(json.dumps({'type': 'run', 'run_id': run['run_id'], **run}, ensure_ascii=False) + '\n')
+        except OSError as e:
+            print(f"  -> エラー(計測記録 JSONL): {e}")
+        return run
+
+
+def format_run(run: dict) -> str:
+    """実行1回分の1行表示"""
+    rows = (run['rows_inserted'] or 0) + (run['rows_updated'] or 0)
+    rss = f"{run['peak_rss_mb']:.0f}MB" if run['peak_rss_mb'] is not None else '-'
+    child = f"/{run['peak_child_rss_mb']:.0f}MB" if run['peak_child_rss_mb'] else ''
+    return (f"#{run['run_id']:<4} {run['started_at'][:16]} {run['mode']:<8} {run['status']:<11} "
+            f"{run['files']:>5}ファイル {rows:>9,}行 {(run['download_bytes'] or 0) / 1024 / 1024:>7.1f}MB "
+            f"全体 {run['wall_s']:>7.1f}秒 (DL {run['download_s']:.1f} / 解析 {run['parse_s']:.1f} / "
+            f"書込 {run['write_s']:.1f}) 再試行 {run['retries']} RSS {rss}{child}")
+
+
+def load_runs(conn: sqlite3.Connection, limit: int = 20, mode: str = None) -> list:
+    """直近の実行（古い順。batch_runs 未作成の旧DBでは空）"""
+    where, params = ("WHERE mode = ?", [mode]) if mode else ('', [])
+    columns = ['run_id'] + RUN_COLUMNS
+    try:
+        rows = conn.execute(f"SELECT {', '.join(columns)} FROM batch_runs {where} "
+                            f"ORDER BY run_id DESC LIMIT ?", params + [limit]).fetchall()
+    except sqlite3.OperationalError:
+        return []
+    return [dict(zip(columns, row)) for row in reversed(rows)]
+
+
+def _change(before: float, after: float) -> str:
+    if not before:
+        return '   -'
+    ratio = after / before
+    mark = ' ⚠️' if ratio >= TREND_WARN_RATIO else ''
+    return f"{ratio - 1:+5.0%}{mark}"
+
+
+def trends(conn: sqlite3.Connection, runs: int = 30, mode: str = 'daily', budget_min: float = DEFAULT_BUDGET_MIN) -> list:
+    """
+    直近 runs 回の実行を前半・後半に分け、データセットごとの1ファイルあたりの計測値の変化と、所要時間の推移を返す
+
+    Returns:
+        表示用の行のリスト
+    """
+    history = [r for r in load_runs(conn, runs, mode) if r['files']]
+    if len(history) < 2:
+        return [f"比較できる実行がありません（{mode}: {len(history)}回）"]
+
+    run_ids = [r['run_id'] for r in history]
+    half = len(run_ids) // 2
+    earlier = set(run_ids[:half])
+    per_file = {}
+    for run_id, dataset, files, size, download_ms, parse_ms, write_ms, rows in conn.execute(f"""
+        SELECT run_id, dataset, COUNT(*), AVG(bytes), AVG(download_ms), AVG(parse_ms), AVG(write_ms),
+               AVG(COALESCE(rows_inserted, 0) + COALESCE(rows_updated, 0) + COALESCE(rows_unchanged, 0))
+        FROM batch_file_metrics
+        WHERE status = 'done' AND run_id IN ({', '.join(['?'] * len(run_ids))})
+        GROUP BY run_id, dataset
+    """, run_ids):
+        group = 'earlier' if run_id in earlier else 'later'
+        per_file.setdefault(dataset, {'earlier': [], 'later': []})[group].append(
+            (files, size, download_ms, parse_ms, write_ms, rows))
+
+    def average(samples: list, index: int) -> float:
+        """ファイル数で重み付けした平均"""
+        weighted = [(s[0], s[index]) for s in samples if s[index] is not None]
+        files = sum(w for w, _ in weighted)
+        return sum(w * v for w, v in weighted) / files if files else 0.0
+
+    lines = [f"--- 1ファイルあたりの変化 ({mode}: 前半 {half}回 → 後半 {len(run_ids) - half}回) ---"]
+    for dataset, groups in sorted(per_file.items()):
+        before, after = groups['earlier'], groups['later']
+        cells = []
+        for label, index, fmt in (('行数', 5, '{:,.0f}'), ('サイズ', 1, '{:,.0f}B'), ('DL', 2, '{:.0f}ms'),
+                                  ('解析', 3, '{:.0f}ms'), ('書込', 4, '{:.0f}ms')):
+            a, b = average(before, index), average(after, index)
+            cells.append(f"{label} {fmt.format(b)} ({_change(a, b)})")
+        lines.append(f"  {dataset:<10} " + ' / '.join(cells))
+
+    # 所要時間の推移（最小二乗法の傾き）から、目安の時間を超えるまでの回数を見積もる
+    walls = [r['wall_s'] for r in history]
+    n = len(walls)
+    mean_x, mean_y = (n - 1) / 2, sum(walls) / n
+    slope = sum((i - mean_x) * (w - mean_y) for i, w in enumerate(walls)) / sum((i - mean_x) ** 2 for i in range(n))
+    budget = budget_min * 60
+    lines.append(f"--- 所要時間: 直近 {walls[-1]:.1f}秒 / 平均 {mean_y:.1f}秒 / 最大 {max(walls):.1f}秒, "
+                 f"1回あたり {slope:+.2f}秒 ---")
+    if walls[-1] >= budget:
+        lines.append(f"  ❌ 直近の実行が目安 ({budget_min:g}分) を超えています")
+    elif slope > 0:
+        remaining = (budget - (mean_y + slope * (n - 1 - mean_x))) / slope
+        icon = '⚠️' if remaining < n else '✅'
+        lines.append(f"  {icon} このままの増え方だと約 {remaining:,.0f}回後に目安 ({budget_min:g}分) を超えます")
+    else:
+        lines.append(f"  ✅ 所要時間は増えていません（目安 {budget_min:g}分）")
+    return lines
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Batch metrics per run and trends across runs')
+    sub = parser.add_subparsers(dest='command', required=True)
+    runs_parser = sub.add_parser('runs', help='List recent batch runs')
+    runs_parser.add_argument('--limit', type=int, default=20, help='Runs to show (default: 20)')
+    runs_parser.add_argument('--mode', choices=['daily', 'backfill', 'bundle'], help='Only runs of this mode')
+    trends_parser = sub.add_parser('trends', help='Compare per-file costs between older and newer runs')
+    trends_parser.add_argument('--runs', type=int, default=30, help='Recent runs to compare (default: 30)')
+    trends_parser.add_argument('--mode', choices=['daily', 'backfill', 'bundle'], default='daily',
+                               help='Run mode to compare (default: daily)')
+    trends_parser.add_argument('--budget-min', type=float, default=DEFAULT_BUDGET_MIN,
+                               help=f'Wall-time budget per run in minutes (default: {DEFAULT_BUDGET_MIN})')
+    args = parser.parse_args()
+
+    conn = get_connection()
+    try:
+        if args.command == 'runs':
+            runs = load_runs(conn, args.limit, args.mode)
+            if not runs:
+                print("  記録された実行がありません")
+            for run in runs:
+                print(format_run(run))
+        else:
+            for line in trends(conn, args.runs, args.mode, args.budget_min):
+                print(line)
+    finally:
+        conn.close()
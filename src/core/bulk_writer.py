@@ -0,0 +1,310 @@
+"""
+DataFrame の一括書き込み（TEMP ステージングテーブル経由）
+
+従来の書き込みは DataFrame を1行ずつ Python のタプルに変換し（欠損値を None に置き換える where と itertuples）、
+INSERT OR REPLACE を executemany で実行していた。ここでは
+
+    1. カラムごとに値のリストを取り出し（Series.tolist）、行ごとの NaN→None 変換をせずに
+       TEMP のステージングテーブルへ executemany で流し込む
+       （SQLite は float の NaN を NULL として格納するため、欠損値はそのまま渡してよい）
+    2. INSERT ... SELECT ... ON CONFLICT DO UPDATE の1文で本テーブルへマージする
+
+の2段階で書き込む。INSERT OR REPLACE と違い、既存行を削除して入れ直さないため、
+主キーのインデックスを更新し直す手間もかからない。
+
+マージでは主キーで本テーブルと突き合わせ、新規の行と値が変わった行だけを書き込む
+（同じファイルの再取り込みや、毎日ほぼ同じ内容の企業マスタは、ほとんど書き込まずに済む）。
+書き込み量・WALの増加・キャッシュの無効化は、実際に変わった行の分だけになる。
+
+ステージングテーブルは接続ごとの TEMP スキーマに、本テーブルと同じカラム・型で作られ、
+書き込みのたびに空にして使い回す。
+
+数年分を取り込むバックフィル (run_daily_batch(backfill=True)) 向けに、一括ロード用の接続設定
+(apply_bulk_pragmas) と、日次データのテーブルの二次インデックスを外して後で作り直す処理
+(drop_secondary_indexes / restore_secondary_indexes) もここに置く。
+
+Usage:
+    PYTHONPATH=. python src/core/bulk_writer.py bench [--rows 3800] [--days 180] [--repeat 5]
+"""
+import os
+import sys
+import json
+import time
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from src.core.db_manager import create_tables, get_metadata, set_metadata
+
+# 日次データの本テーブルの主キー
+TABLE_KEYS = {
+    'companies': ['code'],
+    'daily_prices': ['code', 'date'],
+    'weekly_margin': ['code', 'date'],
+    'daily_indices': ['code', 'date'],
+}
+
+
+def _quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def staging_table(conn: sqlite3.Connection, table: str, columns: list) -> str:
+    """本テーブルと同じ型のステージングテーブルを（無ければ）作って空にし、その名前を返す"""
+    staging = f"temp.{_quote('staging_' + table)}"
+    col_list = ', '.join(_quote(c) for c in columns)
+    conn.execute(f"CREATE TEMP TABLE IF NOT EXISTS {_quote('staging_' + table)} AS "
+                 f"SELECT {col_list} FROM main.{_quote(table)} WHERE 0")
+    conn.execute(f"DELETE FROM {staging}")
+    return staging
+
+
+def stage_frame(conn: sqlite3.Connection, table: str, df: pd.DataFrame, columns: list) -> str:
+    """DataFrame の指定カラムをステージングテーブルに流し込む（カラム単位で取り出し、行ごとの変換はしない）"""
+    staging = staging_table(conn, table, columns)
+    values = zip(*(df[c].tolist() for c in columns))
+    conn.executemany(f"INSERT INTO {staging} VALUES ({', '.join(['?'] * len(columns))})", values)
+    return staging
+
+
+def merge_staging(conn: sqlite3.Connection, table: str, staging: str, columns: list, keys: list = None) -> dict:
+    """
+    ステージングテーブルの行のうち、新規または値が変わった行だけを本テーブルにマージする
+
+    Returns:
+        {'inserted': 新規行数, 'updated': 更新行数, 'unchanged': 変化なしの行数}
+    """
+    keys = keys or TABLE_KEYS[table]
+    target = f"main.{_quote(table)}"
+    values = [c for c in columns if c not in keys]
+    join = ' AND '.join(f"t.{_quote(k)} = s.{_quote(k)}" for k in keys)
+    missing = f"t.{_quote(keys[0])} IS NULL"
+    # IS NOT は NULL 同士を等しいとみなす比較
+    changed = ' OR '.join(f"s.{_quote(c)} IS NOT t.{_quote(c)}" for c in values) or '0'
+    updates = ', '.join(f"{_quote(c)} = excluded.{_quote(c)}" for c in values)
+    conflict = f"DO UPDATE SET {updates}" if updates else "DO NOTHING"
+
+    total = conn.execute(f"SELECT COUNT(*) FROM {staging}").fetchone()[0]
+    inserted = conn.execute(f"SELECT COUNT(*) FROM {staging} s LEFT JOIN {target} t ON {join} WHERE {missing}").fetchone()[0]
+    written = conn.execute(f"""
+        INSERT INTO {target} ({', '.join(_quote(c) for c in columns)})
+        SELECT {', '.join(f's.{_quote(c)}' for c in columns)}
+        FROM {staging} s LEFT JOIN {target} t ON {join}
+        WHERE {missing} OR {changed}
+        ON CONFLICT({', '.join(_quote(k) for k in keys)}) {conflict}
+    """).rowcount
+    return {'inserted': inserted, 'updated': written - inserted, 'unchanged': total - written}
+
+
+def bulk_upsert(conn: sqlite3.Connection, table: str, df: pd.DataFrame, columns: list, keys: list = None) -> dict:
+    """
+    DataFrame を本テーブルへ一括で書き込む（新規・変更のあった行のみ。コミットは呼び出し側）
+
+    Returns:
+        {'inserted': 新規行数, 'updated': 更新行数, 'unchanged': 変化なしの行数}
+    """
+    if df.empty:
+        return {'inserted': 0, 'updated': 0, 'unchanged': 0}
+    staging = stage_frame(conn, table, df, columns)
+    return merge_staging(conn, table, staging, columns, keys)
+
+
+def format_counts(counts: dict) -> str:
+    """書き込み件数の表示 (新規 / 更新 / 変化なし)"""
+    return f"新規 {counts['inserted']:,} / 更新 {counts['updated']:,} / 変化なし {counts['unchanged']:,}"
+
+
+# --- 一括ロード（バックフィル）用の設定 ---
+
+# バックフィル中の接続設定（接続単位。restore_pragmas で元に戻す）
+BULK_PRAGMAS = {
+    'synchronous': 'NORMAL',       # コミットごとの fsync を省く（WAL では NORMAL でもDBは壊れない）
+    'cache_size': -256 * 1024,     # ページキャッシュ 256MB（負値は KiB 単位）
+    'temp_store': 'MEMORY',        # ステージングテーブルをメモリに置く
+    'wal_autocheckpoint': 10000,   # チェックポイントの頻度を下げ、終了時にまとめて書き戻す
+}
+
+# 二次インデックスを外す対象（日次データのテーブル。主キーのインデックスは外せない）
+DATA_TABLES = ['companies', 'daily_prices', 'financial_versions', 'weekly_margin', 'daily_indices']
+
+# 外したインデックスの定義を残す db_metadata のキー（中断しても次回のバッチで作り直す）
+DROPPED_INDEXES_KEY = 'bulk_dropped_indexes'
+
+
+def apply_bulk_pragmas(conn: sqlite3.Connection) -> dict:
+    """
+    一括ロード用の接続設定を適用する（ステージングテーブルを作る前に呼ぶ。temp_store の変更で TEMP テーブルは消える）
+
+    Returns:
+        変更前の設定値（restore_pragmas に渡す）
+    """
+    previous = {}
+    for name, value in BULK_PRAGMAS.items():
+        previous[name] = conn.execute(f"PRAGMA {name}").fetchone()[0]
+        conn.execute(f"PRAGMA {name} = {value}")
+    return previous
+
+
+def restore_pragmas(conn: sqlite3.Connection, previous: dict):
+    """apply_bulk_pragmas で変えた接続設定を元に戻す"""
+    for name, value in previous.items():
+        conn.execute(f"PRAGMA {name} = {value}")
+
+
+def drop_secondary_indexes(conn: sqlite3.Connection, tables: list = None) -> list:
+    """
+    日次データのテーブルの二次インデックスを外す（定義は db_metadata に残してからコミットする）
+
+    Returns:
+        外したインデックス名のリスト
+    """
+    tables = tables or DATA_TABLES
+    rows = conn.execute(f"""
+        SELECT name, sql FROM sqlite_master
+        WHERE type = 'index' AND sql IS NOT NULL AND tbl_name IN ({', '.join(['?'] * len(tables))})
+    """, tables).fetchall()
+    if not rows:
+        return []
+    pending = json.loads(get_metadata(conn, DROPPED_INDEXES_KEY, '[]'))
+    set_metadata(conn, DROPPED_INDEXES_KEY, json.dumps(pending + [list(row) for row in rows], ensure_ascii=False))
+    for name, _ in rows:
+        conn.execute(f"DROP INDEX main.{_quote(name)}")
+    conn.commit()
+    return [name for name, _ in rows]
+
+
+def restore_secondary_indexes(conn: sqlite3.Connection) -> list:
+    """
+    drop_secondary_indexes で外したインデックスを作り直す（前回のバックフィルが中断していた場合も含む）
+
+    Returns:
+        作り直したインデックス名のリスト
+    """
+    pending = json.loads(get_metadata(conn, DROPPED_INDEXES_KEY, '[]'))
+    if not pending:
+        return []
+    existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    restored = []
+    for name, sql in pending:
+        if name not in existing:
+            conn.execute(sql)
+            restored.append(name)
+    conn.execute("DELETE FROM db_metadata WHERE key = ?", (DROPPED_INDEXES_KEY,))
+    conn.commit()
+    return restored
+
+
+# --- ベンチマーク ---
+
+PRICE_COLUMNS = ['code', 'date', 'open', 'high', 'low', 'close', 'volume', 'trading_value', 'market_cap_total']
+
+
+def _synthetic_prices(rows: int, date_str: str, rng) -> pd.DataFrame:
+    """日足株価ファイル1日分と同じ形（parse_daily_prices 相当）の DataFrame"""
+    close = rng.uniform(100, 10000, rows).round(1)
+    df = pd.DataFrame({
+        'code': pd.array([str(1300 + i) for i in range(rows)], dtype='str'),
+        'date': date_str,
+        'open': close * rng.uniform(0.98, 1.02, rows),
+        'high': close * 1.03,
+        'low': close * 0.97,
+        'close': close,
+        'volume': rng.integers(0, 10_000_000, rows).astype(np.float64),
+        'trading_value': rng.uniform(0, 1e7, rows),
+        'market_cap_total': rng.uniform(1e3, 1e7, rows),
+    })
+    # 売買の無い銘柄・新規上場など、欠損値を含む行
+    missing = rng.random(rows) < 0.05
+    df.loc[missing, ['open', 'high', 'low', 'trading_value']] = np.nan
+    return df
+
+
+def _legacy_insert(conn: sqlite3.Connection, df: pd.DataFrame) -> int:
+    """従来の書き込み（行ごとの NaN→None 変換 + INSERT OR REPLACE）"""
+    frame = df[PRICE_COLUMNS].astype(object)
+    records = [tuple(row) for row in frame.where(pd.notnull(frame), None).itertuples(index=False)]
+    conn.executemany(f"""
+        INSERT OR REPLACE INTO daily_prices ({', '.join(PRICE_COLUMNS)})
+        VALUES ({', '.join(['?'] * len(PRICE_COLUMNS))})
+    """, records)
+    return len(records)
+
+
+def _bench_db(path: str) -> sqlite3.Connection:
+    import contextlib
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    with contextlib.redirect_stdout(None):
+        create_tables(conn)
+    return conn
+
+
+def _digest(conn: sqlite3.Connection) -> tuple:
+    return conn.execute("""
+        SELECT COUNT(*), TOTAL(open), TOTAL(close), TOTAL(trading_value), COUNT(open) FROM daily_prices
+    """).fetchone()
+
+
+def benchmark(rows: int = 3800, days: int = 180, repeat: int = 5):
+    """
+    従来の書き込みとステージング経由の書き込みを比較する（一時ディレクトリのDBを使い、本番DBには触れない）
+
+        1日分: rows 行のファイルを同じ日付に repeat 回書き込み（初回は新規、2回目以降は同じ内容の再取り込み）
+        バックフィル: days 日分を日付ごとにコミットしながら書き込む
+    """
+    import tempfile
+
+    rng = np.random.default_rng(0)
+    writers = [('legacy (itertuples + INSERT OR REPLACE)', _legacy_insert),
+               ('staging (TEMP + INSERT ... ON CONFLICT)',
+                lambda conn, df: bulk_upsert(conn, 'daily_prices', df, PRICE_COLUMNS))]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"=== 一括書き込みのベンチマーク: 1日分 {rows:,}行 × {repeat}回 (中央値) ===")
+        df = _synthetic_prices(rows, '20250101', rng)
+        digests = {}
+        for label, write in writers:
+            conn = _bench_db(os.path.join(tmp, f"day_{len(digests)}.db"))
+            samples = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                write(conn, df)
+                conn.commit()
+                samples.append((time.perf_counter() - started) * 1000)
+            digests[label] = _digest(conn)
+            conn.close()
+            updates = sorted(samples[1:]) or samples
+            first, rest = samples[0], updates[len(updates) // 2]
+            print(f"  {label:<42} 新規 {first:>7.1f}ms  再取り込み {rest:>7.1f}ms  ({rows / rest * 1000:>9,.0f}行/s)")
+        print(f"  結果の一致: {'yes' if len(set(digests.values())) == 1 else 'NO'}")
+
+        print(f"\n=== バックフィル: {days}日 × {rows:,}行 ===")
+        frames = [_synthetic_prices(rows, f"2025{i // 28 + 1:02d}{i % 28 + 1:02d}", rng) for i in range(days)]
+        digests = {}
+        for label, write in writers:
+            conn = _bench_db(os.path.join(tmp, f"backfill_{len(digests)}.db"))
+            started = time.perf_counter()
+            for frame in frames:
+                write(conn, frame)
+                conn.commit()
+            elapsed = time.perf_counter() - started
+            digests[label] = _digest(conn)
+            conn.close()
+            print(f"  {label:<42} {elapsed:>7.2f}秒  ({days * rows / elapsed:>9,.0f}行/s)")
+        print(f"  結果の一致: {'yes' if len(set(digests.values())) == 1 else 'NO'}")
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Bulk writes through TEMP staging tables')
+    sub = parser.add_subparsers(dest='command', required=True)
+    bench = sub.add_parser('bench', help='Compare row-wise INSERT OR REPLACE with staged bulk upserts')
+    bench.add_argument('--rows', type=int, default=3800, help='Rows per daily file (default: 3800)')
+    bench.add_argument('--days', type=int, default=180, help='Days in the backfill run (default: 180)')
+    bench.add_argument('--repeat', type=int, default=5, help='Writes of the single daily file (default: 5)')
+    args = parser.parse_args()
+
+    benchmark(args.rows, args.days, args.repeat)
@@ -0,0 +1,453 @@
+"""
+株・プラスCSVのバンドル一括取り込み（新しい環境の初期データ投入用）
+
+数年分の履歴をサーバーから1日ずつ取得する代わりに、手元にコピーしたバンドル（ZIPファイルまたはディレクトリ）
+から取り込む。ファイル名 (<接頭辞>_YYYYMMDD.csv / .csv.gz) でデータセットと日付を判定するため、
+株・プラスのダウンロードをまとめたZIPも、他の環境の生CSVアーカイブ (data/raw) のコピーもそのまま使える。
+
+    - ZIPのメンバーはディスクに展開せず、読み込みスレッドでメモリ上に読み出す（ZIPの中のZIPも可）
+      ZIPの中のZIPは、無圧縮で格納されていれば外側のファイルの該当範囲をそのまま開き、圧縮されていれば
+      一時ファイルに1回だけ書き出して全スレッドで共有する。中のメンバーを全て読み終えたら閉じて削除する
+    - 変換は取り込みパイプライン (ingest_pipeline) の解析プロセスで並行に行い、書き込みはローダと同じ
+      データセットのスキーマ・DB書き込み (batch_loader.DATASETS) を日付・データセット順に使う
+    - 結果は取り込みマニフェスト (ingest_manifest) に記録する。取り込み済みのファイルは読まずにスキップし、
+      --recheck では内容（ハッシュ）が変わったものだけ取り込み直す。中断しても同じバンドルで再実行すれば続きから再開する
+    - 一括ロード用の接続設定で書き込み、BACKFILL_COMMIT_DAYS 日ごとにコミットし、終了時にバックフィルと同じ後処理を行う
+
+同じファイルが複数のバンドルにある場合は、後に指定したバンドルのものを使う。
+
+Usage:
+    PYTHONPATH=. python src/core/bundle_importer.py kabuplus_2020.zip kabuplus_2021.zip [--from 20200101] [--to 20211231]
+    PYTHONPATH=. python src/core/bundle_importer.py /mnt/copy/data/raw --parse-workers 3 --archive
+"""
+import os
+import re
+import sys
+import gzip
+import time
+import shutil
+import struct
+import zipfile
+import tempfile
+import threading
+from collections import Counter
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from src.core.db_manager import get_connection, create_tables, bump_version
+from src.core.batch_loader import (DATASETS, DATASET_FILES, BACKFILL_COMMIT_DAYS, dataset_filename, parse_file,
+                                   _ingest_result, _finish_backfill)
+from src.core.bulk_writer import (apply_bulk_pragmas, drop_secondary_indexes, restore_secondary_indexes,
+                                  format_counts)
+from src.core.financial_versions import migrate_daily_financials
+from src.core.ingest_pipeline import IngestPipeline
+from src.core.batch_metrics import BatchMetrics
+from src.core.ingest_manifest import load_manifest, content_hash, STATUS_DONE, STATUS_FAILED
+from src.core.raw_archive import archive_path, save_raw
+from src.core.table_stats import load_table_stats, refresh_table_stats, format_table_stats
+
+# バンドル内のファイル名 → (データセット, 日付)
+_FILE_PATTERNS = {
+    dataset: re.compile(rf"^{re.escape(prefix)}_(\d{{8}})\.csv(\.gz)?$", re.IGNORECASE)
+    for dataset, (_, prefix) in DATASET_FILES.items()
+}
+
+# 読み込みスレッド数（ZIPの展開は zlib が GIL を解放するため、スレッドでも並行に進む）
+DEFAULT_READ_WORKERS = 2
+
+
+def match_member(name: str):
+    """ファイル名（パス可）に対応する (データセット, 日付)。対象外なら None"""
+    basename = name.replace('\\', '/').rsplit('/', 1)[-1]
+    for dataset, pattern in _FILE_PATTERNS.items():
+        m = pattern.match(basename)
+        if m:
+            return dataset, m.group(1)
+    return None
+
+
+def scan_bundles(paths: list, start_date: str = None, end_date: str = None, reader: 'BundleReader' = None) -> dict:
+    """
+    バンドルに含まれるCSVを列挙する（本文は読まない）
+
+    Args:
+        paths: ZIPファイルまたはディレクトリのパス（ディレクトリは配下を再帰的に探し、中のZIPも開く）
+        reader: 入れ子のZIPを開くのに使う BundleReader（取り込みで同じものを使うと、一時ファイルを書き出し直さない）
+
+    Returns:
+        {(dataset, date_str): (ZIPファイルのパスのタプル, メンバー名 または ファイルのパス)}
+        ZIPの中のZIPは、外側から順にZIPファイルのパス・メンバー名を並べたタプルで表す
+    """
+    found = {}
+    own_reader = reader is None
+    reader = reader or BundleReader()
+
+    def add(name: str, location):
+        key = match_member(name)
+        if key is None or (start_date and key[1] < start_date) or (end_date and key[1] > end_date):
+            return
+        found[key] = location
+
+    def scan_zip(zf: zipfile.ZipFile, chain: tuple):
+        for info in zf.infolist():
+            if info.is_dir():
+                continue
+            if info.filename.lower().endswith('.zip'):
+                scan_zip(reader.open_zip(chain + (info.filename,)), chain + (info.filename,))
+            else:
+                add(info.filename, (chain, info.filename))
+
+    try:
+        for path in paths:
+            if os.path.isdir(path):
+                for root, dirs, files in os.walk(path):
+                    dirs.sort()
+                    for name in sorted(files):
+                        full = os.path.join(root, name)
+                        if name.lower().endswith('.zip'):
+                            scan_zip(reader.open_zip((full,)), (full,))
+                        else:
+                            add(name, ((), full))
+            elif zipfile.is_zipfile(path):
+                scan_zip(reader.open_zip((path,)), (path,))
+            else:
+                add(path, ((), path))
+    finally:
+        if own_reader:
+            reader.close()
+    return found
+
+
+class _MemberSlice:
+    """無圧縮で格納されたメンバーを、外側のファイルの一部としてシーク可能に読むファイルオブジェクト"""
+
+    def __init__(self, fp, start: int, size: int):
+        self._fp = fp
+        self._start = start
+        self._size = size
+        self._pos = 0
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self._pos, os.SEEK_END: self._size}[whence]
+        self._pos = min(max(base + offset, 0), self._size)
+        return self._pos
+
+    def read(self, n: int = -1) -> bytes:
+        remaining = self._size - self._pos
+        n = remaining if n is None or n < 0 else min(n, remaining)
+        # 外側の ZipFile と同じファイルを共有するため、読むたびに位置を合わせる
+        self._fp.seek(self._start + self._pos)
+        data = self._fp.read(n)
+        self._pos += len(data)
+        return data
+
+    def close(self):
+        pass
+
+
+def _member_offset(zf: zipfile.ZipFile, info: zipfile.ZipInfo) -> int:
+    """メンバーの本文の開始位置（ローカルファイルヘッダの直後）"""
+    zf.fp.seek(info.header_offset)
+    header = zf.fp.read(zipfile.sizeFileHeader)
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    return info.header_offset + zipfile.sizeFileHeader + name_length + extra_length
+
+
+class BundleReader:
+    """
+    バンドルのメンバーを読み出す（ZIPは読み込みスレッドごとに開いたものを使い回す）
+
+    入れ子のZIPは、無圧縮なら外側のファイルの該当範囲を直接開き、圧縮されていれば一時ファイルに1回だけ展開して
+    全スレッドで共有する。expect() で読む予定のメンバーを渡しておくと、入れ子のZIPは中のメンバーを
+    全て読み終えた時点で閉じ、一時ファイルを削除する。
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._opened = {}       # chain -> [各スレッドで開いた ZipFile]
+        self._caches = []       # 各スレッドの {chain: ZipFile}
+        self._spilled = {}      # chain -> 一時ファイルのパス
+        self._spill_locks = {}  # chain -> 書き出し中の Lock（他の chain の読み込みは止めない）
+        self._remaining = None  # 入れ子のZIPの chain -> 未読のメンバー数
+        self._tmp_dir = None
+
+    def _cache(self) -> dict:
+        cache = getattr(self._local, 'zips', None)
+        if cache is None:
+            cache = self._local.zips = {}
+            with self._lock:
+                self._caches.append(cache)
+        return cache
+
+    def _spill(self, parent: zipfile.ZipFile, chain: tuple) -> str:
+        """圧縮された入れ子のZIPを一時ファイルに書き出す（スレッド間で1回だけ）"""
+        with self._lock:
+            spill_lock = self._spill_locks.setdefault(chain, threading.Lock())
+            if self._tmp_dir is None:
+                self._tmp_dir = tempfile.mkdtemp(prefix='bundle_')
+        with spill_lock:
+            path = self._spilled.get(chain)
+            if path is None:
+                fd, path = tempfile.mkstemp(suffix='.zip', dir=self._tmp_dir)
+                with parent.open(chain[-1]) as src, os.fdopen(fd, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+                with self._lock:
+                    self._spilled[chain] = path
+        return path
+
+    def open_zip(self, chain: tuple) -> zipfile.ZipFile:
+        """chain が指すZIPを開く（このスレッドで開いたものがあれば再利用する）"""
+        cache = self._cache()
+        if chain not in cache:
+            if len(chain) == 1:
+                zf = zipfile.ZipFile(chain[0])
+            else:
+                parent = self.open_zip(chain[:-1])
+                info = parent.getinfo(chain[-1])
+                if info.compress_type == zipfile.ZIP_STORED:
+                    zf = zipfile.ZipFile(_MemberSlice(parent.fp, _member_offset(parent, info), info.file_size))
+                else:
+                    zf = zipfile.ZipFile(self._spill(parent, chain))
+            cache[chain] = zf
+            with self._lock:
+                self._opened.setdefault(chain, []).append(zf)
+        return cache[chain]
+
+    def expect(self, locations):
+        """これから読むメンバーを登録する（読む予定の無い入れ子のZIPはすぐに閉じる）"""
+        remaining = Counter()
+        for chain, _ in locations:
+            for depth in range(2, len(chain) + 1):
+                remaining[chain[:depth]] += 1
+        with self._lock:
+            self._remaining = remaining
+            unused = [chain for chain in set(self._opened) | set(self._spilled)
+                      if len(chain) > 1 and chain not in remaining]
+        for chain in unused:
+            self._release(chain)
+
+    def _release(self, chain: tuple):
+        """入れ子のZIPを全スレッドで閉じ、一時ファイルを削除する"""
+        with self._lock:
+            zips = self._opened.pop(chain, [])
+            for cache in self._caches:
+                cache.pop(chain, None)
+            path = self._spilled.pop(chain, None)
+            self._spill_locks.pop(chain, None)
+        for zf in zips:
+            zf.close()
+        if path:
+            os.remove(path)
+
+    def read(self, location) -> bytes:
+        """CSV本文（.gz は展開する）"""
+        chain, name = location
+        try:
+            if chain:
+                content = self.open_zip(chain).read(name)
+            else:
+                with open(name, 'rb') as f:
+                    content = f.read()
+        finally:
+            self._done(chain)
+        return gzip.decompress(content) if name.lower().endswith('.gz') else content
+
+    def _done(self, chain: tuple):
+        if self._remaining is None:
+            return
+        finished = []
+        with self._lock:
+            for depth in range(2, len(chain) + 1):
+                key = chain[:depth]
+                self._remaining[key] -= 1
+                if self._remaining[key] <= 0:
+                    finished.append(key)
+        # 内側から閉じる（外側のZIPを先に閉じると、内側の参照するファイルが無くなる）
+        for key in reversed(finished):
+            self._release(key)
+
+    def close(self):
+        """開いている全てのZIPを閉じ、一時ファイルを削除する"""
+        for chain in sorted(set(self._opened) | set(self._spilled), key=len, reverse=True):
+            self._release(chain)
+        if self._tmp_dir:
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
+            self._tmp_dir = None
+
+
+def import_bundles(paths: list, start_date: str = None, end_date: str = None, read_workers: int = DEFAULT_READ_WORKERS,
+                   parse_workers: int = None, commit_days: int = None, recheck: bool = False,
+                   drop_indexes: bool = False, archive: bool = False, publish: bool = True) -> dict:
+    """
+    バンドルのCSVをDBに取り込む
+
+    Args:
+        paths: ZIPファイル・ディレクトリのパス
+        read_workers: バンドルを読み出すスレッド数
+        parse_workers: CSVを変換するプロセス数（既定: CPU数 - 1）
+        commit_days: 何日分ごとにコミットするか（既定: BACKFILL_COMMIT_DAYS）
+        recheck: 取り込み済みのファイルも読み、内容が変わったものだけ取り込み直す
+        drop_indexes: 取り込み中は日次データのテーブルの二次インデックスを外し、終了時に作り直す
+        archive: 取り込んだCSVを生CSVアーカイブ (raw_archive) にも保存する
+        publish: 完了後にスナップショットを公開する
+
+    Returns:
+        {'files': 取り込んだファイル数, 'rows': 書き込み対象の行数, 'bytes': CSVサイズ合計, 'elapsed': 秒}
+    """
+    from src.core.snapshot import publish_snapshot
+
+    started = time.time()
+    reader = BundleReader()
+    try:
+        members = scan_bundles(paths, start_date, end_date, reader)
+    except BaseException:
+        reader.close()
+        raise
+    result = {'files': 0, 'rows': 0, 'bytes': 0, 'elapsed': 0.0}
+    if not members:
+        reader.close()
+        print("❌ バンドルに取り込めるCSVが見つかりません")
+        return result
+
+    commit_days = max(commit_days or BACKFILL_COMMIT_DAYS, 1)
+    if parse_workers is None:
+        parse_workers = max((os.cpu_count() or 1) - 1, 1)
+    dates = sorted(date_str for _, date_str in members)
+    print(f"=== バンドル取り込み: {dates[0]} ~ {dates[-1]} ({len(members)}ファイル, 読み込み {read_workers}スレッド, "
+          f"解析 {parse_workers}プロセス) ===")
+
+    lock = threading.Lock()
+    metrics = BatchMetrics('bundle', dates[0], dates[-1])
+    stores = {name: store for name, _, store in DATASETS}
+    order = {name: i for i, (name, _, _) in enumerate(DATASETS)}
+
+    def read(dataset, date_str, known_hash):
+        """読み込みスレッド: 本文を読み出し、ハッシュを取る（必要なら生CSVアーカイブにも保存する）"""
+        try:
+            content = reader.read(members[(dataset, date_str)])
+        except (OSError, zipfile.BadZipFile, EOFError) as e:
+            print(f"  -> エラー: {dataset_filename(dataset, date_str)}: {e}")
+            return STATUS_FAILED, None, {'error': str(e)}
+        meta = {'byte_size': len(content), 'content_hash': content_hash(content)}
+        with lock:
+            result['bytes'] += len(content)
+        if known_hash is not None and known_hash == meta['content_hash']:
+            return 'unchanged', None, meta
+        if archive:
+            filename = dataset_filename(dataset, date_str)
+            save_raw(archive_path(dataset, filename, date_str), content, url=f"bundle:{filename}")
+        return STATUS_DONE, content, meta
+
+    conn = get_connection()
+    try:
+        with IngestPipeline(read, parse_file, read_workers, parse_workers) as pipeline:
+            previous_pragmas = apply_bulk_pragmas(conn)
+            create_tables(conn)
+            migrate_daily_financials(conn)
+            restored = restore_secondary_indexes(conn)
+            if restored:
+                print(f"  -> インデックスを復元: {', '.join(restored)}")
+            dropped = drop_secondary_indexes(conn) if drop_indexes else []
+            if dropped:
+                print(f"  -> インデックスを一時的に削除: {', '.join(dropped)}")
+            stats_before = load_table_stats(conn)
+            manifest = load_manifest(conn, dates[0], dates[-1])
+
+            tasks, skipped = [], 0
+            for dataset, date_str in sorted(members, key=lambda k: (k[1], order[k[0]])):
+                entry = manifest.get((dataset, date_str))
+                known_hash = None
+                if entry and entry['status'] == STATUS_DONE:
+                    if not recheck:
+                        skipped += 1
+                        continue
+                    known_hash = entry['content_hash']
+                tasks.append((dataset, date_str, known_hash))
+            print(f"  -> 取り込み対象: {len(tasks)}ファイル (取り込み済み {skipped} をスキップ)")
+            # 読み終えた入れ子のZIPから順に閉じられるように、読む予定のメンバーを渡す
+            reader.expect(members[(dataset, date_str)] for dataset, date_str, _ in tasks)
+
+            results = {STATUS_DONE: 0, STATUS_FAILED: 0, 'unchanged': 0}
+            parse_times, write_counts = {}, {}
+            current_date, pending_days = None, 0
+            try:
+                for (name, date_str, _), future in pipeline.run(tasks):
+                    if date_str != current_date:
+                        pending_days += current_date is not None
+                        if pending_days >= commit_days:
+                            conn.commit()
+                            pending_days = 0
+                            elapsed = time.time() - started
+                            print(f"  [bundle] {current_date} まで確定: {result['rows']:,}行, {elapsed:.0f}秒 "
+                                  f"({result['rows'] / max(elapsed, 1e-9):,.0f}行/s)")
+                        current_date = date_str
+                        print(f"Importing: {date_str}")
+                    result['rows'] += _ingest_result(conn, name, date_str, stores[name], future, results,
+                                                     parse_times, write_counts, metrics)
+            except BaseException as e:
+                # 未確定の日付は破棄し（再実行で取り込み直す）、外したインデックスを戻す
+                conn.rollback()
+                if dropped:
+                    restore_secondary_indexes(conn)
+                metrics.save('interrupted' if isinstance(e, KeyboardInterrupt) else 'failed')
+                raise
+
+            if any(c['inserted'] or c['updated'] for c in write_counts.values()):
+                bump_version(conn, 'data_version')
+            conn.commit()
+            result['files'] = results[STATUS_DONE]
+            result['elapsed'] = time.time() - started
+
+            print(f"\n--- {pipeline.summary()} ---")
+            print(f"--- マニフェスト: 取込 {results[STATUS_DONE]} / 変化なし {results['unchanged']} / "
+                  f"失敗 {results[STATUS_FAILED]} / スキップ {skipped} ---")
+            for name, counts in write_counts.items():
+                print(f"--- 書き込み {name}: {format_counts(counts)} ---")
+            print(f"--- 読み込み: {result['bytes'] / 1024 / 1024:.1f}MB / 書き込み合計: {result['rows']:,}行, {result['elapsed']:.1f}秒 "
+                  f"({result['rows'] / max(result['elapsed'], 1e-9):,.0f}行/s) ---")
+            _finish_backfill(conn, dropped, previous_pragmas)
+
+            print("\n--- テーブル統計 ---")
+            for line in format_table_stats(refresh_table_stats(conn), stats_before):
+                print(f"  {line}")
+    finally:
+        conn.close()
+        reader.close()
+
+    if publish:
+        try:
+            publish_snapshot()
+        except Exception as e:
+            print(f"  -> エラー(スナップショット公開): {e}")
+    metrics.save()
+    print("\n=== ✅ バンドル取り込み完了 ===")
+    return result
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Import local ZIP/directory bundles of Kabu+ CSVs through the loader schemas and manifest')
+    parser.add_argument('bundles', nargs='+', help='ZIP files or directories (searched recursively, nested ZIPs included)')
+    parser.add_argument('--from', dest='start', help='First file date YYYYMMDD (default: all)')
+    parser.add_argument('--to', dest='end', help='Last file date YYYYMMDD (default: all)')
+    parser.add_argument('--read-workers', type=int, default=DEFAULT_READ_WORKERS,
+                        help=f'Threads reading bundle members (default: {DEFAULT_READ_WORKERS})')
+    parser.add_argument('--parse-workers', type=int, default=None, help='CSV parser processes (default: CPUs - 1)')
+    parser.add_argument('--commit-days', type=int, default=None,
+                        help=f'Commit every N file dates (default: {BACKFILL_COMMIT_DAYS})')
+    parser.add_argument('--recheck', action='store_true', help='Re-read imported files and re-import those whose content changed')
+    parser.add_argument('--drop-indexes', action='store_true',
+                        help='Drop secondary indexes on the data tables during the import and rebuild them at the end')
+    parser.add_argument('--archive', action='store_true', help='Also store each imported CSV in the raw archive')
+    parser.add_argument('--no-snapshot', action='store_true', help='Do not publish a read-only snapshot at the end')
+    args = parser.parse_args()
+
+    import_bundles(args.bundles, args.start, args.end, args.read_workers, args.parse_workers, args.commit_days,
+                   args.recheck, args.drop_indexes, args.archive, not args.no_snapshot)
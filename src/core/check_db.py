@@ -6,6 +6,7 @@ import sys
 # srcモジュールをインポートできるようにパスを追加
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 from src.core.db_manager import get_connection
+from src.core.table_stats import load_table_stats, format_table_stats
 
 def check_db():
     conn = get_connection()
@@ -73,21 +74,10 @@ def check_db():
     except Exception as e:
         print(f"  -> エラー（業種別指数）: {e}")
 
-    # 5. データ件数概算
-    print("\n[5] データ件数概算")
-    tables = {
-        "日足株価": "daily_prices",
-        "財務指標": "daily_financials",
-        "企業マスタ": "companies",
-        "信用残": "weekly_margin",
-        "業種別指数": "daily_indices"
-    }
-    for name, table in tables.items():
-        try:
-            count = pd.read_sql_query(f"SELECT COUNT(*) FROM {table}", conn).iloc[0, 0]
-            print(f"  - {name}: {count} レコード")
-        except Exception:
-            print(f"  - {name}: テーブルが存在しないかエラー")
+    # 5. データ件数（バッチが記録した table_stats を参照し、全件走査はしない）
+    print("\n[5] データ件数 (table_stats)")
+    for line in format_table_stats(load_table_stats(conn)):
+        print(f"  - {line}")
     
     conn.close()
 
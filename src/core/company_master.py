@@ -0,0 +1,101 @@
+"""
+インメモリ企業マスタ
+
+companies テーブル（約3,800行・更新は1日1回程度）をプロセスごとに1度だけ読み込み、
+不変のスナップショットとして全モジュールに提供する。
+バッチが企業マスタを変更すると db_metadata の companies_version が進むので、
+一定間隔でその値だけを確認し、変わっていれば新しいスナップショットに丸ごと差し替える。
+"""
+import threading
+import time
+from types import MappingProxyType
+
+from src.core.db_manager import get_read_connection, get_metadata
+
+# companies_version を確認する間隔（秒）
+VERSION_CHECK_INTERVAL = 60
+
+
+class CompanyMaster:
+    """
+    企業マスタの不変スナップショット
+
+    Attributes:
+        version: 読み込み時点の companies_version
+        companies: {code: {'code', 'name', 'market', 'industry'}}
+        by_market: {market: (code, ...)}
+        by_industry: {industry: (code, ...)}
+    """
+
+    def __init__(self, rows, version=None):
+        companies = {}
+        by_market = {}
+        by_industry = {}
+        for code, name, market, industry in rows:
+            companies[code] = MappingProxyType({'code': code, 'name': name, 'market': market, 'industry': industry})
+            by_market.setdefault(market, []).append(code)
+            by_industry.setdefault(industry, []).append(code)
+
+        self.version = version
+        self.companies = MappingProxyType(companies)
+        self.by_market = MappingProxyType({k: tuple(sorted(v)) for k, v in by_market.items()})
+        self.by_industry = MappingProxyType({k: tuple(sorted(v)) for k, v in by_industry.items()})
+
+    def __len__(self):
+        return len(self.companies)
+
+    def __contains__(self, code):
+        return code in self.companies
+
+    def get(self, code: str) -> dict:
+        """企業情報の辞書を返す（見つからなければ None）"""
+        info = self.companies.get(str(code))
+        return dict(info) if info else None
+
+    def industry_codes(self, industry: str) -> tuple:
+        """業種の構成銘柄コード一覧"""
+        return self.by_industry.get(industry, ())
+
+    def market_codes(self, market_filter: str) -> tuple:
+        """市場区分名に market_filter を含む銘柄コード一覧 (例: '東証PR')"""
+        codes = []
+        for market, market_codes in self.by_market.items():
+            if market and market_filter in market:
+                codes.extend(market_codes)
+        return tuple(sorted(codes))
+
+
+_master = None
+_last_checked = 0.0
+_lock = threading.Lock()
+
+
+def _load(conn, version) -> CompanyMaster:
+    rows = conn.execute("SELECT code, name, market, industry FROM companies").fetchall()
+    return CompanyMaster(rows, version)
+
+
+def get_company_master(force_reload: bool = False) -> CompanyMaster:
+    """
+    プロセス共通の企業マスタを返す
+
+    初回呼び出し時に読み込み、以降は VERSION_CHECK_INTERVAL ごとに
+    companies_version を確認して、変化があった場合のみ再読み込みする。
+    参照の差し替えは1回の代入で行うため、読み手は常に整合したスナップショットを見る。
+    """
+    global _master, _last_checked
+
+    master = _master
+    if master is not None and not force_reload and time.time() - _last_checked < VERSION_CHECK_INTERVAL:
+        return master
+
+    with _lock:
+        if _master is not None and not force_reload and time.time() - _last_checked < VERSION_CHECK_INTERVAL:
+            return _master
+
+        with get_read_connection() as conn:
+            version = get_metadata(conn, 'companies_version')
+            if force_reload or _master is None or _master.version != version:
+                _master = _load(conn, version)
+        _last_checked = time.time()
+        return _master
@@ -0,0 +1,221 @@
+"""
+株・プラスCSVのスキーマ定義とストリーミング解析
+
+データセットごとに、CSVヘッダーとDBカラムの対応・型・必須カラム・ヘッダーの照合方法を宣言し、
+parse_csv() が共通の手順で DataFrame（DBカラム名・宣言した型）に変換する。
+
+    - cp932 をストリームのまま少しずつデコードし、CHUNK_ROWS 行ずつ読み込む
+      （レスポンス全体のデコード済み文字列や、全カラムの object 型 DataFrame を作らない）
+    - 読み込むのは対応表にあるカラムだけで、数値カラムは float64 として解析する
+    - 銘柄コードは文字列として読み、前後の空白を除く（'1301' と 1301.0 の揺れを作らない）
+
+ヘッダーの照合方法:
+    name:           ヘッダー名で対応付ける（別名 aliases も可）
+    name_or_order:  必須カラムの名前が揃っていれば名前で、揃っていなければ既定の並び (order) とみなす
+    order:          カラム数が既定の並びと一致すれば、名前によらず並びで対応付ける
+"""
+import io
+import csv
+
+import numpy as np
+import pandas as pd
+
+ENCODING = 'cp932'
+
+# 1回に解析する行数（全銘柄 約3,800行のファイルを2回に分けて読む）
+CHUNK_ROWS = 2000
+
+# 欠損とみなす値
+NA_VALUES = ['', '-', '－', '—']
+
+
+class CsvSchema:
+    """1データセット分のCSVスキーマ"""
+
+    def __init__(self, name: str, columns: dict, numeric: list, required: list,
+                 header: str = 'name', order: list = None, aliases: dict = None):
+        """
+        Args:
+            name: データセット名
+            columns: {CSVヘッダー名: DBカラム名}
+            numeric: float64 として読むDBカラム（それ以外は文字列）
+            required: 必須のCSVヘッダー名
+            header: ヘッダーの照合方法 (name / name_or_order / order)
+            order: 既定のカラムの並び（CSVヘッダー名のリスト）
+            aliases: {別名: CSVヘッダー名}（年によって表記が揺れるカラム用）
+        """
+        self.name = name
+        self.columns = columns
+        self.numeric = set(numeric)
+        self.required = required
+        self.header = header
+        self.order = order or []
+        self.aliases = aliases or {}
+
+    @property
+    def db_columns(self) -> list:
+        return list(dict.fromkeys(self.columns.values()))
+
+
+def _normalize(name: str) -> str:
+    """ヘッダー名の空白（全角を含む）の揺れを無視する"""
+    return str(name).strip().replace(' ', '').replace('　', '')
+
+
+def resolve_header(header: list, schema: CsvSchema) -> dict:
+    """
+    CSVのヘッダー行から、読み込むカラムの位置と DBカラム名の対応を決める
+
+    Returns:
+        {カラム位置: DBカラム名}
+
+    Raises:
+        KeyError: 必須カラムが無い、またはカラム数が既定の並びと一致しない
+    """
+    normalized = [_normalize(h) for h in header]
+    order = [_normalize(h) for h in schema.order]
+    required = [_normalize(h) for h in schema.required]
+
+    by_name = schema.header == 'name' or (
+        schema.header == 'name_or_order' and all(r in normalized for r in required))
+    if schema.header == 'order' or not by_name:
+        if len(header) != len(order):
+            raise KeyError(f"カラム数不一致: CSV({len(header)}) vs 期待値({len(order)})")
+        names = order
+    else:
+        aliases = {_normalize(k): _normalize(v) for k, v in schema.aliases.items()}
+        names = [aliases.get(n, n) for n in normalized]
+        missing = [r for r in schema.required if _normalize(r) not in names]
+        if missing:
+            raise KeyError(f"CSVに必須カラムが見つかりません: {missing} (CSVカラム: {header})")
+
+    columns = {_normalize(k): v for k, v in schema.columns.items()}
+    positions = {}
+    for i, name in enumerate(names):
+        db_name = columns.get(name)
+        if db_name is not None and db_name not in positions.values():
+            positions[i] = db_name
+    return positions
+
+
+def parse_csv(source, schema: CsvSchema, chunk_rows: int = CHUNK_ROWS) -> pd.DataFrame:
+    """
+    CSV（cp932 のバイナリストリーム）をスキーマに従って DataFrame に変換する
+
+    Args:
+        source: バイナリのファイルライクオブジェクト (io.BytesIO, gzip.open(...) など)
+
+    Returns:
+        スキーマの DBカラムを全て持つ DataFrame（CSVに無いカラムは欠損値）
+    """
+    stream = io.TextIOWrapper(source, encoding=ENCODING, newline='')
+    header = next(csv.reader([stream.readline()]), [])
+    positions = resolve_header(header, schema)
+
+    usecols = sorted(positions)
+    dtype = {i: (np.float64 if positions[i] in schema.numeric else str) for i in usecols}
+    reader = pd.read_csv(stream, header=None, usecols=usecols, dtype=dtype, na_values=NA_VALUES,
+                         keep_default_na=False, chunksize=chunk_rows)
+
+    chunks = []
+    for chunk in reader:
+        chunk = chunk.rename(columns=positions)
+        if 'code' in chunk.columns:
+            chunk['code'] = chunk['code'].astype(str).str.strip()
+        chunks.append(chunk)
+
+    if chunks:
+        df = pd.concat(chunks, ignore_index=True)
+    else:
+        df = pd.DataFrame({positions[i]: pd.Series(dtype=dtype[i]) for i in usecols})
+    for col in schema.db_columns:
+        if col not in df.columns:
+            df[col] = np.nan if col in schema.numeric else None
+    return df[schema.db_columns]
+
+
+# --- データセットごとのスキーマ ---
+
+PRICES_SCHEMA = CsvSchema(
+    'prices',
+    columns={
+        'SC': 'code',
+        '名称': 'name',
+        '市場': 'market',
+        '業種': 'industry',
+        '日付': 'date',
+        '始値': 'open',
+        '高値': 'high',
+        '安値': 'low',
+        '株価': 'close',
+        '出来高': 'volume',
+        '売買代金（千円）': 'trading_value',
+        '時価総額（百万円）': 'market_cap_total',
+    },
+    numeric=['open', 'high', 'low', 'close', 'volume', 'trading_value', 'market_cap_total'],
+    required=['SC', '名称', '日付', '株価'],
+)
+
+FINANCIALS_SCHEMA = CsvSchema(
+    'financials',
+    columns={
+        'SC': 'code',
+        '時価総額（百万円）': 'market_cap',
+        '発行済株式数': 'shares_outstanding',
+        'PER（予想）': 'per_forecast',
+        'PBR（実績）': 'pbr_actual',
+        'EPS（予想）': 'eps_forecast',
+        'BPS（実績）': 'bps_actual',
+        '配当利回り（予想）': 'dividend_yield',
+        '最低投資金額': 'min_investment',
+    },
+    numeric=['market_cap', 'shares_outstanding', 'per_forecast', 'pbr_actual',
+             'eps_forecast', 'bps_actual', 'dividend_yield', 'min_investment'],
+    required=['SC', 'PER（予想）', 'PBR（実績）'],
+    # 時価総額のカラム名が揺れる可能性に対応
+    aliases={'時価総額（全銘柄）': '時価総額（百万円）'},
+)
+
+MARGIN_SCHEMA = CsvSchema(
+    'margin',
+    columns={
+        'SC': 'code',
+        '信用売残': 'sell_balance_total',
+        '信用買残': 'buy_balance_total',
+        '貸借倍率': 'ratio',
+        '制度信用売残': 'sell_balance_ins',
+        '制度信用買残': 'buy_balance_ins',
+        '一般信用売残': 'sell_balance_gen',
+        '一般信用買残': 'buy_balance_gen',
+    },
+    numeric=['sell_balance_total', 'buy_balance_total', 'ratio', 'sell_balance_ins',
+             'buy_balance_ins', 'sell_balance_gen', 'buy_balance_gen'],
+    required=['SC', '信用売残', '信用買残'],
+    # ヘッダーに売残・買残の名前があればそれに従い、無ければ既定の並びとみなす
+    header='name_or_order',
+    order=["SC", "公表日", "信用取引区分", "信用売残", "信用売残 前週比", "信用買残", "信用買残 前週比", "貸借倍率",
+           "制度信用売残", "制度信用売残 前週比", "制度信用買残", "制度信用買残 前週比",
+           "一般信用売残", "一般信用売残 前週比", "一般信用買残", "一般信用買残 前週比"],
+)
+
+INDICES_SCHEMA = CsvSchema(
+    'indices',
+    columns={
+        'SC': 'code',
+        '指数名': 'name',
+        '日付': 'date',
+        '終値': 'close',
+        '前日比（％）': 'change_ratio',
+        '時価総額（指数用・浮動株ベース）': 'market_cap_index',
+        '売買単位換算後株式数': 'volume',
+        '銘柄数': '銘柄数',
+    },
+    numeric=['close', 'change_ratio', 'market_cap_index', 'volume', '銘柄数'],
+    required=['SC', '指数名', '日付', '終値'],
+    # ヘッダーの括弧の有無などが揺れるため、カラムの並びで対応付ける
+    header='order',
+    order=["SC", "指数名", "日付", "終値", "前日比", "前日比（％）", "前日終値", "時価総額（指数用・浮動株ベース）",
+           "時価総額前日比（同左）", "前日時価総額（同左）", "平均時価総額（同左）", "基準時価総額", "銘柄数", "売買単位換算後株式数"],
+)
+
+SCHEMAS = {schema.name: schema for schema in (PRICES_SCHEMA, FINANCIALS_SCHEMA, MARGIN_SCHEMA, INDICES_SCHEMA)}
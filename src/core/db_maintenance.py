@@ -0,0 +1,223 @@
+"""
+データベースの定期メンテナンス
+
+run_daily_batch の INSERT OR REPLACE が積み重なると、空きページの断片化が進み、
+クエリプランナの統計情報も古くなる。バッチ後に以下を実行する。
+    1. PRAGMA optimize / ANALYZE   (統計情報の更新)
+    2. PRAGMA incremental_vacuum   (時間予算内で空きページを解放)
+    3. PRAGMA wal_checkpoint       (WALの書き戻しと切り詰め)
+    4. PRAGMA quick_check          (整合性チェック)
+
+--incremental を付けると、ANALYZE の走査量を制限し、少量ずつ VACUUM しながら間に休止を挟み、
+チェックポイントも PASSIVE で書き戻してから短い待ち時間で TRUNCATE を試すため、実行中もBotの応答を妨げない。
+
+旧形式の daily_financials テーブルの移行は --migrate-financials で明示的に行う（他の処理は行わない）。
+
+Usage:
+    PYTHONPATH=. python src/core/db_maintenance.py [--incremental] [--budget 60] [--enable-auto-vacuum]
+    PYTHONPATH=. python src/core/db_maintenance.py --migrate-financials
+"""
+import os
+import sys
+import time
+import sqlite3
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from src.core.db_manager import DB_PATH, get_connection
+
+# incremental_vacuum 1回あたりに解放するページ数
+VACUUM_STEP_PAGES = 2000
+# incremental モードで各ステップの間に挟む休止（秒）
+INCREMENTAL_PAUSE = 0.2
+# incremental モードの ANALYZE で1インデックスあたりに走査する行数の上限
+INCREMENTAL_ANALYSIS_LIMIT = 1000
+# incremental モードで PASSIVE の後に TRUNCATE を試すときの待ち時間（ミリ秒）
+INCREMENTAL_TRUNCATE_TIMEOUT_MS = 1000
+
+
+def db_status(conn: sqlite3.Connection) -> dict:
+    """DBファイルサイズ・WALサイズ・ページ情報を取得する"""
+    wal_path = DB_PATH + '-wal'
+    return {
+        'file_size': os.path.getsize(DB_PATH) if os.path.exists(DB_PATH) else 0,
+        'wal_size': os.path.getsize(wal_path) if os.path.exists(wal_path) else 0,
+        'page_size': conn.execute("PRAGMA page_size").fetchone()[0],
+        'page_count': conn.execute("PRAGMA page_count").fetchone()[0],
+        'freelist_count': conn.execute("PRAGMA freelist_count").fetchone()[0],
+        'journal_mode': conn.execute("PRAGMA journal_mode").fetchone()[0],
+        'auto_vacuum': conn.execute("PRAGMA auto_vacuum").fetchone()[0],
+    }
+
+
+def _fmt_size(size: int) -> str:
+    return f"{size / 1024 / 1024:.1f}MB"
+
+
+def run_analyze(conn: sqlite3.Connection, incremental: bool):
+    """統計情報を更新する（incremental では走査行数を制限した PRAGMA optimize のみ）"""
+    if incremental:
+        conn.execute(f"PRAGMA analysis_limit = {INCREMENTAL_ANALYSIS_LIMIT}")
+        conn.execute("PRAGMA optimize")
+    else:
+        conn.execute("ANALYZE")
+        conn.execute("PRAGMA optimize")
+    conn.commit()
+
+
+def run_incremental_vacuum(conn: sqlite3.Connection, budget: float, incremental: bool) -> int:
+    """
+    時間予算内で空きページを解放する
+
+    auto_vacuum=INCREMENTAL のDBでのみ有効（新規DBは create_tables で設定される）。少量ずつコミットするため、ステップ間で他の接続が書き込める。
+
+    Returns:
+        解放したページ数
+    """
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        print("  -> スキップ: auto_vacuum が INCREMENTAL ではありません (--enable-auto-vacuum で切り替え)")
+        return 0
+
+    started = time.time()
+    freed = 0
+    while time.time() - started < budget:
+        before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if before == 0:
+            break
+        conn.execute(f"PRAGMA incremental_vacuum({VACUUM_STEP_PAGES})").fetchall()
+        conn.commit()
+        step_freed = before - conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if step_freed <= 0:
+            break
+        freed += step_freed
+        if incremental:
+            time.sleep(INCREMENTAL_PAUSE)
+    return freed
+
+
+def enable_auto_vacuum(conn: sqlite3.Connection):
+    """auto_vacuum を INCREMENTAL に切り替える（既存DBでは1回だけ全体の VACUUM が必要）"""
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+
+
+def run_checkpoint(conn: sqlite3.Connection, incremental: bool):
+    """
+    WALを書き戻して切り詰める
+
+    incremental では読み手を待たない PASSIVE で書き戻してから、短い待ち時間で TRUNCATE を試す。
+    PASSIVE だけでは WAL ファイルが切り詰められず、バッチごとに肥大化したまま残るため。
+    読み手が居続けて TRUNCATE できなかった場合は busy=1 を返す（次回のメンテナンスで再試行される）。
+    """
+    if not incremental:
+        busy, log_frames, checkpointed = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+        return {'mode': 'TRUNCATE', 'busy': busy, 'log_frames': log_frames, 'checkpointed': checkpointed}
+
+    busy, log_frames, checkpointed = conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+    previous_timeout = conn.execute("PRAGMA busy_timeout").fetchone()[0]
+    conn.execute(f"PRAGMA busy_timeout = {INCREMENTAL_TRUNCATE_TIMEOUT_MS}")
+    try:
+        truncate = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+    finally:
+        conn.execute(f"PRAGMA busy_timeout = {previous_timeout}")
+    if not truncate[0]:
+        busy, log_frames, checkpointed = truncate
+    return {'mode': 'PASSIVE+TRUNCATE', 'busy': busy, 'log_frames': log_frames, 'checkpointed': checkpointed}
+
+
+def run_quick_check(conn: sqlite3.Connection) -> list:
+    """quick_check の結果（正常なら ['ok']）"""
+    return [row[0] for row in conn.execute("PRAGMA quick_check").fetchall()]
+
+
+def run_maintenance(incremental: bool = False, budget: float = 60.0, convert_auto_vacuum: bool = False) -> dict:
+    """
+    メンテナンス一式を実行し、結果を表示する
+
+    Args:
+        incremental: Botの稼働中でも実行できる軽量モード
+        budget: incremental_vacuum に使う時間予算（秒）
+        convert_auto_vacuum: auto_vacuum を INCREMENTAL に切り替える（全体 VACUUM を伴う）
+
+    Returns:
+        実行結果の辞書 (before, after, steps, quick_check)
+    """
+    conn = get_connection()
+    conn.execute("PRAGMA busy_timeout = 5000")
+    try:
+        before = db_status(conn)
+        print(f"=== DBメンテナンス開始 ({'incremental' if incremental else 'full'}) ===")
+        print(f"  ファイル: {_fmt_size(before['file_size'])}, WAL: {_fmt_size(before['wal_size'])}, "
+              f"空きページ: {before['freelist_count']}/{before['page_count']}")
+
+        steps = {}
+        started = time.time()
+
+        if convert_auto_vacuum and before['auto_vacuum'] != 2:
+            t = time.time()
+            enable_auto_vacuum(conn)
+            steps['enable_auto_vacuum'] = time.time() - t
+            print(f"  -> auto_vacuum=INCREMENTAL に切り替え ({steps['enable_auto_vacuum']:.1f}秒)")
+
+        t = time.time()
+        run_analyze(conn, incremental)
+        steps['analyze'] = time.time() - t
+        print(f"  -> ANALYZE/optimize ({steps['analyze']:.1f}秒)")
+
+        t = time.time()
+        freed = run_incremental_vacuum(conn, budget, incremental)
+        steps['incremental_vacuum'] = time.time() - t
+        print(f"  -> incremental_vacuum: {freed}ページ解放 ({steps['incremental_vacuum']:.1f}秒)")
+
+        t = time.time()
+        if before['journal_mode'] == 'wal':
+            checkpoint = run_checkpoint(conn, incremental)
+            print(f"  -> wal_checkpoint({checkpoint['mode']}): {checkpoint['checkpointed']}/{checkpoint['log_frames']}フレーム"
+                  + (" (読み手がいるため切り詰めは次回に持ち越し)" if checkpoint['busy'] else ""))
+        else:
+            print(f"  -> スキップ: wal_checkpoint (journal_mode={before['journal_mode']})")
+        steps['checkpoint'] = time.time() - t
+
+        t = time.time()
+        quick_check = run_quick_check(conn)
+        steps['quick_check'] = time.time() - t
+        status_icon = "✅" if quick_check == ['ok'] else "❌"
+        print(f"  -> quick_check: {status_icon} {', '.join(quick_check[:5])} ({steps['quick_check']:.1f}秒)")
+
+        after = db_status(conn)
+        steps['total'] = time.time() - started
+        print(f"  ファイル: {_fmt_size(before['file_size'])} → {_fmt_size(after['file_size'])}, "
+              f"WAL: {_fmt_size(before['wal_size'])} → {_fmt_size(after['wal_size'])}, "
+              f"空きページ: {before['freelist_count']} → {after['freelist_count']}")
+        print(f"=== メンテナンス完了 ({steps['total']:.1f}秒) ===")
+
+        return {'before': before, 'after': after, 'steps': steps, 'quick_check': quick_check}
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Database maintenance (ANALYZE, incremental VACUUM, WAL checkpoint, quick_check)')
+    parser.add_argument('--incremental', action='store_true', help='Lightweight mode that keeps the bot responsive')
+    parser.add_argument('--budget', type=float, default=60.0, help='Time budget for incremental vacuum in seconds (default: 60)')
+    parser.add_argument('--enable-auto-vacuum', action='store_true',
+                        help='Switch auto_vacuum to INCREMENTAL (runs a one-time full VACUUM)')
+    parser.add_argument('--migrate-financials', action='store_true',
+                        help='Convert the legacy daily_financials table to financial_versions '
+                             '(the old table is kept as daily_financials_legacy)')
+    args = parser.parse_args()
+
+    if args.migrate_financials:
+        from src.core.financial_versions import migrate_daily_financials
+
+        conn = get_connection()
+        try:
+            if migrate_daily_financials(conn) is None:
+                print("  -> 旧形式の daily_financials テーブルはありません。")
+        finally:
+            conn.close()
+        sys.exit(0)
+
+    result = run_maintenance(args.incremental, args.budget, args.enable_auto_vacuum)
+    sys.exit(0 if result['quick_check'] == ['ok'] else 1)
@@ -1,17 +1,117 @@
 import sqlite3
 import os
-from datetime import datetime
+import sys
+import threading
+from pathlib import Path
+from datetime import datetime, timedelta
 
-DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data', 'stock_data.db')
+# スクリプトとして直接実行された場合も src パッケージを解決できるようにする
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from src.core.financial_versions import create_financial_schema
+from src.core.query_cache import cached_query
+
+# STOCK_DB_PATH で別のDBファイルを使える（分割バックフィルのシャードDBなど）
+DB_PATH = os.getenv('STOCK_DB_PATH') or os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data', 'stock_data.db')
+
+# バッチ完了ごとに公開される読み取り専用スナップショット（current は最新版へのシンボリックリンク）
+SNAPSHOT_DIR = os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), 'snapshots')
+SNAPSHOT_LINK = os.path.join(SNAPSHOT_DIR, 'current')
+
+def _connection_factory():
+    """STOCK_DB_PROFILE が設定されていればプロファイラ付きの接続クラスを返す"""
+    if os.getenv('STOCK_DB_PROFILE'):
+        from src.core.query_profiler import ProfilingConnection
+        return ProfilingConnection
+    return sqlite3.Connection
+
+# DBスレッドプールのワーカーごとに保持する再利用接続
+_thread_local = threading.local()
+
+def bind_thread_connection():
+    """
+    現在のスレッドに再利用可能な接続を割り当てる（DBスレッドプールの initializer 用）
+
+    割り当て後、このスレッドでの get_connection() は毎回同じ接続を返す。
+    """
+    _thread_local.conn = sqlite3.connect(DB_PATH, factory=_connection_factory())
 
 def get_connection():
     """SQLite接続オブジェクトを返す"""
-    return sqlite3.connect(DB_PATH)
+    conn = getattr(_thread_local, 'conn', None)
+    if conn is not None:
+        return conn
+    return sqlite3.connect(DB_PATH, factory=_connection_factory())
+
+def get_snapshot_path():
+    """公開中のスナップショットの実ファイルパス（未公開なら None）"""
+    if not os.path.exists(SNAPSHOT_LINK):
+        return None
+    return os.path.realpath(SNAPSHOT_LINK)
+
+def _open_snapshot(path: str):
+    # スナップショットは公開後に変更されないため immutable で開く（ロック・WAL確認が不要）
+    uri = Path(path).as_uri() + "?mode=ro&immutable=1"
+    return sqlite3.connect(uri, uri=True, factory=_connection_factory())
+
+def bind_thread_snapshot(path: str = None) -> str:
+    """
+    現在のスレッドの読み取り接続を、指定した（省略時は最新の）スナップショットに切り替える
+
+    ジョブの合間に呼び出す。同じスナップショットのままなら接続を再利用する。
+    指定したスナップショットが既に削除されている場合は最新版を使う。
+
+    Returns:
+        割り当てたスナップショットのパス（未公開なら None = 本体DBを直接読む）
+    """
+    if path is None or not os.path.exists(path):
+        path = get_snapshot_path()
+    if getattr(_thread_local, 'snapshot_path', None) == path and getattr(_thread_local, 'read_conn', None) is not None:
+        return path
+
+    old = getattr(_thread_local, 'read_conn', None)
+    _thread_local.read_conn = _open_snapshot(path) if path else None
+    _thread_local.snapshot_path = path
+    if old is not None:
+        old.close()
+    return path
+
+def get_read_connection():
+    """
+    読み取り用のSQLite接続を返す（Bot・分析向け）
+
+    公開済みのスナップショットがあればそれを読み、バッチ書き込み中の本体DBは参照しない。
+    bind_thread_snapshot() 済みのスレッドでは、そのスナップショットの接続を返す。
+    """
+    conn = getattr(_thread_local, 'read_conn', None)
+    if conn is not None:
+        return conn
+    path = get_snapshot_path()
+    if path is None:
+        return get_connection()
+    return _open_snapshot(path)
+
+def get_readonly_connection(db_path: str = None):
+    """
+    読み取り専用のSQLite接続を返す（エクスポート・分析用途向け）
+
+    Args:
+        db_path: 対象DBファイル（デフォルト: DB_PATH）
+    """
+    uri = Path(os.path.abspath(db_path or DB_PATH)).as_uri() + "?mode=ro"
+    return sqlite3.connect(uri, uri=True, factory=_connection_factory())
 
 def create_tables(conn: sqlite3.Connection):
     """データベーステーブルを定義し、作成する"""
     cursor = conn.cursor()
 
+    # 空きページを db_maintenance の incremental_vacuum で少しずつ解放できるようにする
+    # WAL への切り替えでヘッダが書かれた空のDBにも反映させるため VACUUM する（テーブルが無いので一瞬で終わる）
+    # 既存DBは db_maintenance.py --enable-auto-vacuum で切り替える
+    is_empty = cursor.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone() is None
+    if is_empty and not conn.in_transaction and cursor.execute("PRAGMA auto_vacuum").fetchone()[0] == 0:
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        cursor.execute("VACUUM")
+
     # 1. 銘柄マスタ (companies):
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS companies (
@@ -38,22 +138,9 @@ def create_tables(conn: sqlite3.Connection):
         );
     """)
 
-    # 3. 日足財務指標 (daily_financials): 拡張カラムを追加
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS daily_financials (
-            code TEXT,
-            date TEXT,
-            market_cap REAL,
-            shares_outstanding REAL,
-            per_forecast REAL,
-            pbr_actual REAL,
-            eps_forecast REAL,
-            bps_actual REAL,
-            dividend_yield REAL,
-            min_investment REAL,
-            PRIMARY KEY (code, date)
-        );
-    """)
+    # 3. 日足財務指標 (daily_financials):
+    # 基礎値の変更履歴 (financial_versions) と、株価から指標を再計算する互換ビュー
+    create_financial_schema(conn)
 
     # 4. 週次信用残 (weekly_margin):
     cursor.execute("""
@@ -97,9 +184,164 @@ def create_tables(conn: sqlite3.Connection):
             success INTEGER DEFAULT 1
         );
     """)
+    # 新しい順の一覧・ユーザー別・銘柄別の絞り込みをインデックスで引く（id はキーセットページングの同順位解消用）
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_analysis_history_at ON analysis_history (analyzed_at, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_analysis_history_user ON analysis_history (user_name, analyzed_at, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_analysis_history_code ON analysis_history (stock_code, analyzed_at, id)")
+
+    # 7-2. 分析履歴の日次集計 (analysis_daily_stats): 保持期間を過ぎた生の履歴はここに集約して削除する
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS analysis_daily_stats (
+            day TEXT,                   -- YYYY-MM-DD
+            stock_code TEXT,
+            user_name TEXT,             -- 不明なユーザーは空文字
+            requests INTEGER,
+            successes INTEGER,
+            PRIMARY KEY (day, stock_code, user_name)
+        );
+    """)
+
+    # 8. メタデータ (db_metadata): データ版数などのキー・バリュー
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS db_metadata (
+            key TEXT PRIMARY KEY,
+            value TEXT,
+            updated_at TEXT
+        );
+    """)
+
+    # 9. テーブル統計 (table_stats): 行数・日付範囲をバッチ時に記録し、状態確認で全件走査しない
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS table_stats (
+            table_name TEXT PRIMARY KEY,
+            row_count INTEGER,
+            min_date TEXT,
+            max_date TEXT,
+            last_ingested_date TEXT,    -- ローダが最後に取り込んだデータ日付
+            updated_at TEXT
+        );
+    """)
+
+    # 10. 取り込みマニフェスト (ingest_manifest): ファイル単位の取り込み状況（再開・取り込み済みのスキップ用）
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS ingest_manifest (
+            dataset TEXT,               -- prices / financials / margin / indices
+            file_date TEXT,             -- ファイル名の日付 (YYYYMMDD)
+            status TEXT,                -- done / not_found / failed
+            row_count INTEGER,
+            byte_size INTEGER,
+            content_hash TEXT,          -- CSV本文の SHA-256
+            attempts INTEGER DEFAULT 0,
+            error TEXT,
+            parse_ms REAL,              -- CSVの解析にかかった時間
+            first_seen_at TEXT,
+            loaded_at TEXT,             -- 最後に status = done になった日時
+            updated_at TEXT,
+            PRIMARY KEY (dataset, file_date)
+        );
+    """)
+    # 11. バッチの計測記録 (batch_runs / batch_file_metrics): 実行ごと・ファイルごとの所要時間と行数 (batch_metrics)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS batch_runs (
+            run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            started_at TEXT,
+            finished_at TEXT,
+            mode TEXT,                  -- daily / backfill / bundle
+            status TEXT,                -- ok / failed / interrupted
+            start_date TEXT,
+            end_date TEXT,
+            db_path TEXT,
+            files INTEGER,              -- 取り込んだファイル数
+            failed INTEGER,
+            download_bytes INTEGER,
+            requests INTEGER,
+            retries INTEGER,            -- 429 と 5xx の再試行
+            download_s REAL,            -- 応答待ちの合計（並行分を含む）
+            parse_s REAL,
+            write_s REAL,
+            wall_s REAL,                -- 実行全体の所要時間
+            rows_inserted INTEGER,
+            rows_updated INTEGER,
+            rows_unchanged INTEGER,
+            peak_rss_mb REAL,
+            peak_child_rss_mb REAL      -- 解析プロセスの最大
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS batch_file_metrics (
+            run_id INTEGER,
+            dataset TEXT,
+            file_date TEXT,
+            status TEXT,                -- done / not_found / failed / unchanged
+            bytes INTEGER,              -- CSV本文のサイズ
+            download_bytes INTEGER,     -- 受信したサイズ（304 では 0）
+            download_ms REAL,
+            requests INTEGER,
+            retries INTEGER,
+            parse_ms REAL,
+            write_ms REAL,
+            rows_inserted INTEGER,
+            rows_updated INTEGER,
+            rows_unchanged INTEGER,
+            PRIMARY KEY (run_id, dataset, file_date)
+        );
+    """)
+
+    manifest_columns = {row[1] for row in cursor.execute("PRAGMA table_info(ingest_manifest)")}
+    if 'parse_ms' not in manifest_columns:
+        cursor.execute("ALTER TABLE ingest_manifest ADD COLUMN parse_ms REAL")
     conn.commit()
     print("✅ Tables created/verified successfully.")
 
+def get_metadata(conn: sqlite3.Connection, key: str, default: str = None):
+    """
+    db_metadata の値を取得する（テーブル未作成の旧DBでは default を返す）
+    """
+    try:
+        row = conn.execute("SELECT value FROM db_metadata WHERE key = ?", (key,)).fetchone()
+    except sqlite3.OperationalError:
+        return default
+    return row[0] if row else default
+
+def set_metadata(conn: sqlite3.Connection, key: str, value):
+    """db_metadata に値を書き込む（コミットは呼び出し側で行う）"""
+    conn.execute("""
+        INSERT OR REPLACE INTO db_metadata (key, value, updated_at)
+        VALUES (?, ?, ?)
+    """, (key, str(value), datetime.now().isoformat()))
+
+def bump_version(conn: sqlite3.Connection, key: str) -> int:
+    """
+    db_metadata 上のバージョンカウンタを1つ進める
+
+    Returns:
+        新しいバージョン番号
+    """
+    version = int(get_metadata(conn, key, 0)) + 1
+    set_metadata(conn, key, version)
+    return version
+
+def upsert_companies(conn: sqlite3.Connection, companies) -> dict:
+    """
+    企業マスタを更新する（変更のあった銘柄のみ書き込む）
+
+    ステージングテーブル経由で既存の値と突き合わせ (bulk_writer)、新規・変更のあった銘柄だけを書き込む。
+    何か変更があった場合は companies_version を進め、
+    各プロセスのインメモリ企業マスタ (company_master) に再読み込みを促す。
+
+    Args:
+        companies: code, name, market, industry カラムを持つ DataFrame（code は重複なし）
+
+    Returns:
+        {'inserted': 新規銘柄数, 'updated': 変更のあった銘柄数, 'unchanged': 変化なしの銘柄数}
+    """
+    from src.core.bulk_writer import bulk_upsert
+
+    counts = bulk_upsert(conn, 'companies', companies, ['code', 'name', 'market', 'industry'])
+    if counts['inserted'] or counts['updated']:
+        bump_version(conn, 'companies_version')
+    return counts
+
 def log_analysis_history(code: str, company_name: str = None, user_name: str = None, success: bool = True):
     """
     分析履歴を記録する
@@ -118,24 +360,82 @@ def log_analysis_history(code: str, company_name: str = None, user_name: str = N
         """, (code, company_name, datetime.now().isoformat(), user_name, 1 if success else 0))
         conn.commit()
 
-def get_analysis_history(limit: int = 10):
+def log_analysis_history_many(entries: list):
+    """
+    分析履歴をまとめて記録する（非同期ライタからのバッチ書き込み用）
+
+    Args:
+        entries: [(code, company_name, analyzed_at, user_name, success), ...]
+    """
+    with get_connection() as conn:
+        conn.executemany("""
+            INSERT INTO analysis_history (stock_code, company_name, analyzed_at, user_name, success)
+            VALUES (?, ?, ?, ?, ?)
+        """, [(code, name, at, user, 1 if success else 0) for code, name, at, user, success in entries])
+        conn.commit()
+
+def get_analysis_history(limit: int = 10, user_name: str = None, code: str = None, before: tuple = None):
     """
-    分析履歴を取得する
+    分析履歴を新しい順に取得する（インデックスを使ったキーセットページング）
     
     Args:
         limit: 取得件数（デフォルト: 10件）
+        user_name: 指定したユーザーの履歴のみ
+        code: 指定した証券コードの履歴のみ
+        before: 前ページ最後の行の (analyzed_at, id)。指定するとそれより古い行を返す
         
     Returns:
         履歴のリスト [(id, stock_code, company_name, analyzed_at, user_name, success), ...]
     """
+    conditions, params = [], []
+    if user_name is not None:
+        conditions.append("user_name = ?")
+        params.append(user_name)
+    if code is not None:
+        conditions.append("stock_code = ?")
+        params.append(code)
+    if before is not None:
+        conditions.append("(analyzed_at, id) < (?, ?)")
+        params.extend(before)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
     with get_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("""
+        cursor.execute(f"""
             SELECT id, stock_code, company_name, analyzed_at, user_name, success
             FROM analysis_history
-            ORDER BY analyzed_at DESC
+            {where}
+            ORDER BY analyzed_at DESC, id DESC
+            LIMIT ?
+        """, params + [limit])
+        return cursor.fetchall()
+
+def get_analysis_daily_stats(days: int = 7, group_by: str = 'stock_code', limit: int = 10):
+    """
+    日次集計から直近の分析リクエスト数を集計する（生の履歴は読まない）
+
+    Args:
+        days: 集計する日数（当日を含まない、集計済みの日のみ）
+        group_by: 'stock_code' または 'user_name'
+        limit: 取得件数
+
+    Returns:
+        [(stock_code または user_name, requests, successes), ...] リクエスト数の多い順
+    """
+    if group_by not in ('stock_code', 'user_name'):
+        raise ValueError(f"group_by must be 'stock_code' or 'user_name': {group_by}")
+    since = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
+
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT {group_by}, SUM(requests), SUM(successes)
+            FROM analysis_daily_stats
+            WHERE day >= ?
+            GROUP BY {group_by}
+            ORDER BY SUM(requests) DESC
             LIMIT ?
-        """, (limit,))
+        """, (since, limit))
         return cursor.fetchall()
 
 def initialize_db():
@@ -144,9 +444,23 @@ def initialize_db():
         os.makedirs(os.path.dirname(DB_PATH))
     
     with get_connection() as conn:
+        # WALモード: バッチの書き込み中もBotの読み取りをブロックしない（設定はDBファイルに永続化される）
+        conn.execute("PRAGMA journal_mode=WAL")
         create_tables(conn)
     print(f"✅ Database initialized at: {DB_PATH}")
 
+def get_table_stats() -> dict:
+    """
+    バッチが記録したテーブル統計を取得する（全件走査なし）
+
+    Returns:
+        {'tables': {table: {row_count, min_date, max_date, last_ingested_date, updated_at}},
+         'db_size': int, 'wal_size': int, 'updated_at': str}
+    """
+    from src.core.table_stats import load_table_stats
+    with get_read_connection() as conn:
+        return load_table_stats(conn)
+
 def get_company_info(code: str) -> dict:
     """
     企業情報を取得する
@@ -157,24 +471,11 @@ def get_company_info(code: str) -> dict:
     Returns:
         企業情報の辞書 (code, name, market, industry)
     """
-    with get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT code, name, market, industry
-            FROM companies
-            WHERE code = ?
-        """, (code,))
-        
-        result = cursor.fetchone()
-        if result:
-            return {
-                'code': result[0],
-                'name': result[1],
-                'market': result[2],
-                'industry': result[3]
-            }
-        return None
+    # 銘柄マスタはプロセス内のスナップショットから引く（DBアクセスなし）
+    from src.core.company_master import get_company_master
+    return get_company_master().get(code)
 
+@cached_query
 def get_stock_prices(code: str, start_date: str = None, end_date: str = None, limit: int = None):
     """
     株価データを取得する
@@ -190,10 +491,18 @@ def get_stock_prices(code: str, start_date: str = None, end_date: str = None, li
     """
     import pandas as pd
     
-    with get_connection() as conn:
-        query = """
+    with get_read_connection() as conn:
+        table = 'daily_prices'
+        # アーカイブ済みの期間を含む場合は、年別アーカイブをATTACHして参照する
+        archive_before = get_metadata(conn, 'archive_before')
+        if archive_before and (start_date is None or start_date < archive_before):
+            from src.core.archive import attach_archives
+            attach_archives(conn, start_date, tables=['daily_prices'], end_date=end_date, code=code)
+            table = 'daily_prices_all'
+
+        query = f"""
             SELECT date, open, high, low, close, volume
-            FROM daily_prices
+            FROM {table}
             WHERE code = ?
         """
         params = [code]
@@ -228,6 +537,7 @@ def get_stock_prices(code: str, start_date: str = None, end_date: str = None, li
         
         return df
 
+@cached_query
 def get_financial_data(code: str, limit: int = 5):
     """
     財務データを取得する（最新のN件）
@@ -241,7 +551,7 @@ def get_financial_data(code: str, limit: int = 5):
     """
     import pandas as pd
     
-    with get_connection() as conn:
+    with get_read_connection() as conn:
         query = """
             SELECT date, per_forecast, pbr_actual, eps_forecast, 
                    bps_actual, dividend_yield, market_cap
@@ -270,6 +580,7 @@ def get_financial_data(code: str, limit: int = 5):
         
         return df
     
+@cached_query
 def get_margin_balance(code: str, limit: int = 26):
     """
     信用残データを取得する（最新のN件）
@@ -284,7 +595,7 @@ def get_margin_balance(code: str, limit: int = 26):
     """
     import pandas as pd
     
-    with get_connection() as conn:
+    with get_read_connection() as conn:
         # sell_balance_ins: 制度信用売残（機関の空売りを含むことが多い）
         query = """
             SELECT date, sell_balance_total, buy_balance_total, ratio,
@@ -316,6 +627,7 @@ def get_margin_balance(code: str, limit: int = 26):
         return df
     
     
+@cached_query
 def get_market_advance_decline(limit: int = 30, market_filter: str = None):
     """
     市場全体の騰落数を集計する（前日比ベース）
@@ -328,8 +640,19 @@ def get_market_advance_decline(limit: int = 30, market_filter: str = None):
         pandas.DataFrame: columns=[date, up_count, down_count]
     """
     import pandas as pd
-    
-    with get_connection() as conn:
+    from src.core import analytics
+
+    # DuckDB が使える場合は列指向で集計する（対象銘柄はインメモリ企業マスタから）
+    if analytics.engine_enabled():
+        codes = None
+        if market_filter:
+            from src.core.company_master import get_company_master
+            codes = get_company_master().market_codes(market_filter)
+        df = analytics.market_advance_decline(limit, codes)
+        if df is not None:
+            return _format_advance_decline(df)
+
+    with get_read_connection() as conn:
         # 1. Determine target codes first (if filter exists)
         market_condition = ""
         params = []
@@ -364,11 +687,66 @@ def get_market_advance_decline(limit: int = 30, market_filter: str = None):
         params.append(limit)
 
         df = pd.read_sql_query(query, conn, params=params)
-        if not df.empty:
-            df['date'] = pd.to_datetime(df['date'], format='%Y%m%d')
-            df = df.sort_values('date')
-            df = df.set_index('date')
-        return df
+    return _format_advance_decline(df)
+
+def _format_advance_decline(df):
+    if not df.empty:
+        import pandas as pd
+        df['date'] = pd.to_datetime(df['date'], format='%Y%m%d')
+        df = df.sort_values('date')
+        df = df.set_index('date')
+    return df
+
+
+@cached_query
+def get_sector_daily(industry: str, days: int = 100):
+    """
+    業種の構成銘柄を日次で集計する（直近データ日から days 日分）
+
+    Args:
+        industry: 業種名 (companies.industry)
+        days: 集計する暦日数
+
+    Returns:
+        pandas.DataFrame: index=date, columns=[section_trading_value, avg_change_rate]（該当なしは空）
+    """
+    import json
+    import pandas as pd
+    from src.core.company_master import get_company_master
+
+    # 構成銘柄はインメモリ企業マスタから取得
+    constituents = get_company_master().industry_codes(industry)
+    if not constituents:
+        return pd.DataFrame()
+
+    from src.core import analytics
+
+    # DuckDB が使える場合は列指向で集計する
+    df = analytics.sector_daily(constituents, days) if analytics.engine_enabled() else None
+    if df is not None:
+        return _format_sector_daily(df)
+
+    with get_read_connection() as conn:
+        last_date = conn.execute("SELECT MAX(date) FROM daily_prices").fetchone()[0]
+        if last_date is None:
+            return pd.DataFrame()
+        start_date = (datetime.strptime(last_date, '%Y%m%d') - timedelta(days=days)).strftime('%Y%m%d')
+
+        query = """
+            SELECT p.date, SUM(p.trading_value) as section_trading_value, AVG((p.close - p.open)/p.open) as avg_change_rate
+            FROM daily_prices p
+            WHERE p.code IN (SELECT value FROM json_each(?)) AND p.date >= ?
+            GROUP BY p.date ORDER BY p.date
+        """
+        df = pd.read_sql_query(query, conn, params=[json.dumps(constituents), start_date])
+    return _format_sector_daily(df)
+
+def _format_sector_daily(df):
+    if not df.empty:
+        import pandas as pd
+        df['date'] = pd.to_datetime(df['date'], format='%Y%m%d')
+        df = df.set_index('date')
+    return df
 
 
 if __name__ == "__main__":
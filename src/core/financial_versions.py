@@ -0,0 +1,298 @@
+"""
+財務指標の変更履歴ストレージ (SCD: slowly changing dimension)
+
+株・プラスの財務指標CSVは全銘柄×毎日の行を持つが、発行済株式数・EPS・BPS・配当・売買単位といった
+基礎値は決算や株式分割のときにしか変わらず、PER・PBR・時価総額・配当利回り・最低投資金額は
+基礎値と株価から決まる。そこで基礎値が変わったときだけ1行 (valid_from〜valid_to) を保存し、
+株価依存の指標は daily_financials ビューで日足株価から再計算する。
+
+    financial_versions: (code, valid_from) を主キーとする基礎値の有効期間テーブル
+                        valid_to は次の版の開始日（排他的）、現行の版は NULL
+    daily_financials:   日足株価 × その日に有効な版 を結合した互換ビュー
+                        （従来の daily_financials テーブルと同じカラムを返す）
+
+配当は利回り(小数2桁)から1株配当を逆算するため丸め誤差で日々揺れる。
+DIVIDEND_TOLERANCE 以内の揺れは変更とみなさない。
+
+ビューが返す値の精度:
+    - 各版の valid_from 当日は、CSVの値をそのまま保存したアンカー値を返す。
+    - それ以外の日は終値と基礎値から再計算するため、CSVの値と丸め1単位ずれることがある。
+      例: 1305 の 20250612 は CSV の配当利回り 1.83 に対し、逆算した1株配当からの再計算では 1.84 になる。
+    - 日足株価の行が無い日は、版の開始日に限りアンカー値で行を返す。
+      それ以外の株価の無い日は復元できないため、旧テーブルの行は daily_financials_legacy に残す。
+
+旧形式の daily_financials テーブルは create_tables では移行しない（スキーマ確認のたびに重い変換を走らせないため）。
+取り込み処理（日次バッチ・バンドル取り込み・生データの再取り込み・シャードのマージ）の開始時に
+migrate_daily_financials で移行し、旧テーブルのまま financial_versions にだけ書き込むことはしない。
+手動で移行する場合:
+    PYTHONPATH=. python src/core/db_maintenance.py --migrate-financials
+"""
+import sqlite3
+
+# 従来の daily_financials テーブルのカラム順（ローダから渡されるレコードの並び）
+FIN_COLUMNS = ['code', 'date', 'market_cap', 'shares_outstanding', 'per_forecast', 'pbr_actual',
+               'eps_forecast', 'bps_actual', 'dividend_yield', 'min_investment']
+
+# 変更検知の対象となる基礎値
+FUNDAMENTAL_COLUMNS = ['shares_outstanding', 'eps_forecast', 'bps_actual', 'dividend_per_share', 'trading_unit']
+
+# 版の開始日時点の株価依存指標（その日の株価が無い場合のフォールバック）
+ANCHOR_COLUMNS = ['market_cap', 'per_forecast', 'pbr_actual', 'dividend_yield', 'min_investment']
+
+VERSION_COLUMNS = ['code', 'valid_from', 'valid_to'] + FUNDAMENTAL_COLUMNS + ANCHOR_COLUMNS
+
+# 1株配当の揺れの許容幅（相対値）と、株価に対する下限（利回りの丸め幅 0.005% の2倍）
+DIVIDEND_TOLERANCE = 0.01
+DIVIDEND_PRICE_TOLERANCE = 0.0001
+
+_VIEW_TEMPLATE = """
+    CREATE {temp}VIEW IF NOT EXISTS {view} AS
+    SELECT
+        p.code AS code,
+        p.date AS date,
+        CAST(CASE WHEN p.date = f.valid_from AND f.market_cap IS NOT NULL THEN f.market_cap
+                  WHEN p.close IS NOT NULL AND f.shares_outstanding IS NOT NULL
+                  THEN ROUND(p.close * f.shares_outstanding / 1000000.0) ELSE f.market_cap END AS REAL) AS market_cap,
+        f.shares_outstanding AS shares_outstanding,
+        CAST(CASE WHEN p.date = f.valid_from AND f.per_forecast IS NOT NULL THEN f.per_forecast
+                  WHEN p.close IS NOT NULL AND f.eps_forecast > 0
+                  THEN ROUND(p.close / f.eps_forecast, 2) ELSE f.per_forecast END AS REAL) AS per_forecast,
+        CAST(CASE WHEN p.date = f.valid_from AND f.pbr_actual IS NOT NULL THEN f.pbr_actual
+                  WHEN p.close IS NOT NULL AND f.bps_actual > 0
+                  THEN ROUND(p.close / f.bps_actual, 2) ELSE f.pbr_actual END AS REAL) AS pbr_actual,
+        f.eps_forecast AS eps_forecast,
+        f.bps_actual AS bps_actual,
+        CAST(CASE WHEN p.date = f.valid_from AND f.dividend_yield IS NOT NULL THEN f.dividend_yield
+                  WHEN p.close > 0 AND f.dividend_per_share IS NOT NULL
+                  THEN ROUND(f.dividend_per_share / p.close * 100, 2) ELSE f.dividend_yield END AS REAL) AS dividend_yield,
+        CAST(CASE WHEN p.date = f.valid_from AND f.min_investment IS NOT NULL THEN f.min_investment
+                  WHEN p.close IS NOT NULL AND f.trading_unit IS NOT NULL
+                  THEN p.close * f.trading_unit ELSE f.min_investment END AS REAL) AS min_investment
+    FROM {prices} p
+    JOIN {versions} f
+      ON f.code = p.code
+     AND f.valid_from <= p.date
+     AND (f.valid_to IS NULL OR p.date < f.valid_to)
+    UNION ALL
+    -- 株価の行が無い版の開始日はアンカー値をそのまま返す
+    SELECT f.code, f.valid_from, f.market_cap, f.shares_outstanding, f.per_forecast, f.pbr_actual,
+           f.eps_forecast, f.bps_actual, f.dividend_yield, f.min_investment
+    FROM {versions} f
+    WHERE NOT EXISTS (SELECT 1 FROM {prices} p WHERE p.code = f.code AND p.date = f.valid_from)
+"""
+
+
+def daily_financials_view_sql(view: str = 'daily_financials', prices: str = 'daily_prices',
+                              versions: str = 'financial_versions', temp: bool = False) -> str:
+    """日足株価と財務指標の版を結合するビューのDDL（アーカイブ込みの一時ビューにも使う）"""
+    return _VIEW_TEMPLATE.format(temp='TEMP ' if temp else '', view=view, prices=prices, versions=versions)
+
+
+def create_financial_schema(conn: sqlite3.Connection):
+    """financial_versions テーブルと daily_financials ビューを作成する（旧テーブルがあればビューは作らない）"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS financial_versions (
+            code TEXT,
+            valid_from TEXT,
+            valid_to TEXT,                  -- 次の版の開始日 (排他的)。現行の版は NULL
+            shares_outstanding REAL,
+            eps_forecast REAL,
+            bps_actual REAL,
+            dividend_per_share REAL,        -- 配当利回り × 株価 から逆算
+            trading_unit REAL,              -- 最低投資金額 ÷ 株価 から逆算
+            market_cap REAL,                -- 以下、valid_from 時点の値
+            per_forecast REAL,
+            pbr_actual REAL,
+            dividend_yield REAL,
+            min_investment REAL,
+            PRIMARY KEY (code, valid_from)
+        );
+    """)
+    row = conn.execute("SELECT type FROM sqlite_master WHERE name = 'daily_financials'").fetchone()
+    if row and row[0] == 'table':
+        print("⚠️ 旧形式の daily_financials テーブルがあります（次回の取り込み開始時に移行されます）。")
+        return
+    # 定義を変更したときに既存DBのビューも作り直す
+    conn.execute("DROP VIEW IF EXISTS daily_financials")
+    conn.execute(daily_financials_view_sql())
+
+
+def _num(value):
+    """NaN を None に揃える"""
+    if value is None or value != value:
+        return None
+    return float(value)
+
+
+def _fundamentals(record: dict, close) -> dict:
+    """CSVの1行と終値から基礎値を求める"""
+    dividend_yield = _num(record.get('dividend_yield'))
+    min_investment = _num(record.get('min_investment'))
+    close = _num(close)
+    return {
+        'shares_outstanding': _num(record.get('shares_outstanding')),
+        'eps_forecast': _num(record.get('eps_forecast')),
+        'bps_actual': _num(record.get('bps_actual')),
+        'dividend_per_share': dividend_yield * close / 100 if dividend_yield is not None and close else None,
+        'trading_unit': float(round(min_investment / close)) if min_investment is not None and close else None,
+    }
+
+
+def _is_changed(old: dict, new: dict, close) -> bool:
+    """基礎値に変化があるか（1株配当は丸め誤差を許容）"""
+    for col in FUNDAMENTAL_COLUMNS:
+        a, b = old.get(col), new.get(col)
+        if a is None or b is None:
+            # 株価が無い日は配当・売買単位を比較できないため、新側の欠損は変化とみなさない
+            if b is None and col in ('dividend_per_share', 'trading_unit'):
+                continue
+            if a is not b:
+                return True
+            continue
+        if col == 'dividend_per_share':
+            tolerance = max(abs(a) * DIVIDEND_TOLERANCE, (_num(close) or 0) * DIVIDEND_PRICE_TOLERANCE)
+            if abs(a - b) > tolerance:
+                return True
+        elif a != b:
+            return True
+    return False
+
+
+def _version_row(code, valid_from, valid_to, fundamentals: dict, record: dict) -> tuple:
+    anchors = [_num(record.get(col)) for col in ANCHOR_COLUMNS]
+    return tuple([code, valid_from, valid_to] + [fundamentals[col] for col in FUNDAMENTAL_COLUMNS] + anchors)
+
+
+def apply_daily_financials(conn: sqlite3.Connection, date_str: str, records: list) -> dict:
+    """
+    1日分の財務指標を financial_versions に反映する（基礎値が変わった銘柄のみ書き込む）
+
+    日足株価 (daily_prices) の同日分が先に格納されている前提で、終値から配当・売買単位を逆算する。
+    過去日の再取り込みにも対応し、その日を含む版を分割して新しい版を差し込む。
+
+    Args:
+        date_str: データ日付 (YYYYMMDD)
+        records: FIN_COLUMNS 順のタプルのリスト
+
+    Returns:
+        {'new': 新規銘柄数, 'changed': 版を追加した銘柄数, 'unchanged': 変化なしの銘柄数}
+    """
+    closes = dict(conn.execute("SELECT code, close FROM daily_prices WHERE date = ?", (date_str,)).fetchall())
+
+    cols = ', '.join(VERSION_COLUMNS)
+    covering = {}
+    for row in conn.execute(f"""
+        SELECT {cols} FROM financial_versions
+        WHERE valid_from <= ? AND (valid_to IS NULL OR ? < valid_to)
+    """, (date_str, date_str)):
+        covering[row[0]] = dict(zip(VERSION_COLUMNS, row))
+    next_start = dict(conn.execute("""
+        SELECT code, MIN(valid_from) FROM financial_versions WHERE valid_from > ? GROUP BY code
+    """, (date_str,)).fetchall())
+
+    inserts, closes_at, replaces = [], [], []
+    counts = {'new': 0, 'changed': 0, 'unchanged': 0}
+    for values in records:
+        record = dict(zip(FIN_COLUMNS, values))
+        code = str(record['code'])
+        close = closes.get(code)
+        fundamentals = _fundamentals(record, close)
+        current = covering.get(code)
+
+        if current is None:
+            # この日を含む版が無い: 次の版（あれば）の手前までを新しい版とする
+            inserts.append(_version_row(code, date_str, next_start.get(code), fundamentals, record))
+            counts['new'] += 1
+        elif not _is_changed(current, fundamentals, close):
+            counts['unchanged'] += 1
+        elif current['valid_from'] == date_str:
+            # 同日の再取り込みで値が変わった: 版を置き換える
+            replaces.append(_version_row(code, date_str, current['valid_to'], fundamentals, record))
+            counts['changed'] += 1
+        else:
+            # 既存の版をこの日で閉じ、新しい版を開始する
+            closes_at.append((date_str, code, current['valid_from']))
+            inserts.append(_version_row(code, date_str, current['valid_to'], fundamentals, record))
+            counts['changed'] += 1
+
+    placeholders = ', '.join(['?'] * len(VERSION_COLUMNS))
+    if closes_at:
+        conn.executemany("UPDATE financial_versions SET valid_to = ? WHERE code = ? AND valid_from = ?", closes_at)
+    if inserts or replaces:
+        conn.executemany(f"INSERT OR REPLACE INTO financial_versions ({cols}) VALUES ({placeholders})",
+                         inserts + replaces)
+    return counts
+
+
+def migrate_daily_financials(conn: sqlite3.Connection, batch_rows: int = 50_000):
+    """
+    旧形式の daily_financials テーブル（全銘柄×毎日）を financial_versions に変換し、ビューに置き換える
+
+    銘柄・日付順にストリーミングで読み込み、基礎値が変わった行だけを版として残す。
+    旧テーブルは削除せず daily_financials_legacy に改名して残す。
+    移行前にローダが書き込んだ版がある銘柄は、その最初の版より前の期間だけを旧テーブルから補う。
+
+    Returns:
+        {'source_rows': 旧テーブルの行数, 'versions': 追加した版の数}（旧テーブルが無ければ None）
+    """
+    row = conn.execute("SELECT type FROM sqlite_master WHERE name = 'daily_financials'").fetchone()
+    if not row or row[0] != 'table':
+        return None
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'daily_financials_legacy'").fetchone():
+        raise RuntimeError("daily_financials_legacy が既に存在するため移行できません")
+
+    print("  -> daily_financials を変更履歴形式 (financial_versions) へ移行します...")
+    first_start = dict(conn.execute("SELECT code, MIN(valid_from) FROM financial_versions GROUP BY code").fetchall())
+    src_cols = ', '.join(f"f.{c}" for c in FIN_COLUMNS)
+    cursor = conn.execute(f"""
+        SELECT {src_cols}, p.close
+        FROM daily_financials f
+        LEFT JOIN daily_prices p ON p.code = f.code AND p.date = f.date
+        ORDER BY f.code, f.date
+    """)
+
+    versions = []
+    current_code, current, current_row = None, None, None
+    source_rows = 0
+
+    def flush_current(valid_to):
+        if current_row is None:
+            return
+        code, valid_from = current_row[:2]
+        first = first_start.get(code)
+        if first is not None:
+            # 既存の版と重なる期間は既存の版を優先する
+            if valid_from >= first:
+                return
+            valid_to = min(valid_to or first, first)
+        versions.append(current_row[:2] + (valid_to,) + current_row[3:])
+
+    while True:
+        rows = cursor.fetchmany(batch_rows)
+        if not rows:
+            break
+        for values in rows:
+            source_rows += 1
+            record = dict(zip(FIN_COLUMNS, values[:-1]))
+            close = values[-1]
+            code, date = str(record['code']), record['date']
+            fundamentals = _fundamentals(record, close)
+
+            if code != current_code:
+                flush_current(None)
+                current_code, current = code, fundamentals
+                current_row = _version_row(code, date, None, fundamentals, record)
+            elif _is_changed(current, fundamentals, close):
+                flush_current(date)
+                current = fundamentals
+                current_row = _version_row(code, date, None, fundamentals, record)
+    flush_current(None)
+
+    cols = ', '.join(VERSION_COLUMNS)
+    placeholders = ', '.join(['?'] * len(VERSION_COLUMNS))
+    conn.executemany(f"INSERT OR REPLACE INTO financial_versions ({cols}) VALUES ({placeholders})", versions)
+    conn.execute("ALTER TABLE daily_financials RENAME TO daily_financials_legacy")
+    conn.execute(daily_financials_view_sql())
+    conn.commit()
+    print(f"  -> 移行完了: {source_rows}行 → {len(versions)}版（旧テーブルは daily_financials_legacy に保存）")
+    return {'source_rows': source_rows, 'versions': len(versions)}
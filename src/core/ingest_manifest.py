@@ -0,0 +1,141 @@
+"""
+取り込みマニフェスト (ingest_manifest)
+
+株・プラスのCSVファイル1つ（データセット × ファイル日付）ごとに、取り込み結果・行数・サイズ・
+本文の SHA-256 を記録する。ローダはデータの書き込みと同じトランザクションで記録し、日付ごとにコミットするため、
+途中で落ちても完了した日付までは記録とデータが一致している。
+
+    done:       取り込み済み。次回以降はダウンロードしない（--recheck 時はハッシュが変わった場合のみ再取り込み）
+    not_found:  404。ファイル日付より後の日に確認した 404 は「存在しない」と確定し（ネガティブキャッシュ）、
+                以後は取得しない。当日の 404 は公表前の可能性があるため次回も取得を試みる
+    failed:     ダウンロード・変換・書き込みのエラー。次回も取得を試みる
+
+Usage:
+    PYTHONPATH=. python src/core/ingest_manifest.py show [--days 30]
+    PYTHONPATH=. python src/core/ingest_manifest.py reset --dataset margin --from 20260101 --to 20260131
+"""
+import os
+import sys
+import hashlib
+import sqlite3
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from src.core.db_manager import get_connection
+
+STATUS_DONE = 'done'
+STATUS_NOT_FOUND = 'not_found'
+STATUS_FAILED = 'failed'
+
+MANIFEST_COLUMNS = ['dataset', 'file_date', 'status', 'row_count', 'byte_size', 'content_hash',
+                    'attempts', 'error', 'parse_ms', 'first_seen_at', 'loaded_at', 'updated_at']
+
+
+def content_hash(content: bytes) -> str:
+    """CSV本文の SHA-256"""
+    return hashlib.sha256(content).hexdigest()
+
+
+def load_manifest(conn: sqlite3.Connection, start_date: str, end_date: str) -> dict:
+    """
+    期間内の記録を読み込む（ingest_manifest 未作成の旧DBでは空）
+
+    Returns:
+        {(dataset, file_date): {status, row_count, content_hash, ...}}
+    """
+    try:
+        rows = conn.execute(f"""
+            SELECT {', '.join(MANIFEST_COLUMNS)} FROM ingest_manifest
+            WHERE file_date >= ? AND file_date <= ?
+        """, (start_date, end_date)).fetchall()
+    except sqlite3.OperationalError:
+        return {}
+    return {(row[0], row[1]): dict(zip(MANIFEST_COLUMNS, row)) for row in rows}
+
+
+def is_confirmed_missing(entry: dict) -> bool:
+    """ファイル日付より後の日に 404 を確認済みか（公表前の 404 と区別する）"""
+    if not entry or entry['status'] != STATUS_NOT_FOUND or not entry['updated_at']:
+        return False
+    return entry['updated_at'][:10].replace('-', '') > entry['file_date']
+
+
+def record_ingest(conn: sqlite3.Connection, dataset: str, file_date: str, status: str,
+                  row_count: int = None, byte_size: int = None, content_hash: str = None, error: str = None,
+                  parse_ms: float = None):
+    """
+    1ファイル分の結果を記録する（コミットは呼び出し側）
+
+    done 以外の結果では、前回 done だったときの行数・ハッシュ・取り込み日時を残す。
+    """
+    now = datetime.now().isoformat()
+    loaded_at = now if status == STATUS_DONE else None
+    conn.execute("""
+        INSERT INTO ingest_manifest (dataset, file_date, status, row_count, byte_size, content_hash,
+                                     attempts, error, parse_ms, first_seen_at, loaded_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, 1, ?, ?, ?, ?, ?)
+        ON CONFLICT(dataset, file_date) DO UPDATE SET
+            status = excluded.status,
+            row_count = COALESCE(excluded.row_count, row_count),
+            byte_size = COALESCE(excluded.byte_size, byte_size),
+            content_hash = COALESCE(excluded.content_hash, content_hash),
+            attempts = attempts + 1,
+            error = excluded.error,
+            parse_ms = COALESCE(excluded.parse_ms, parse_ms),
+            loaded_at = COALESCE(excluded.loaded_at, loaded_at),
+            updated_at = excluded.updated_at
+    """, (dataset, file_date, status, row_count, byte_size, content_hash, error, parse_ms, now, loaded_at, now))
+
+
+def summarize_manifest(conn: sqlite3.Connection, since: str = None) -> list:
+    """データセット・状態ごとの件数 [(dataset, status, files, rows, bytes, 平均解析ms, 最古日付, 最新日付), ...]"""
+    return conn.execute("""
+        SELECT dataset, status, COUNT(*), COALESCE(SUM(row_count), 0), COALESCE(SUM(byte_size), 0),
+               AVG(parse_ms), MIN(file_date), MAX(file_date)
+        FROM ingest_manifest
+        WHERE file_date >= ?
+        GROUP BY dataset, status
+        ORDER BY dataset, status
+    """, (since or '',)).fetchall()
+
+
+def reset_manifest(conn: sqlite3.Connection, dataset: str = None, start_date: str = None, end_date: str = None) -> int:
+    """記録を削除し、次回のバッチで再取り込みさせる（コミットまで行う）"""
+    where, params = ["file_date >= ?", "file_date <= ?"], [start_date or '', end_date or '99999999']
+    if dataset:
+        where.append("dataset = ?")
+        params.append(dataset)
+    deleted = conn.execute(f"DELETE FROM ingest_manifest WHERE {' AND '.join(where)}", params).rowcount
+    conn.commit()
+    return deleted
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Show or reset the ingestion manifest')
+    sub = parser.add_subparsers(dest='command', required=True)
+    show = sub.add_parser('show', help='Show file counts per dataset and status')
+    show.add_argument('--days', type=int, default=None, help='Only files from the last N days (default: all)')
+    reset = sub.add_parser('reset', help='Forget files so the next batch ingests them again')
+    reset.add_argument('--dataset', choices=['prices', 'financials', 'margin', 'indices'], help='Dataset (default: all)')
+    reset.add_argument('--from', dest='start', help='First file date YYYYMMDD')
+    reset.add_argument('--to', dest='end', help='Last file date YYYYMMDD')
+    args = parser.parse_args()
+
+    conn = get_connection()
+    try:
+        if args.command == 'show':
+            since = (datetime.now() - timedelta(days=args.days)).strftime('%Y%m%d') if args.days else None
+            rows = summarize_manifest(conn, since)
+            if not rows:
+                print("  記録がありません（バッチ実行時に作成されます）")
+            for dataset, status, files, row_count, size, parse_ms, first, last in rows:
+                parse = f"解析 平均{parse_ms:.0f}ms" if parse_ms is not None else ''
+                print(f"  {dataset:<10} {status:<9} {files:>5}ファイル {row_count:>10,}行 "
+                      f"{size / 1024 / 1024:>8.1f}MB  {first}〜{last}  {parse}")
+        else:
+            deleted = reset_manifest(conn, args.dataset, args.start, args.end)
+            print(f"  -> {deleted}件の記録を削除しました")
+    finally:
+        conn.close()
@@ -0,0 +1,187 @@
+"""
+取り込みパイプライン（ダウンロード → 解析 → 書き込み）
+
+run_daily_batch のファイルごとの処理を3段に分け、段ごとに別の資源で並行に動かす。
+
+    1. ダウンロード (ネットワーク):  I/O スレッドプール (download_workers 本)
+    2. 解析 (CPU):                   プロセスプール (parse_workers 個)。cp932 のCSVを型付きの列を持つ DataFrame に変換する
+                                     （スレッドでは GIL のため1コアしか使えない）。0 ならダウンロードしたスレッドで解析する
+    3. 書き込み (ディスク):          呼び出し側のスレッド1つ（SQLite の書き手は常に1つ）。コミットの間隔は呼び出し側が決める
+
+ファイルは投入順に書き込み側へ渡し、投入済みで未書き込みのファイル数を depth までに制限する。
+書き込みが追いつかないと新しいダウンロードを始めない（背圧）ため、解析済みのデータがメモリに溜まりすぎない。
+段ごとの稼働時間を記録し、summary() で稼働率と書き込み待ちの件数を報告する。
+"""
+import os
+import sys
+import time
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, wait
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from src.core.ingest_manifest import STATUS_DONE, STATUS_FAILED
+
+# 解析プロセスの起動方法。ダウンロードスレッドの動作中に fork すると、子プロセスがロックを握ったまま複製され得るため spawn を使う
+PROCESS_START_METHOD = 'spawn'
+
+
+def _timed_parse(parse, dataset: str, date_str: str, content: bytes):
+    """解析プロセスで実行する（戻り値と経過ミリ秒）"""
+    started = time.perf_counter()
+    payload = parse(dataset, date_str, content)
+    return payload, (time.perf_counter() - started) * 1000
+
+
+class IngestPipeline:
+    """
+    ダウンロード・解析・書き込みの3段パイプライン
+
+    Usage:
+        with IngestPipeline(fetch, parse, download_workers=4, parse_workers=3) as pipeline:
+            for (dataset, date_str, known_hash), future in pipeline.run(items):
+                status, payload, meta = future.result()   # 投入順に届く。ここでDBに書き込む
+        print(pipeline.summary())
+    """
+
+    def __init__(self, fetch, parse, download_workers: int, parse_workers: int = 0, depth: int = None):
+        """
+        Args:
+            fetch: fetch(dataset, date_str, known_hash) -> (状態, CSV本文, meta)。ダウンロードスレッドで実行する
+            parse: parse(dataset, date_str, content) -> 変換結果（失敗時 None）。モジュール直下の関数（プロセス間で受け渡す）
+            download_workers: ダウンロードスレッド数
+            parse_workers: 解析プロセス数（0 ならダウンロードスレッドで解析）
+            depth: 投入済みで未書き込みのファイル数の上限（既定: 全ワーカー数の2倍）
+        """
+        self.fetch = fetch
+        self.parse = parse
+        self.download_workers = max(download_workers, 1)
+        self.parse_workers = max(parse_workers, 0)
+        self.depth = depth or (self.download_workers + self.parse_workers) * 2
+
+        self._lock = threading.Lock()
+        self.busy = {'download': 0.0, 'parse': 0.0, 'write': 0.0}
+        self.write_wait = 0.0
+        self.files = 0
+        self.ready_total = 0
+        self.ready_max = 0
+        self.elapsed = 0.0
+        self._download_pool = None
+        self._parse_pool = None
+
+    def __enter__(self):
+        self._download_pool = ThreadPoolExecutor(self.download_workers, thread_name_prefix='download')
+        if self.parse_workers:
+            self._parse_pool = ProcessPoolExecutor(
+                self.parse_workers, mp_context=multiprocessing.get_context(PROCESS_START_METHOD))
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # 中断時は未着手のダウンロード・解析を取り消す
+        cancel = exc_type is not None
+        self._download_pool.shutdown(wait=True, cancel_futures=cancel)
+        if self._parse_pool is not None:
+            self._parse_pool.shutdown(wait=True, cancel_futures=cancel)
+        return False
+
+    def _add_busy(self, stage: str, seconds: float):
+        with self._lock:
+            self.busy[stage] += seconds
+
+    def _download(self, dataset: str, date_str: str, known_hash: str):
+        started = time.perf_counter()
+        try:
+            return self.fetch(dataset, date_str, known_hash)
+        finally:
+            self._add_busy('download', time.perf_counter() - started)
+
+    def _parsed(self, payload, parse_ms: float, meta: dict, slot: Future):
+        self._add_busy('parse', parse_ms / 1000)
+        meta = {**meta, 'parse_ms': parse_ms}
+        if payload is None:
+            slot.set_result((STATUS_FAILED, None, {**meta, 'error': 'parse error'}))
+        else:
+            slot.set_result((STATUS_DONE, payload, meta))
+
+    def _after_download(self, dataset: str, date_str: str, download: Future, slot: Future):
+        """ダウンロードの完了時（ダウンロードスレッド上）: 解析を始める"""
+        try:
+            status, content, meta = download.result()
+            if status != STATUS_DONE:
+                slot.set_result((status, None, meta))
+            elif self._parse_pool is None:
+                self._parsed(*_timed_parse(self.parse, dataset, date_str, content), meta, slot)
+            else:
+                parsing = self._parse_pool.submit(_timed_parse, self.parse, dataset, date_str, content)
+                parsing.add_done_callback(lambda f: self._after_parse(f, meta, slot))
+        except BaseException as e:
+            slot.set_exception(e)
+
+    def _after_parse(self, parsing: Future, meta: dict, slot: Future):
+        try:
+            self._parsed(*parsing.result(), meta, slot)
+        except BaseException as e:
+            slot.set_exception(e)
+
+    def _submit(self, item) -> Future:
+        dataset, date_str, known_hash = item
+        slot = Future()
+        download = self._download_pool.submit(self._download, dataset, date_str, known_hash)
+        download.add_done_callback(lambda f: self._after_download(dataset, date_str, f, slot))
+        return slot
+
+    def run(self, items: list):
+        """
+        items [(dataset, date_str, known_hash), ...] を処理し、投入順に (item, 完了した Future) を返す
+
+        Future の結果は (状態, 変換結果, meta)。ループ本体（書き込み）の所要時間は書き込み段の稼働時間として数える。
+        """
+        started = time.perf_counter()
+        queue = iter(items)
+        in_flight = deque()
+
+        def submit_next():
+            item = next(queue, None)
+            if item is not None:
+                in_flight.append((item, self._submit(item)))
+
+        for _ in range(self.depth):
+            submit_next()
+
+        try:
+            while in_flight:
+                ready = sum(slot.done() for _, slot in in_flight)
+                self.ready_total += ready
+                self.ready_max = max(self.ready_max, ready)
+
+                item, slot = in_flight.popleft()
+                waited = time.perf_counter()
+                wait([slot])
+                self.write_wait += time.perf_counter() - waited
+                # 書き込み側が1件受け取るごとに1件投入する（未書き込みの件数は depth を超えない）
+                submit_next()
+
+                writing = time.perf_counter()
+                yield item, slot
+                self.busy['write'] += time.perf_counter() - writing
+                self.files += 1
+        finally:
+            self.elapsed += time.perf_counter() - started
+
+    def summary(self) -> str:
+        """段ごとの稼働率（稼働時間 / (経過時間 × 並列数)）と書き込み待ちの件数"""
+        elapsed = max(self.elapsed, 1e-9)
+
+        def utilization(stage: str, workers: int) -> str:
+            return f"{self.busy[stage] / (elapsed * workers):.0%}"
+
+        if self.parse_workers:
+            parse = f"解析 {self.parse_workers}プロセス {utilization('parse', self.parse_workers)}"
+        else:
+            parse = f"解析 (ダウンロードスレッド内) {self.busy['parse']:.1f}秒"
+        ready_avg = self.ready_total / self.files if self.files else 0
+        return (f"パイプライン: {elapsed:.1f}秒, ダウンロード {self.download_workers}スレッド "
+                f"{utilization('download', self.download_workers)} / {parse} / "
+                f"書き込み {utilization('write', 1)} (上流待ち {self.write_wait:.1f}秒) / "
+                f"書き込み待ち 平均{ready_avg:.1f}・最大{self.ready_max}件 (上限 {self.depth})")
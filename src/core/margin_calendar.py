@@ -0,0 +1,133 @@
+"""
+信用残 (tosho-stock-margin-transactions-2) の公表日カレンダー
+
+信用残は週次データで、前週金曜日時点の残高がその週の2営業日目（通常は火曜、月曜が祝日なら水曜）に公表される。
+従来のローダは全営業日に取得を試みていたため、5日のうち4日は 404 になっていた。
+ここでは公表日になり得る日だけを判定し、ローダはそれ以外の日の信用残を取得しない。
+
+公表日の規則は既定で「週の2営業日目」とし、取り込みマニフェストに記録された実際の公表日
+（status = done の日付）が週の何営業日目だったかを学習して候補に加える。
+週の営業日が規則の日数に満たない週（年末年始など）は、その週の最終営業日を候補にする。
+
+ローダは公表日の候補しか取得しないため、候補の日が 404 確定になった週は probe_days で
+その週の残りの営業日も取得してみる。公表日がずれた週の実際の公表日が取り込まれ、学習の対象になる。
+"""
+import sqlite3
+from datetime import date, datetime, timedelta
+
+import jpholiday
+
+from src.core.ingest_manifest import STATUS_DONE, is_confirmed_missing
+
+# 公表日は週の何営業日目か（1始まり）
+DEFAULT_PUBLICATION_OFFSETS = {2}
+
+# 東証の年末年始休業日 (月, 日)。祝日 (jpholiday) 以外の休場日
+MARKET_CLOSED_DAYS = {(12, 31), (1, 2), (1, 3)}
+
+
+def _as_date(value) -> date:
+    if isinstance(value, str):
+        return datetime.strptime(value, '%Y%m%d').date()
+    if isinstance(value, datetime):
+        return value.date()
+    return value
+
+
+def is_market_day(value) -> bool:
+    """東証の営業日か（土日・祝日・年末年始を除く）"""
+    d = _as_date(value)
+    return d.weekday() < 5 and not jpholiday.is_holiday(d) and (d.month, d.day) not in MARKET_CLOSED_DAYS
+
+
+def week_market_days(value) -> list:
+    """その日を含む週（月〜金）の営業日のリスト"""
+    d = _as_date(value)
+    monday = d - timedelta(days=d.weekday())
+    return [day for day in (monday + timedelta(days=i) for i in range(5)) if is_market_day(day)]
+
+
+def business_day_offset(value) -> int:
+    """週の何営業日目か（営業日でなければ 0）"""
+    d = _as_date(value)
+    days = week_market_days(d)
+    return days.index(d) + 1 if d in days else 0
+
+
+def learn_publication_offsets(conn: sqlite3.Connection, min_count: int = 2) -> set:
+    """
+    取り込みマニフェストから、信用残が実際に公表された営業日の位置を学習する
+
+    min_count 回以上観測された位置のみ採用し、既定の規則 (DEFAULT_PUBLICATION_OFFSETS) に加える。
+    """
+    offsets = set(DEFAULT_PUBLICATION_OFFSETS)
+    try:
+        rows = conn.execute("""
+            SELECT file_date FROM ingest_manifest WHERE dataset = 'margin' AND status = 'done'
+        """).fetchall()
+    except sqlite3.OperationalError:
+        return offsets
+
+    counts = {}
+    for (file_date,) in rows:
+        offset = business_day_offset(file_date)
+        if offset:
+            counts[offset] = counts.get(offset, 0) + 1
+    offsets.update(offset for offset, count in counts.items() if count >= min_count)
+    return offsets
+
+
+def is_publication_day(value, offsets: set = None) -> bool:
+    """信用残が公表され得る日か"""
+    d = _as_date(value)
+    days = week_market_days(d)
+    if d not in days:
+        return False
+    offsets = offsets or DEFAULT_PUBLICATION_OFFSETS
+    offset = days.index(d) + 1
+    if offset in offsets:
+        return True
+    # 営業日が規則の日数に満たない週は最終営業日に公表されるものとみなす
+    return d == days[-1] and len(days) < min(offsets)
+
+
+def probe_days(manifest: dict, start: str, end: str, offsets: set = None) -> list:
+    """
+    公表日の候補が 404 確定だった週について、その週の残りの営業日 (YYYYMMDD) を返す
+
+    信用残を取り込み済みの週と、それ自体が 404 確定の日は除く（404 確定の記録が同じ日への再取得を防ぐ）。
+
+    Args:
+        manifest: ingest_manifest.load_manifest の結果
+        start, end: 対象期間 (YYYYMMDD)
+    """
+    done_weeks, missed = set(), {}
+    for (name, file_date), entry in manifest.items():
+        if name != 'margin':
+            continue
+        week = week_market_days(file_date)
+        if not week:
+            continue
+        if entry['status'] == STATUS_DONE:
+            done_weeks.add(week[0])
+        elif is_confirmed_missing(entry) and is_publication_day(file_date, offsets):
+            missed[week[0]] = min(missed.get(week[0], file_date), file_date)
+
+    days = []
+    for week, first_missed in missed.items():
+        if week in done_weeks:
+            continue
+        for day in week_market_days(week):
+            date_str = day.strftime('%Y%m%d')
+            if first_missed < date_str and start <= date_str <= end \
+                    and not is_confirmed_missing(manifest.get(('margin', date_str))):
+                days.append(date_str)
+    return sorted(days)
+
+
+def publication_days(start, end, offsets: set = None) -> list:
+    """期間内の公表日候補 (YYYYMMDD) のリスト"""
+    start_d, end_d = _as_date(start), _as_date(end)
+    return [(start_d + timedelta(days=i)).strftime('%Y%m%d')
+            for i in range((end_d - start_d).days + 1)
+            if is_publication_day(start_d + timedelta(days=i), offsets)]
@@ -0,0 +1,256 @@
+"""
+SQLite → Parquet スナップショットエクスポート
+
+オフライン分析用に、日次系テーブルを年/月でパーティション分割したParquetへ書き出す。
+前回エクスポート時から変化した月のパーティションのみを書き直し（増分）、
+変化した月の行を日付順の1回の走査で読み、カーソルから一定件数ずつストリーミングするため、
+テーブル全体をメモリに載せず、月ごとにテーブルを走査し直すこともない。
+DBは読み取り専用で開き、公開済みのスナップショットがあればそちらを読むので、本番のバッチ書き込みとは競合しない。
+
+出力レイアウト:
+    data/parquet/<table>/year=YYYY/month=MM/part-0.parquet
+    data/parquet/_export_state.json   (パーティションごとの変更検知用シグネチャ)
+
+Usage:
+    PYTHONPATH=. python src/core/parquet_export.py [--out DIR] [--tables daily_prices ...] [--full]
+"""
+import os
+import sys
+import json
+import time
+import zlib
+from datetime import datetime
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow は任意依存（エクスポート時のみ必要）
+    pa = None
+    pq = None
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from src.core.db_manager import DB_PATH, get_readonly_connection, get_metadata, get_snapshot_path
+
+DEFAULT_OUT_DIR = os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), 'parquet')
+STATE_FILE = '_export_state.json'
+
+# エクスポート対象テーブル
+EXPORT_TABLES = ['daily_prices', 'daily_financials', 'weekly_margin', 'daily_indices']
+
+# 1回のfetchmanyで読み込む行数
+BATCH_ROWS = 50_000
+
+
+def _arrow_type(decl_type: str):
+    """SQLiteの宣言型をArrowの型に対応付ける"""
+    decl = (decl_type or '').upper()
+    if 'INT' in decl:
+        return pa.int64()
+    if 'REAL' in decl or 'FLOA' in decl or 'DOUB' in decl:
+        return pa.float64()
+    return pa.string()
+
+
+def _table_columns(conn, table: str):
+    """
+    [(カラム名, 宣言型), ...] を返す
+
+    ビューの計算カラムは宣言型を持たないため、実データの typeof() から補う。
+    """
+    columns = []
+    for row in conn.execute(f"PRAGMA table_info({table})"):
+        name, decl = row[1], row[2]
+        if not decl:
+            sample = conn.execute(f'SELECT typeof("{name}") FROM {table} WHERE "{name}" IS NOT NULL LIMIT 1').fetchone()
+            decl = sample[0] if sample else 'REAL'
+        columns.append((name, decl))
+    return columns
+
+
+def _crc32(value) -> int:
+    """文字列カラムの変更検知用ハッシュ（SQLの関数として登録する）"""
+    if value is None:
+        return None
+    return zlib.crc32(str(value).encode('utf-8'))
+
+
+def _partition_signatures(conn, table: str, columns) -> dict:
+    """
+    月ごとの変更検知用シグネチャを計算する
+
+    行数と、数値カラムの合計値・文字列カラムのハッシュ (CRC32) の合計値を連結したもの。
+    INSERT OR REPLACE による値の書き換えや、銘柄名など文字列だけの変更も検知できる。
+
+    Returns:
+        {'YYYYMM': 'count:sum1:sum2...:hash1...', ...}
+    """
+    conn.create_function('crc32', 1, _crc32, deterministic=True)
+    numeric = [name for name, decl in columns if _arrow_type(decl) != pa.string()]
+    text = [name for name, decl in columns if _arrow_type(decl) == pa.string()]
+    sums = ''.join(f", TOTAL(\"{c}\")" for c in numeric)
+    # 整数の SUM で合計し、浮動小数の丸めで変化を取りこぼさないようにする
+    hashes = ''.join(f", COALESCE(SUM(crc32(\"{c}\")), 0)" for c in text)
+    query = f"SELECT substr(date, 1, 6) AS ym, COUNT(*){sums}{hashes} FROM {table} GROUP BY ym"
+    signatures = {}
+    for row in conn.execute(query):
+        if row[0] is None:
+            continue
+        values = row[2:2 + len(numeric)]
+        signatures[row[0]] = ':'.join([str(row[1])] + [f"{v:.6f}" for v in values]
+                                      + [str(v) for v in row[2 + len(numeric):]])
+    return signatures
+
+
+def _partition_path(out_dir: str, table: str, ym: str) -> str:
+    part_dir = os.path.join(out_dir, table, f"year={ym[:4]}", f"month={ym[4:]}")
+    os.makedirs(part_dir, exist_ok=True)
+    return os.path.join(part_dir, 'part-0.parquet')
+
+
+def _write_partitions(conn, table: str, columns, months: list, out_dir: str):
+    """
+    指定した月のパーティションを、日付順の1回の走査でストリーミングで書き出す
+
+    主キーは (code, date) のため、月ごとに WHERE date で絞ると月の数だけ全件走査になる。
+    対象の月の行を日付順にまとめて読み、月が変わるたびに書き出し先のファイルを切り替える。
+    各パーティションは一時ファイルに書き込んでから置き換えるため、読み手が書きかけのファイルを見ることはない。
+
+    Yields:
+        (YYYYMM, 書き出した行数)  パーティションを書き終えるたびに返す
+    """
+    schema = pa.schema([(name, _arrow_type(decl)) for name, decl in columns])
+    date_index = [name for name, _ in columns].index('date')
+    col_list = ', '.join(f'"{name}"' for name, _ in columns)
+    placeholders = ', '.join(['?'] * len(months))
+    cursor = conn.execute(
+        f"SELECT {col_list} FROM {table} WHERE substr(date, 1, 6) IN ({placeholders}) ORDER BY date, code",
+        months
+    )
+
+    current, writer, final_path, rows_written = None, None, None, 0
+
+    def write(rows):
+        arrays = [pa.array(values, type=field.type) for values, field in zip(zip(*rows), schema)]
+        writer.write_batch(pa.record_batch(arrays, schema=schema))
+
+    try:
+        while True:
+            rows = cursor.fetchmany(BATCH_ROWS)
+            if not rows:
+                break
+            start = 0
+            for i, row in enumerate(rows):
+                ym = row[date_index][:6]
+                if ym == current:
+                    continue
+                if writer is not None:
+                    if i > start:
+                        write(rows[start:i])
+                        rows_written += i - start
+                    writer.close()
+                    os.replace(final_path + '.tmp', final_path)
+                    yield current, rows_written
+                current, rows_written, start = ym, 0, i
+                final_path = _partition_path(out_dir, table, ym)
+                writer = pq.ParquetWriter(final_path + '.tmp', schema, compression='zstd')
+            write(rows[start:])
+            rows_written += len(rows) - start
+        if writer is not None:
+            writer.close()
+            writer = None
+            os.replace(final_path + '.tmp', final_path)
+            yield current, rows_written
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def _load_state(out_dir: str) -> dict:
+    path = os.path.join(out_dir, STATE_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _save_state(out_dir: str, state: dict):
+    path = os.path.join(out_dir, STATE_FILE)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def export_parquet(out_dir: str = DEFAULT_OUT_DIR, tables: list = None, full: bool = False) -> dict:
+    """
+    DBの日次系テーブルをParquetへ増分エクスポートする
+
+    Args:
+        out_dir: 出力先ディレクトリ
+        tables: 対象テーブル（デフォルト: EXPORT_TABLES）
+        full: Trueの場合、変更検知を無視して全パーティションを書き直す
+
+    Returns:
+        テーブルごとの結果 {table: {'partitions': 書き出した月数, 'rows': 行数}}
+    """
+    if pa is None:
+        raise RuntimeError("pyarrow がインストールされていません (pip install pyarrow)")
+
+    os.makedirs(out_dir, exist_ok=True)
+    state = {} if full else _load_state(out_dir)
+    summary = {}
+
+    # スナップショットが公開済みならそれを読む（バッチ途中の状態を書き出さない）
+    conn = get_readonly_connection(get_snapshot_path())
+    try:
+        # 分析エンジン (analytics.py) がDBと同じ版かを判定するために記録する
+        data_version = get_metadata(conn, 'data_version', '0')
+        for table in tables or EXPORT_TABLES:
+            started = time.time()
+            columns = _table_columns(conn, table)
+            if not columns:
+                print(f"  -> スキップ: {table} (テーブルが存在しません)")
+                continue
+
+            signatures = _partition_signatures(conn, table, columns)
+            previous = state.get(table, {})
+            changed = sorted(ym for ym, sig in signatures.items() if previous.get(ym) != sig)
+
+            total_rows = 0
+            for ym, rows in _write_partitions(conn, table, columns, changed, out_dir):
+                total_rows += rows
+                previous[ym] = signatures[ym]
+                # パーティション単位で状態を保存し、中断しても完了分は再実行しない
+                state[table] = previous
+                _save_state(out_dir, state)
+
+            # DBから消えた月（アーカイブ済みなど）のParquetは履歴として残す
+            summary[table] = {'partitions': len(changed), 'rows': total_rows}
+            print(f"  -> {table}: {len(changed)}/{len(signatures)} パーティション更新, "
+                  f"{total_rows}行 ({time.time() - started:.1f}秒)")
+    finally:
+        conn.close()
+
+    state['_exported_at'] = datetime.now().isoformat()
+    if set(tables or EXPORT_TABLES) == set(EXPORT_TABLES):
+        state['_data_version'] = data_version
+    _save_state(out_dir, state)
+    return summary
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Export stock database to partitioned Parquet')
+    parser.add_argument('--out', default=DEFAULT_OUT_DIR, help=f'Output directory (default: {DEFAULT_OUT_DIR})')
+    parser.add_argument('--tables', nargs='+', choices=EXPORT_TABLES, help='Tables to export (default: all)')
+    parser.add_argument('--full', action='store_true', help='Rewrite every partition')
+    args = parser.parse_args()
+
+    print(f"=== Parquetエクスポート開始: {args.out} ===")
+    try:
+        export_parquet(args.out, args.tables, args.full)
+    except RuntimeError as e:
+        print(f"❌ エラー: {e}")
+        sys.exit(1)
+    print("=== ✅ エクスポート完了 ===")
@@ -0,0 +1,185 @@
+"""
+データ版数 (data_version) に連動するクエリ結果キャッシュ
+
+株価・財務・騰落数などの読み取り関数は、次のバッチまで同じ引数に同じ結果を返す。
+cached_query を付けた関数の結果を、(関数名, 引数, data_version) をキーとして
+バイト数上限付きのLRUに保持する。バッチは完了時に db_metadata の data_version を進めるため、
+古い版のエントリは二度と参照されず、LRUから順に追い出される。
+
+DataFrame は内部の配列を書き込み禁止にしてから保持し、呼び出し側には深いコピーを返す。
+浅いコピーで配列を共有できるのは pandas 3 の Copy-on-Write 下だけで、pandas 2 では
+呼び出し側の df.loc[...] = ... が read-only エラーになるかキャッシュ上の値を書き換えてしまうため。
+呼び出し側はコピーを自由に書き換えてよく、キャッシュ上の値は変わらない。
+
+環境変数 STOCK_DB_CACHE_MB で上限 (MB) を変更できる（0 で無効）。
+
+Usage:
+    @cached_query
+    def get_stock_prices(code, ...): ...
+
+    get_query_cache().stats()   # {'hits', 'misses', 'hit_rate', 'bytes', 'entries', 'evictions', 'functions'}
+"""
+import os
+import sys
+import pickle
+import functools
+import threading
+from collections import OrderedDict
+
+# キャッシュ全体のバイト数上限（MB）
+DEFAULT_MAX_MB = 64
+
+
+def _estimate_size(value) -> int:
+    """値のおおよそのメモリ使用量（バイト）"""
+    try:
+        import pandas as pd
+        if isinstance(value, pd.DataFrame):
+            return int(value.memory_usage(index=True, deep=True).sum())
+        if isinstance(value, pd.Series):
+            return int(value.memory_usage(index=True, deep=True))
+    except ImportError:
+        pass
+    try:
+        return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return sys.getsizeof(value)
+
+
+def _freeze(value):
+    """DataFrame の内部配列を書き込み禁止にする"""
+    blocks = getattr(getattr(value, '_mgr', None), 'blocks', ())
+    for block in blocks:
+        values = getattr(block, 'values', None)
+        flags = getattr(values, 'flags', None)
+        if flags is not None:
+            flags.writeable = False
+    return value
+
+
+def _share(value):
+    """キャッシュ上の値を呼び出し側に渡す（DataFrame は深いコピー。pandas のバージョンによらず書き換えられる）"""
+    copy = getattr(value, 'copy', None)
+    if copy is not None and hasattr(value, '_mgr'):
+        return copy(deep=True)
+    return value
+
+
+class QueryCache:
+    """バイト数上限付きのLRUキャッシュ"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()   # key -> (value, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._functions = {}
+
+    def _count(self, name: str, hit: bool):
+        counts = self._functions.setdefault(name, {'hits': 0, 'misses': 0})
+        counts['hits' if hit else 'misses'] += 1
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def get(self, name: str, key):
+        """(見つかったか, 値) を返す"""
+        with self._lock:
+            entry = self._entries.get(key)
+            self._count(name, entry is not None)
+            if entry is None:
+                return False, None
+            self._entries.move_to_end(key)
+            return True, entry[0]
+
+    def put(self, key, value):
+        size = _estimate_size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        """ヒット率などの統計"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'functions': {name: dict(counts) for name, counts in self._functions.items()},
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_query_cache() -> QueryCache:
+    """プロセス共通のキャッシュ"""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                max_mb = float(os.getenv('STOCK_DB_CACHE_MB', DEFAULT_MAX_MB))
+                _cache = QueryCache(int(max_mb * 1024 * 1024))
+    return _cache
+
+
+def _data_version() -> str:
+    """読み取り先DB（スナップショット）の data_version"""
+    from src.core import db_manager
+    with db_manager.get_read_connection() as conn:
+        return db_manager.get_metadata(conn, 'data_version', '0')
+
+
+def cached_query(func):
+    """読み取り関数の結果を data_version 単位でキャッシュするデコレータ"""
+    name = func.__qualname__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        cache = get_query_cache()
+        if cache.max_bytes <= 0:
+            return func(*args, **kwargs)
+
+        key = (name, args, tuple(sorted(kwargs.items())), _data_version())
+        try:
+            hash(key)
+        except TypeError:
+            return func(*args, **kwargs)
+        found, value = cache.get(name, key)
+        if not found:
+            value = _freeze(func(*args, **kwargs))
+            cache.put(key, value)
+        return _share(value)
+
+    return wrapper
+
+
+def format_cache_stats(stats: dict) -> str:
+    """統計を1行に整形する"""
+    return (f"クエリキャッシュ: ヒット率 {stats['hit_rate']:.0%} ({stats['hits']}/{stats['hits'] + stats['misses']}), "
+            f"{stats['entries']}件 {stats['bytes'] / 1024 / 1024:.1f}/{stats['max_bytes'] / 1024 / 1024:.0f}MB, "
+            f"追い出し {stats['evictions']}件")
@@ -0,0 +1,320 @@
+"""
+SQLクエリプロファイラ（オプトイン）
+
+環境変数 STOCK_DB_PROFILE を設定すると、db_manager.get_connection() が返す接続が
+ProfilingConnection になり、db_manager / SupplyDemandAnalyzer / check_db が発行する
+全クエリについて以下を記録する。
+    - SQLのフィンガープリント（リテラルを ? に正規化した文のハッシュ）
+    - パラメータの形 (例: list[2], many[3809x9])
+    - 返却行数と実行時間（execute + fetch の合計）
+    - 初出時の EXPLAIN QUERY PLAN と、テーブルのフルスキャン有無
+
+集計結果はプロセス終了時に JSONL (既定: logs/query_profile.jsonl) へ追記する。
+STOCK_DB_PROFILE に .jsonl のパスを指定した場合はそのファイルへ出力する。
+
+Usage:
+    STOCK_DB_PROFILE=1 python test_pdf_generation.py 7203
+    PYTHONPATH=. python src/core/query_profiler.py summary [--file PATH] [--top 20]
+"""
+import os
+import re
+import sys
+import json
+import time
+import atexit
+import hashlib
+import sqlite3
+import threading
+from datetime import datetime
+
+DEFAULT_PROFILE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'logs', 'query_profile.jsonl')
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER_LIST = re.compile(r"\?(?:\s*,\s*\?)+")
+_WHITESPACE = re.compile(r"\s+")
+_FULL_SCAN = re.compile(r"^SCAN (?:TABLE )?(\S+)(.*)$")
+
+
+def normalize_sql(sql: str) -> str:
+    """リテラル・空白の違いを吸収した正規化SQL"""
+    text = _STRING_LITERAL.sub('?', sql)
+    text = _NUMBER_LITERAL.sub('?', text)
+    text = _PLACEHOLDER_LIST.sub('?+', text)
+    return _WHITESPACE.sub(' ', text).strip()
+
+
+def fingerprint(sql: str) -> str:
+    """正規化SQLのハッシュ（12桁）"""
+    return hashlib.sha1(normalize_sql(sql).encode('utf-8')).hexdigest()[:12]
+
+
+def params_shape(params, many: bool = False) -> str:
+    """パラメータの形を表す文字列（値そのものは記録しない）"""
+    if many:
+        width = len(params[0]) if params else 0
+        return f"many[{len(params)}x{width}]"
+    if params is None:
+        return "none"
+    if isinstance(params, dict):
+        return f"dict[{','.join(sorted(params))}]"
+    return f"{type(params).__name__}[{len(params)}]"
+
+
+class QueryProfiler:
+    """フィンガープリントごとのクエリ統計を集計する"""
+
+    def __init__(self, output_path: str = None):
+        self.output_path = output_path or DEFAULT_PROFILE_PATH
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    def _entry(self, fp: str, sql: str) -> dict:
+        entry = self.stats.get(fp)
+        if entry is None:
+            entry = {
+                'fingerprint': fp,
+                'sql': normalize_sql(sql),
+                'calls': 0,
+                'rows': 0,
+                'total_ms': 0.0,
+                'max_ms': 0.0,
+                'params_shapes': [],
+                'plan': None,
+                'full_scans': [],
+            }
+            self.stats[fp] = entry
+        return entry
+
+    def is_new(self, fp: str) -> bool:
+        with self._lock:
+            return fp not in self.stats
+
+    def record_execute(self, fp: str, sql: str, shape: str, elapsed: float, rows: int = 0):
+        with self._lock:
+            entry = self._entry(fp, sql)
+            entry['calls'] += 1
+            entry['rows'] += max(rows, 0)
+            ms = elapsed * 1000
+            entry['total_ms'] += ms
+            entry['max_ms'] = max(entry['max_ms'], ms)
+            entry['_last_ms'] = ms
+            if shape not in entry['params_shapes']:
+                entry['params_shapes'].append(shape)
+
+    def record_fetch(self, fp: str, elapsed: float, rows: int):
+        with self._lock:
+            entry = self.stats.get(fp)
+            if entry is not None:
+                entry['rows'] += rows
+                entry['total_ms'] += elapsed * 1000
+                # 直近の呼び出しの execute + fetch 合計で最大値を更新
+                entry['_last_ms'] = entry.get('_last_ms', 0.0) + elapsed * 1000
+                entry['max_ms'] = max(entry['max_ms'], entry['_last_ms'])
+
+    def record_plan(self, fp: str, sql: str, plan: list, full_scans: list):
+        with self._lock:
+            entry = self._entry(fp, sql)
+            entry['plan'] = plan
+            entry['full_scans'] = full_scans
+
+    def dump(self):
+        """集計結果をJSONLへ追記し、統計をリセットする"""
+        with self._lock:
+            if not self.stats:
+                return
+            entries = list(self.stats.values())
+            self.stats = {}
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.output_path)), exist_ok=True)
+        meta = {'pid': os.getpid(), 'dumped_at': datetime.now().isoformat(), 'argv': ' '.join(sys.argv)}
+        with open(self.output_path, 'a', encoding='utf-8') as f:
+            for entry in entries:
+                record = {k: v for k, v in entry.items() if not k.startswith('_')}
+                f.write(json.dumps({**meta, **record}, ensure_ascii=False) + '\n')
+
+
+_profiler = None
+_profiler_lock = threading.Lock()
+
+
+def get_profiler() -> QueryProfiler:
+    """プロセス共通のプロファイラ（初回呼び出し時に終了時ダンプを登録）"""
+    global _profiler
+    if _profiler is None:
+        with _profiler_lock:
+            if _profiler is None:
+                setting = os.getenv('STOCK_DB_PROFILE', '')
+                path = setting if setting.endswith('.jsonl') else None
+                _profiler = QueryProfiler(path)
+                atexit.register(_profiler.dump)
+    return _profiler
+
+
+def _explain(conn: sqlite3.Connection, sql: str, params):
+    """EXPLAIN QUERY PLAN の結果と、インデックスを使わないテーブル走査の一覧を返す"""
+    head = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else ''
+    if head not in ('SELECT', 'WITH'):
+        return None, []
+
+    # プロファイル対象外の素のカーソルで実行する
+    cur = sqlite3.Cursor(conn)
+    try:
+        tables = {row[0] for row in cur.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        plan_rows = cur.execute("EXPLAIN QUERY PLAN " + sql, params if params is not None else ()).fetchall()
+    except sqlite3.Error as e:
+        return [f"EXPLAIN failed: {e}"], []
+    finally:
+        cur.close()
+
+    plan, full_scans = [], []
+    for row in plan_rows:
+        detail = row[-1]
+        plan.append(detail)
+        m = _FULL_SCAN.match(detail)
+        if m and m.group(1) in tables and 'USING' not in m.group(2):
+            full_scans.append(m.group(1))
+    return plan, full_scans
+
+
+class ProfilingCursor(sqlite3.Cursor):
+    """実行時間・行数を QueryProfiler に記録するカーソル"""
+
+    _fp = None
+
+    def execute(self, sql, parameters=None):
+        profiler = get_profiler()
+        fp = fingerprint(sql)
+        if profiler.is_new(fp):
+            plan, full_scans = _explain(self.connection, sql, parameters)
+            profiler.record_plan(fp, sql, plan, full_scans)
+
+        started = time.perf_counter()
+        if parameters is None:
+            result = super().execute(sql)
+        else:
+            result = super().execute(sql, parameters)
+        # SELECT以外は rowcount が変更行数
+        affected = self.rowcount if self.description is None else 0
+        profiler.record_execute(fp, sql, params_shape(parameters), time.perf_counter() - started, affected)
+        self._fp = fp
+        return result
+
+    def executemany(self, sql, seq_of_parameters):
+        params = list(seq_of_parameters)
+        profiler = get_profiler()
+        fp = fingerprint(sql)
+        started = time.perf_counter()
+        result = super().executemany(sql, params)
+        profiler.record_execute(fp, sql, params_shape(params, many=True), time.perf_counter() - started, self.rowcount)
+        self._fp = fp
+        return result
+
+    def executescript(self, sql_script):
+        profiler = get_profiler()
+        fp = fingerprint(sql_script)
+        started = time.perf_counter()
+        result = super().executescript(sql_script)
+        profiler.record_execute(fp, sql_script, 'script', time.perf_counter() - started)
+        self._fp = fp
+        return result
+
+    def _timed_fetch(self, fetch, *args):
+        started = time.perf_counter()
+        rows = fetch(*args)
+        if self._fp is not None:
+            count = len(rows) if isinstance(rows, list) else int(rows is not None)
+            get_profiler().record_fetch(self._fp, time.perf_counter() - started, count)
+        return rows
+
+    def fetchone(self):
+        return self._timed_fetch(super().fetchone)
+
+    def fetchmany(self, size=None):
+        if size is None:
+            return self._timed_fetch(super().fetchmany)
+        return self._timed_fetch(super().fetchmany, size)
+
+    def fetchall(self):
+        return self._timed_fetch(super().fetchall)
+
+
+class ProfilingConnection(sqlite3.Connection):
+    """cursor() / execute() が ProfilingCursor を使う接続 (sqlite3.connect の factory 用)"""
+
+    def cursor(self, factory=ProfilingCursor):
+        return super().cursor(factory)
+
+    # sqlite3.Connection の execute 系は C 実装で内部のカーソルを使い、cursor() を経由しないため明示的に渡す
+    def execute(self, sql, parameters=None):
+        if parameters is None:
+            return self.cursor().execute(sql)
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+
+def load_profile(path: str) -> list:
+    """JSONLを読み込み、フィンガープリントごとに全プロセス分を合算する"""
+    merged = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            agg = merged.setdefault(entry['fingerprint'], {
+                'fingerprint': entry['fingerprint'], 'sql': entry['sql'], 'calls': 0, 'rows': 0,
+                'total_ms': 0.0, 'max_ms': 0.0, 'params_shapes': [], 'plan': None, 'full_scans': [],
+            })
+            agg['calls'] += entry['calls']
+            agg['rows'] += entry['rows']
+            agg['total_ms'] += entry['total_ms']
+            agg['max_ms'] = max(agg['max_ms'], entry['max_ms'])
+            agg['params_shapes'] = sorted(set(agg['params_shapes']) | set(entry['params_shapes']))
+            if entry.get('plan'):
+                agg['plan'] = entry['plan']
+                agg['full_scans'] = entry.get('full_scans', [])
+    return sorted(merged.values(), key=lambda e: e['total_ms'], reverse=True)
+
+
+def print_summary(path: str, top: int = 20, show_plans: bool = False):
+    """合計時間の降順でクエリ統計を表示する"""
+    if not os.path.exists(path):
+        print(f"❌ プロファイルが見つかりません: {path}")
+        return
+
+    entries = load_profile(path)
+    print(f"=== クエリプロファイル: {path} ({len(entries)}種類) ===")
+    print(f"{'total_ms':>10} {'calls':>6} {'avg_ms':>8} {'max_ms':>8} {'rows':>9}  scan  fingerprint   sql")
+    for e in entries[:top]:
+        avg = e['total_ms'] / e['calls'] if e['calls'] else 0.0
+        scan = 'FULL' if e['full_scans'] else '    '
+        sql = e['sql'] if len(e['sql']) <= 100 else e['sql'][:97] + '...'
+        print(f"{e['total_ms']:>10.1f} {e['calls']:>6} {avg:>8.2f} {e['max_ms']:>8.2f} {e['rows']:>9}  {scan}  {e['fingerprint']}  {sql}")
+        if show_plans and e['plan']:
+            for detail in e['plan']:
+                print(f"{'':>48}  └ {detail}")
+
+    scans = [e for e in entries if e['full_scans']]
+    if scans:
+        print(f"\n⚠️  フルスキャンを含むクエリ: {len(scans)}種類")
+        for e in scans:
+            print(f"  - {e['fingerprint']}: {', '.join(sorted(set(e['full_scans'])))}")
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='SQL query profiler summary')
+    sub = parser.add_subparsers(dest='command', required=True)
+    summary = sub.add_parser('summary', help='Show aggregated stats sorted by total time')
+    summary.add_argument('--file', default=DEFAULT_PROFILE_PATH, help='Profile JSONL path')
+    summary.add_argument('--top', type=int, default=20, help='Number of queries to show')
+    summary.add_argument('--plans', action='store_true', help='Show EXPLAIN QUERY PLAN for each query')
+    args = parser.parse_args()
+
+    print_summary(args.file, args.top, args.plans)
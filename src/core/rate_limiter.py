@@ -0,0 +1,108 @@
+"""
+ダウンロード用のレート制限とスループット計測
+
+TokenBucket は全ワーカーで共有し、1リクエストごとに1トークンを消費する。
+トークンは毎秒 rate 個ずつ（最大 burst 個まで）補充されるため、並列数によらず
+サーバーへのリクエスト数は平均 rate 件/秒に抑えられる。
+429 Too Many Requests を受けたら Retry-After の秒数だけバケット全体を停止し、全ワーカーが待つ。
+"""
+import time
+import threading
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+
+
+def parse_retry_after(value, default: float = 5.0) -> float:
+    """Retry-After ヘッダ（秒数 または HTTP日付）を待機秒数に変換する"""
+    if not value:
+        return default
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max((when - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+class TokenBucket:
+    """スレッド間で共有するトークンバケット"""
+
+    def __init__(self, rate: float, burst: int = None):
+        """
+        Args:
+            rate: 1秒あたりのリクエスト数（0以下で無制限）
+            burst: 連続して送れる最大リクエスト数（デフォルト: rate の切り上げ、最低1）
+        """
+        self.rate = rate
+        self.capacity = burst or max(int(rate + 0.999), 1)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+        self.waited = 0.0     # トークン待ち・停止で待った合計秒数（全ワーカー分）
+        self.paused = 0.0     # Retry-After による停止の合計秒数
+
+    def acquire(self):
+        """トークンを1つ取得する（無ければ補充・停止解除まで待つ）"""
+        if self.rate <= 0:
+            return
+        started = time.monotonic()
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    self.waited += now - started
+                    return
+                else:
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """seconds 秒間、全ワーカーのリクエストを止める（429 の Retry-After 用）"""
+        with self._lock:
+            until = time.monotonic() + seconds
+            if until > self._paused_until:
+                self.paused += until - max(self._paused_until, time.monotonic())
+                self._paused_until = until
+            # 再開直後に溜まったトークンで一斉に送らないようにする
+            self._tokens = 0.0
+
+
+class ThroughputStats:
+    """ダウンロードの件数・バイト数を集計する（スレッドセーフ）"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.requests = 0
+        self.files = 0
+        self.bytes = 0
+        self.not_found = 0
+        self.not_modified = 0
+        self.throttled = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def add(self, **counts):
+        with self._lock:
+            for key, value in counts.items():
+                setattr(self, key, getattr(self, key) + value)
+
+    def summary(self, limiter: TokenBucket = None) -> str:
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        text = (f"ダウンロード: {self.files}件 / {self.requests}リクエスト "
+                f"(304: {self.not_modified}, 404: {self.not_found}, 429: {self.throttled}, エラー: {self.errors}), "
+                f"{self.bytes / 1024 / 1024:.1f}MB, {elapsed:.1f}秒, "
+                f"実効 {self.bytes / 1024 / 1024 / elapsed:.2f}MB/s・{self.files / elapsed:.2f}件/s")
+        if limiter is not None and limiter.rate > 0:
+            text += f", 制限 {limiter.rate:g}件/s (429停止 {limiter.paused:.1f}秒)"
+        return text
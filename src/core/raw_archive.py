@@ -0,0 +1,259 @@
+"""
+株・プラスの生CSVアーカイブ
+
+ダウンロードしたCSVをgzip圧縮してローカルに保存し、レスポンスの ETag / Last-Modified を
+サイドカーJSONに残す。ローダは次回から条件付きGET (If-None-Match / If-Modified-Since) で再検証し、
+304 Not Modified ならアーカイブの内容を使う。
+CSVの解釈（カラム対応など）を直したときは、rebuild でアーカイブからDBを作り直せる（ネットワーク不要）。
+
+レイアウト:
+    data/raw/<dataset>/<YYYY>/<ファイル名>.csv.gz
+    data/raw/<dataset>/<YYYY>/<ファイル名>.csv.gz.json   (etag, last_modified, sha256, size, url, fetched_at)
+
+Usage:
+    PYTHONPATH=. python src/core/raw_archive.py status
+    PYTHONPATH=. python src/core/raw_archive.py rebuild [--from YYYYMMDD]
+"""
+import os
+import sys
+import gzip
+import json
+import time
+import hashlib
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from src.core.db_manager import DB_PATH
+
+# STOCK_RAW_DIR で置き場所を変えられる（シャードDBへのバックフィルでも本体と同じアーカイブを使うため）
+RAW_DIR = os.getenv('STOCK_RAW_DIR') or os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), 'raw')
+
+# gzip の圧縮レベル（CSVは6で十分に縮み、9との差は小さい）
+COMPRESS_LEVEL = 6
+
+
+def archive_path(dataset: str, filename: str, date_str: str, raw_dir: str = None) -> str:
+    """アーカイブのパス (data/raw/<dataset>/<YYYY>/<filename>.gz)"""
+    return os.path.join(raw_dir or RAW_DIR, dataset, date_str[:4], filename + '.gz')
+
+
+def save_raw(path: str, content: bytes, headers: dict = None, url: str = None) -> dict:
+    """
+    CSV本文を圧縮して保存し、検証用のメタデータをサイドカーJSONに書き込む
+
+    一時ファイルに書いてから置き換えるため、中断しても壊れたアーカイブは残らない。
+
+    Returns:
+        サイドカーに書き込んだメタデータ
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with gzip.open(tmp_path, 'wb', compresslevel=COMPRESS_LEVEL) as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+    headers = headers or {}
+    meta = {
+        'etag': headers.get('ETag'),
+        'last_modified': headers.get('Last-Modified'),
+        'sha256': hashlib.sha256(content).hexdigest(),
+        'size': len(content),
+        'url': url,
+        'fetched_at': datetime.now().isoformat(),
+    }
+    with open(path + '.json.tmp', 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    os.replace(path + '.json.tmp', path + '.json')
+    return meta
+
+
+def load_raw(path: str):
+    """アーカイブしたCSV本文（無ければ None）"""
+    if not os.path.exists(path):
+        return None
+    with gzip.open(path, 'rb') as f:
+        return f.read()
+
+
+def load_meta(path: str) -> dict:
+    """サイドカーのメタデータ（無ければ空）"""
+    try:
+        with open(path + '.json', 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def conditional_headers(path: str) -> dict:
+    """アーカイブ済みのファイルを再検証するためのリクエストヘッダ"""
+    if not os.path.exists(path):
+        return {}
+    meta = load_meta(path)
+    headers = {}
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+    return headers
+
+
+def list_archive(datasets: dict, start_date: str = None, end_date: str = None, raw_dir: str = None) -> list:
+    """
+    アーカイブ済みのファイルを日付順に列挙する
+
+    Args:
+        datasets: {dataset: ファイル名の接頭辞}
+
+    Returns:
+        [(date_str, dataset, path), ...]
+    """
+    entries = []
+    for dataset, prefix in datasets.items():
+        base = os.path.join(raw_dir or RAW_DIR, dataset)
+        if not os.path.isdir(base):
+            continue
+        for year in sorted(os.listdir(base)):
+            year_dir = os.path.join(base, year)
+            for name in os.listdir(year_dir):
+                if not (name.startswith(prefix + '_') and name.endswith('.csv.gz')):
+                    continue
+                date_str = name[len(prefix) + 1:-len('.csv.gz')]
+                if (start_date and date_str < start_date) or (end_date and date_str > end_date):
+                    continue
+                entries.append((date_str, dataset, os.path.join(year_dir, name)))
+    return sorted(entries)
+
+
+def archive_status(datasets: dict, raw_dir: str = None) -> dict:
+    """データセットごとのファイル数・圧縮後/元サイズ・期間"""
+    status = {}
+    for date_str, dataset, path in list_archive(datasets, raw_dir=raw_dir):
+        s = status.setdefault(dataset, {'files': 0, 'bytes': 0, 'raw_bytes': 0, 'first': date_str, 'last': date_str})
+        s['files'] += 1
+        s['bytes'] += os.path.getsize(path)
+        s['raw_bytes'] += load_meta(path).get('size') or 0
+        s['last'] = date_str
+    return status
+
+
+def _margin_rows_from(file_date: str) -> str:
+    """信用残ファイルが含むデータ日付の下限（公表日の前週金曜日 ≥ 公表日の7日前の翌日）"""
+    return (datetime.strptime(file_date, '%Y%m%d') - timedelta(days=6)).strftime('%Y%m%d')
+
+
+def rebuild_from_archive(start_date: str = None) -> dict:
+    """
+    アーカイブからDBの日次データを作り直す（ネットワーク不要）
+
+    アーカイブの範囲（データセットごとの最古日付、または start_date 以降）の行を削除し、日付・データセット順に
+    ローダと同じ変換・書き込み処理で入れ直す。それより古い行と分析履歴はそのまま残る。
+    財務指標の版は日付順に積み上げるため、範囲の終わりは常に最新のアーカイブまでとする。
+    全体を1トランザクションで行うため、途中で失敗した場合はDBは変わらない。
+
+    Returns:
+        {'files': 取り込んだファイル数, 'rows': 行数, 'bytes': 元のCSVサイズ合計, 'elapsed': 秒}
+    """
+    # ローダがこのモジュールを使うため、ここで読み込む
+    from src.core.batch_loader import DATASETS, DATASET_FILES
+    from src.core.db_manager import get_connection, create_tables, bump_version
+    from src.core.financial_versions import migrate_daily_financials
+    from src.core.ingest_manifest import record_ingest, content_hash, STATUS_DONE, STATUS_FAILED
+    from src.core.table_stats import load_table_stats, refresh_table_stats, format_table_stats
+    from src.core.snapshot import publish_snapshot
+
+    prefixes = {name: prefix for name, (_, prefix) in DATASET_FILES.items()}
+    entries = list_archive(prefixes, start_date)
+    if not entries:
+        print("❌ アーカイブが見つかりません")
+        return {'files': 0, 'rows': 0, 'bytes': 0, 'elapsed': 0.0}
+
+    first = {}
+    for date_str, dataset, _ in entries:
+        first.setdefault(dataset, date_str)
+    handlers = {name: (parse, store) for name, parse, store in DATASETS}
+    order = {name: i for i, (name, _, _) in enumerate(DATASETS)}
+    entries.sort(key=lambda e: (e[0], order[e[1]]))
+
+    started = time.time()
+    result = {'files': 0, 'rows': 0, 'bytes': 0}
+    conn = get_connection()
+    try:
+        create_tables(conn)
+        migrate_daily_financials(conn)
+        stats_before = load_table_stats(conn)
+
+        # 作り直す範囲の行を消す（財務指標は範囲内で始まる版を消し、範囲にかかる版を開いた状態に戻す）
+        if 'prices' in first:
+            conn.execute("DELETE FROM daily_prices WHERE date >= ?", (first['prices'],))
+        if 'financials' in first:
+            conn.execute("DELETE FROM financial_versions WHERE valid_from >= ?", (first['financials'],))
+            conn.execute("UPDATE financial_versions SET valid_to = NULL WHERE valid_to >= ?", (first['financials'],))
+        if 'margin' in first:
+            conn.execute("DELETE FROM weekly_margin WHERE date >= ?", (_margin_rows_from(first['margin']),))
+        if 'indices' in first:
+            conn.execute("DELETE FROM daily_indices WHERE date >= ?", (first['indices'],))
+
+        print(f"=== アーカイブから再構築: {entries[0][0]} ~ {entries[-1][0]} ({len(entries)}ファイル) ===")
+        current_date = None
+        for date_str, dataset, path in entries:
+            if date_str != current_date:
+                current_date = date_str
+                print(f"Rebuilding: {date_str}")
+            content = load_raw(path)
+            parse, store = handlers[dataset]
+            parse_started = time.perf_counter()
+            payload = parse(date_str, content)
+            parse_ms = (time.perf_counter() - parse_started) * 1000
+            counts = store(conn, date_str, payload) if payload is not None else None
+            row_count = sum(counts.values()) if counts is not None else None
+            status = STATUS_DONE if row_count is not None else STATUS_FAILED
+            record_ingest(conn, dataset, date_str, status, row_count, len(content), content_hash(content),
+                          None if row_count is not None else 'rebuild error', parse_ms)
+            result['files'] += 1
+            result['rows'] += row_count or 0
+            result['bytes'] += len(content)
+
+        bump_version(conn, 'data_version')
+        conn.commit()
+        result['elapsed'] = time.time() - started
+
+        print(f"\n--- 再構築: {result['files']}ファイル, {result['rows']:,}行, "
+              f"{result['bytes'] / 1024 / 1024:.1f}MB, {result['elapsed']:.1f}秒 "
+              f"({result['rows'] / max(result['elapsed'], 1e-9):,.0f}行/s) ---")
+        print("\n--- テーブル統計 ---")
+        for line in format_table_stats(refresh_table_stats(conn), stats_before):
+            print(f"  {line}")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    try:
+        publish_snapshot()
+    except Exception as e:
+        print(f"  -> エラー(スナップショット公開): {e}")
+    return result
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Raw Kabu+ CSV archive (status / offline rebuild)')
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('status', help='Show archived files per dataset')
+    rebuild = sub.add_parser('rebuild', help='Re-derive the database from the archive without network access')
+    rebuild.add_argument('--from', dest='start', help='First file date YYYYMMDD (default: oldest archived)')
+    args = parser.parse_args()
+
+    if args.command == 'status':
+        from src.core.batch_loader import DATASET_FILES
+        status = archive_status({name: prefix for name, (_, prefix) in DATASET_FILES.items()})
+        if not status:
+            print(f"  アーカイブがありません ({RAW_DIR})")
+        for dataset, s in status.items():
+            ratio = s['bytes'] / s['raw_bytes'] if s['raw_bytes'] else 0
+            print(f"  {dataset:<10} {s['files']:>5}ファイル {s['bytes'] / 1024 / 1024:>8.1f}MB "
+                  f"(元 {s['raw_bytes'] / 1024 / 1024:.1f}MB, {ratio:.0%})  {s['first']}〜{s['last']}")
+    else:
+        rebuild_from_archive(args.start)
@@ -0,0 +1,399 @@
+"""
+分割バックフィル（シャードDBへの並列取り込みと本体DBへのマージ）
+
+数年分の取り込みは、パイプライン化したローダでも SQLite の書き手が1つであることに律速される。
+ここでは期間を週の区切り（月曜日）で shards 個に分け、シャードごとに独立したローダのプロセス
+(batch_loader.py --backfill) を起動して別々のDBファイル (STOCK_DB_PATH) に書き込ませ、
+最後に本体DBへ ATTACH して集合演算の INSERT ... SELECT でマージする。
+
+    data/shards/<開始日>_<終了日>/shard_<n>_<開始日>_<終了日>.db   (シャードDB。ログは .log)
+
+    - 生CSVのアーカイブ (STOCK_RAW_DIR) は本体と共用し、サーバーへのリクエスト数の上限 rps はシャード間で分け合う
+    - シャードDBは残しておくため、中断したら同じ期間で再実行すれば各シャードが続きから取り込み、マージし直す
+    - マージは冪等: 日次データ・企業マスタ・取り込みマニフェストは主キーでの upsert（同じ行は書き込まない）、
+      財務指標の版 (financial_versions) は期間内の版を消してからシャードの版をつなぎ直す
+    - マージ後にテーブルごとの行数・チェックサム（数値カラムの合計）・差分行数をシャードと突き合わせて検証する
+
+財務指標の版は各シャードの初日に全銘柄の版が始まるため、シャードの境目で前の版と基礎値が変わっていなければ
+前の版に統合する（1つのローダで順に取り込んだ場合と同じ版の並びになる）。
+
+Usage:
+    PYTHONPATH=. python src/core/sharded_backfill.py run --from 20200101 --to 20251231 [--shards 4] [--rps 2]
+    PYTHONPATH=. python src/core/sharded_backfill.py merge --from 20200101 --to 20251231
+"""
+import os
+import sys
+import time
+import subprocess
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from src.core.db_manager import DB_PATH, get_connection, create_tables, bump_version
+from src.core.bulk_writer import merge_staging, format_counts
+from src.core.financial_versions import VERSION_COLUMNS, FUNDAMENTAL_COLUMNS, _is_changed, migrate_daily_financials
+from src.core.table_stats import load_table_stats, refresh_table_stats, format_table_stats, mark_ingested
+from src.core.raw_archive import RAW_DIR
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+SHARD_DIR = os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), 'shards')
+
+# シャードを取り込むローダのコマンド（この後に期間などの引数を付ける）
+LOADER_COMMAND = [sys.executable, os.path.join(REPO_ROOT, 'src', 'core', 'batch_loader.py')]
+
+DEFAULT_SHARDS = 4
+# マージ時に同時に ATTACH するため、SQLite の上限 (SQLITE_MAX_ATTACHED = 10) 未満に抑える
+MAX_SHARDS = 8
+# シャードの進み具合を確認する間隔（秒）
+POLL_INTERVAL = 5.0
+
+# 主キーで upsert するテーブル（マージの順）。企業マスタは古いシャードから順に上書きし、最新の名称を残す
+MERGE_TABLES = {
+    'companies': ['code'],
+    'daily_prices': ['code', 'date'],
+    'weekly_margin': ['code', 'date'],
+    'daily_indices': ['code', 'date'],
+    'ingest_manifest': ['dataset', 'file_date'],
+}
+
+
+def split_ranges(start_date: str, end_date: str, shards: int) -> list:
+    """
+    期間を週の区切り（月曜日）で shards 個以下に分ける（信用残の週が複数のシャードにまたがらないようにする）
+
+    Returns:
+        [(開始日, 終了日), ...] (YYYYMMDD)
+    """
+    start = datetime.strptime(start_date, '%Y%m%d')
+    end = datetime.strptime(end_date, '%Y%m%d')
+    days = (end - start).days + 1
+    step = -(-days // max(shards, 1))
+
+    ranges, current = [], start
+    while current <= end:
+        boundary = current + timedelta(days=step)
+        boundary += timedelta(days=(7 - boundary.weekday()) % 7)   # 次の月曜日まで延ばす
+        last = min(boundary - timedelta(days=1), end)
+        ranges.append((current.strftime('%Y%m%d'), last.strftime('%Y%m%d')))
+        current = last + timedelta(days=1)
+    return ranges
+
+
+def shard_paths(start_date: str, end_date: str, shards: int, shard_dir: str = None) -> list:
+    """[(開始日, 終了日, シャードDBのパス), ...]"""
+    base = os.path.join(shard_dir or SHARD_DIR, f"{start_date}_{end_date}")
+    return [(a, b, os.path.join(base, f"shard_{i}_{a}_{b}.db"))
+            for i, (a, b) in enumerate(split_ranges(start_date, end_date, shards))]
+
+
+def run_shards(shards: list, workers: int = 2, rps: float = 2.0, parse_workers: int = None) -> bool:
+    """
+    シャードごとにローダのプロセスを起動し、全て終わるまで待つ
+
+    Args:
+        shards: shard_paths() の結果
+        workers: シャードあたりのダウンロードスレッド数
+        rps: 全シャード合計のリクエスト数の上限（シャード数で等分する）
+        parse_workers: シャードあたりの解析プロセス数（既定: CPU数をシャード数で割った数 - 1）
+
+    Returns:
+        全シャードが正常終了したか
+    """
+    if parse_workers is None:
+        parse_workers = max((os.cpu_count() or 1) // len(shards) - 1, 0)
+    shard_rps = rps / len(shards) if rps > 0 else 0
+
+    env = dict(os.environ, STOCK_RAW_DIR=RAW_DIR, PYTHONPATH=REPO_ROOT)
+    running = []
+    for start, end, path in shards:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        command = LOADER_COMMAND + ['--from', start, '--to', end, '--backfill', '--no-snapshot',
+                                    '--workers', str(workers), '--rps', f"{shard_rps:g}",
+                                    '--parse-workers', str(parse_workers)]
+        log = open(path[:-len('.db')] + '.log', 'a', encoding='utf-8')
+        process = subprocess.Popen(command, env=dict(env, STOCK_DB_PATH=path), stdout=log,
+                                   stderr=subprocess.STDOUT, cwd=REPO_ROOT)
+        running.append((start, end, path, process, log, time.time()))
+        print(f"  -> シャード起動: {start} ~ {end} (pid {process.pid}, {os.path.basename(path)})")
+
+    ok = True
+    try:
+        while running:
+            time.sleep(POLL_INTERVAL)
+            for entry in list(running):
+                start, end, path, process, log, started = entry
+                if process.poll() is None:
+                    continue
+                log.close()
+                running.remove(entry)
+                status = "✅" if process.returncode == 0 else f"❌ (終了コード {process.returncode})"
+                ok = ok and process.returncode == 0
+                print(f"  -> シャード完了: {start} ~ {end} {status} ({time.time() - started:.0f}秒)")
+    except BaseException:
+        # 中断時は残りのシャードも止める（シャードDBは最後にコミットした日付まで残り、次回はそこから再開する）
+        for _, _, _, process, log, _ in running:
+            process.terminate()
+            process.wait()
+            log.close()
+        raise
+    return ok
+
+
+def _columns(conn, table: str) -> list:
+    return [row[1] for row in conn.execute(f"PRAGMA main.table_info({table})")]
+
+
+def _version_dict(row) -> dict:
+    return dict(zip(VERSION_COLUMNS, row))
+
+
+def stitch_financial_versions(conn, aliases: list, start_date: str, end_date: str) -> dict:
+    """
+    シャードの財務指標の版を本体の版とつなぎ直す（コミットは呼び出し側）
+
+    期間内に始まる本体の版を消し、期間の直前の版 + シャードの版（日付順）+ 期間後の最初の版 を銘柄ごとに並べて、
+    基礎値が変わっていない隣の版を統合し、各版の valid_to を次の版の開始日に揃える。
+
+    Returns:
+        {'versions': 書き込んだ版数, 'merged': 境目で統合した版数}
+    """
+    cols = ', '.join(VERSION_COLUMNS)
+    conn.execute("DELETE FROM main.financial_versions WHERE valid_from >= ? AND valid_from <= ?", (start_date, end_date))
+
+    # 期間の直前の版（期間にかかっていた版）と、期間後の最初の版の開始日
+    prefix = {row[0]: _version_dict(row) for row in conn.execute(f"""
+        SELECT {cols} FROM main.financial_versions f
+        WHERE valid_from < ? AND (valid_to IS NULL OR valid_to >= ?)
+          AND valid_from = (SELECT MAX(valid_from) FROM main.financial_versions WHERE code = f.code AND valid_from < ?)
+    """, (start_date, start_date, start_date))}
+    suffix = dict(conn.execute("""
+        SELECT code, MIN(valid_from) FROM main.financial_versions WHERE valid_from > ? GROUP BY code
+    """, (end_date,)).fetchall())
+
+    chains, closes = {}, {}
+    for alias in aliases:
+        for row in conn.execute(f"""
+            SELECT {cols} FROM {alias}.financial_versions
+            WHERE valid_from >= ? AND valid_from <= ? ORDER BY code, valid_from
+        """, (start_date, end_date)):
+            chains.setdefault(row[0], []).append(_version_dict(row))
+        closes.update(((code, date), close) for code, date, close in conn.execute(f"""
+            SELECT p.code, p.date, p.close FROM {alias}.daily_prices p
+            JOIN {alias}.financial_versions f ON f.code = p.code AND f.valid_from = p.date
+        """))
+
+    inserts, updates, merged = [], [], 0
+    for code in set(chains) | set(prefix):
+        kept = [prefix[code]] if code in prefix else []
+        for version in chains.get(code, []):
+            # 1つのローダで順に取り込んだ場合と同じく、直前の版と基礎値が変わっていなければ版を増やさない
+            if kept and not _is_changed(kept[-1], {c: version[c] for c in FUNDAMENTAL_COLUMNS},
+                                        closes.get((code, version['valid_from']))):
+                merged += 1
+                continue
+            kept.append(version)
+        for i, version in enumerate(kept):
+            version['valid_to'] = kept[i + 1]['valid_from'] if i + 1 < len(kept) else suffix.get(code)
+        if code in prefix:
+            updates.append((kept[0]['valid_to'], code, kept[0]['valid_from']))
+            kept = kept[1:]
+        inserts.extend(tuple(v[c] for c in VERSION_COLUMNS) for v in kept)
+
+    conn.executemany("UPDATE main.financial_versions SET valid_to = ? WHERE code = ? AND valid_from = ?", updates)
+    conn.executemany(f"INSERT INTO main.financial_versions ({cols}) VALUES ({', '.join(['?'] * len(VERSION_COLUMNS))})",
+                     inserts)
+    return {'versions': len(inserts), 'merged': merged}
+
+
+def carry_ingested_dates(conn, aliases: list) -> dict:
+    """
+    シャードの table_stats から最終取り込み日を本体に引き継ぐ（本体より古い日付では戻さない。コミットは呼び出し側）
+
+    Returns:
+        {テーブル名: シャード中の最新の取り込み日}
+    """
+    latest = {}
+    for alias in aliases:
+        for table, date_str in conn.execute(f"""
+            SELECT table_name, MAX(last_ingested_date) FROM {alias}.table_stats
+            WHERE last_ingested_date IS NOT NULL GROUP BY table_name
+        """):
+            latest[table] = max(latest.get(table, ''), date_str)
+    for table, date_str in latest.items():
+        mark_ingested(conn, table, date_str)
+    return latest
+
+
+def _signature(conn, table: str, columns: list, source: str, keys: list = None) -> tuple:
+    """行数と数値カラムの合計（keys を指定すると、source のキーに一致する本体の行について数える）"""
+    numeric = [c for c, decl in ((row[1], row[2]) for row in conn.execute(f"PRAGMA main.table_info({table})"))
+               if decl.upper() in ('REAL', 'INTEGER') and c in columns]
+    sums = ''.join(f", TOTAL(t.\"{c}\")" for c in numeric)
+    if keys:
+        join = ' AND '.join(f't."{k}" = s."{k}"' for k in keys)
+        row = conn.execute(f"SELECT COUNT(*){sums} FROM main.{table} t JOIN {source}.{table} s ON {join}").fetchone()
+    else:
+        row = conn.execute(f"SELECT COUNT(*){sums} FROM {source}.{table} t").fetchone()
+    return (row[0],) + tuple(round(v, 6) for v in row[1:])
+
+
+def verify_merge(conn, aliases: list, ranges: list) -> bool:
+    """
+    マージ結果をシャードと突き合わせる
+
+        日次データ・マニフェスト: シャードごとに 行数・チェックサム（数値カラムの合計）が一致し、本体と異なる行が無いこと
+        企業マスタ:               最後のシャードの行が本体と一致すること
+        財務指標の版:             銘柄ごとに現行の版が1つで、版の期間が途切れず、daily_financials の行数がシャードと一致すること
+    """
+    ok = True
+
+    def report(label: str, passed: bool, detail: str):
+        nonlocal ok
+        ok = ok and passed
+        print(f"  {'✅' if passed else '❌'} {label:<32} {detail}")
+
+    for table, keys in MERGE_TABLES.items():
+        columns = ', '.join(f'"{c}"' for c in _columns(conn, table))
+        targets = aliases[-1:] if table == 'companies' else aliases
+        for alias in targets:
+            diff = conn.execute(f"""
+                SELECT COUNT(*) FROM (SELECT {columns} FROM {alias}.{table} EXCEPT SELECT {columns} FROM main.{table})
+            """).fetchone()[0]
+            expected = _signature(conn, table, _columns(conn, table), alias)
+            actual = _signature(conn, table, _columns(conn, table), alias, keys)
+            report(f"{table} ({alias})", diff == 0 and expected == actual,
+                   f"{expected[0]:,}行 / 本体 {actual[0]:,}行, 差分 {diff}行, "
+                   f"チェックサム{'一致' if expected[1:] == actual[1:] else '不一致'}")
+
+    open_versions = conn.execute("""
+        SELECT COUNT(*) FROM (SELECT code FROM main.financial_versions WHERE valid_to IS NULL GROUP BY code HAVING COUNT(*) > 1)
+    """).fetchone()[0]
+    gaps = conn.execute("""
+        SELECT COUNT(*) FROM main.financial_versions f
+        WHERE valid_to IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM main.financial_versions n WHERE n.code = f.code AND n.valid_from = f.valid_to)
+    """).fetchone()[0]
+    report("financial_versions", open_versions == 0 and gaps == 0,
+           f"現行の版が複数の銘柄 {open_versions}, 途切れた版 {gaps}")
+    for alias, (start, end) in zip(aliases, ranges):
+        query = "SELECT COUNT(*) FROM {db}.daily_financials WHERE date >= ? AND date <= ?"
+        # シャードのビューは本体の接続からは参照できないため、シャード側の行数は版と株価の結合で数える
+        expected = conn.execute(f"""
+            SELECT COUNT(*) FROM {alias}.daily_prices p JOIN {alias}.financial_versions f
+              ON f.code = p.code AND f.valid_from <= p.date AND (f.valid_to IS NULL OR p.date < f.valid_to)
+            WHERE p.date >= ? AND p.date <= ?
+        """, (start, end)).fetchone()[0]
+        actual = conn.execute(query.format(db='main'), (start, end)).fetchone()[0]
+        report(f"daily_financials ({alias})", expected == actual, f"{expected:,}行 / 本体 {actual:,}行")
+    return ok
+
+
+def merge_shards(shards: list) -> bool:
+    """
+    シャードDBを本体DBにマージして検証し、スナップショットを公開する（何度実行しても同じ結果になる）
+
+    Returns:
+        検証に通ったか
+    """
+    from src.core.snapshot import publish_snapshot
+
+    shards = [(a, b, path) for a, b, path in shards if os.path.exists(path)]
+    if not shards:
+        print("❌ シャードDBが見つかりません")
+        return False
+    start_date, end_date = shards[0][0], shards[-1][1]
+    aliases = [f"shard_{i}" for i in range(len(shards))]
+
+    print(f"=== シャードのマージ: {start_date} ~ {end_date} ({len(shards)}シャード) ===")
+    started = time.time()
+    conn = get_connection()
+    try:
+        create_tables(conn)
+        migrate_daily_financials(conn)
+        conn.commit()
+        stats_before = load_table_stats(conn)
+        # ATTACH はトランザクションの外で行う必要がある
+        for alias, (_, _, path) in zip(aliases, shards):
+            conn.execute("ATTACH DATABASE ? AS " + alias, (path,))
+
+        changed = False
+        for table, keys in MERGE_TABLES.items():
+            columns = _columns(conn, table)
+            total = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+            for alias in aliases:
+                counts = merge_staging(conn, table, f"{alias}.{table}", columns, keys)
+                for key, value in counts.items():
+                    total[key] += value
+            changed = changed or total['inserted'] > 0 or total['updated'] > 0
+            if table == 'companies' and (total['inserted'] or total['updated']):
+                bump_version(conn, 'companies_version')
+            print(f"  -> {table}: {format_counts(total)}")
+
+        versions = stitch_financial_versions(conn, aliases, start_date, end_date)
+        print(f"  -> financial_versions: {versions['versions']:,}版 (シャードの境目で統合 {versions['merged']:,}版)")
+        carry_ingested_dates(conn, aliases)
+
+        # 財務指標の版はつなぎ直すたびに書き込むため、データ版数は常に進める
+        bump_version(conn, 'data_version')
+        conn.commit()
+        print(f"  -> マージ完了 ({time.time() - started:.1f}秒)")
+
+        print("\n--- 検証 ---")
+        ok = verify_merge(conn, aliases, [(a, b) for a, b, _ in shards])
+
+        print("\n--- テーブル統計 ---")
+        for line in format_table_stats(refresh_table_stats(conn), stats_before):
+            print(f"  {line}")
+        conn.commit()
+        for alias in aliases:
+            conn.execute(f"DETACH DATABASE {alias}")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    if ok:
+        try:
+            publish_snapshot()
+        except Exception as e:
+            print(f"  -> エラー(スナップショット公開): {e}")
+    print(f"=== {'✅ 検証OK' if ok else '❌ 検証NG'} ===")
+    return ok
+
+
+def run_sharded_backfill(start_date: str, end_date: str, shards: int = DEFAULT_SHARDS, workers: int = 2,
+                         rps: float = 2.0, parse_workers: int = None) -> bool:
+    """期間をシャードに分けて並列に取り込み、本体DBにマージする"""
+    shards = min(max(shards, 1), MAX_SHARDS)
+    plan = shard_paths(start_date, end_date, shards)
+    print(f"=== 分割バックフィル: {start_date} ~ {end_date} ({len(plan)}シャード, 合計 {rps:g}件/s) ===")
+    started = time.time()
+    if not run_shards(plan, workers, rps, parse_workers):
+        print("❌ 失敗したシャードがあります（ログを確認し、同じ期間で再実行すると続きから取り込みます）")
+        return False
+    print(f"  -> 全シャード完了 ({time.time() - started:.0f}秒)\n")
+    return merge_shards(plan)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Sharded parallel backfill into per-range databases with a verified merge')
+    sub = parser.add_subparsers(dest='command', required=True)
+    run = sub.add_parser('run', help='Load each shard in its own process, then merge into the main database')
+    merge = sub.add_parser('merge', help='Merge (again) the existing shard databases for a range')
+    for p in (run, merge):
+        p.add_argument('--from', dest='start', required=True, help='First date YYYYMMDD')
+        p.add_argument('--to', dest='end', required=True, help='Last date YYYYMMDD')
+        p.add_argument('--shards', type=int, default=DEFAULT_SHARDS,
+                       help=f'Number of shards, at most {MAX_SHARDS} (default: {DEFAULT_SHARDS})')
+    run.add_argument('--workers', type=int, default=2, help='Download threads per shard (default: 2)')
+    run.add_argument('--rps', type=float, default=2.0, help='Total max requests per second over all shards (default: 2)')
+    run.add_argument('--parse-workers', type=int, default=None, help='Parser processes per shard (default: CPUs / shards - 1)')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        ok = run_sharded_backfill(args.start, args.end, args.shards, args.workers, args.rps, args.parse_workers)
+    else:
+        ok = merge_shards(shard_paths(args.start, args.end, min(max(args.shards, 1), MAX_SHARDS)))
+    sys.exit(0 if ok else 1)
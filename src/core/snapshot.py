@@ -0,0 +1,136 @@
+"""
+ブルー/グリーン方式のDBスナップショット公開
+
+バッチは本体DB (data/stock_data.db) を書き込み用のステージングとして更新し、
+完了後に SQLite のオンラインバックアップAPIで不変のスナップショットを作成して公開する。
+公開は current シンボリックリンクの付け替え (os.replace) で行うため原子的で、
+Botは常に「ある1日分のバッチが完了した状態」のDBだけを読む。
+
+    data/snapshots/stock_data_YYYYMMDD_HHMMSS.db   (公開後は変更しない)
+    data/snapshots/current -> stock_data_YYYYMMDD_HHMMSS.db
+
+読み手はジョブの合間に db_manager.bind_thread_snapshot() で最新版へ切り替える。
+切り替え前の版を読んでいるジョブのために、直近 DEFAULT_KEEP 世代は削除せずに残す。
+
+Usage:
+    PYTHONPATH=. python src/core/snapshot.py publish [--keep 3]
+    PYTHONPATH=. python src/core/snapshot.py status
+"""
+import os
+import sys
+import glob
+import time
+import sqlite3
+from datetime import datetime
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from src.core.db_manager import (
+    SNAPSHOT_DIR, SNAPSHOT_LINK, get_connection, get_snapshot_path, set_metadata,
+)
+
+# 残しておくスナップショットの世代数（current を含む）
+DEFAULT_KEEP = 3
+# バックアップ1ステップでコピーするページ数（ステップ間で書き手に譲る）
+BACKUP_STEP_PAGES = 4096
+
+
+def _list_snapshots() -> list:
+    """公開済みスナップショットのパス（古い順）"""
+    return sorted(glob.glob(os.path.join(SNAPSHOT_DIR, 'stock_data_*.db')))
+
+
+def _swap_link(target_name: str):
+    """current リンクを原子的に付け替える"""
+    tmp_link = SNAPSHOT_LINK + '.tmp'
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(target_name, tmp_link)
+    os.replace(tmp_link, SNAPSHOT_LINK)
+
+
+def prune_snapshots(keep: int = DEFAULT_KEEP) -> list:
+    """古いスナップショットを削除する（current が指す版は常に残す）"""
+    current = get_snapshot_path()
+    snapshots = _list_snapshots()
+    removed = []
+    for path in snapshots[:max(len(snapshots) - keep, 0)]:
+        if current and os.path.samefile(path, current):
+            continue
+        # 削除済みのファイルでも、開いたままの接続は読み続けられる
+        os.remove(path)
+        removed.append(path)
+    return removed
+
+
+def publish_snapshot(keep: int = DEFAULT_KEEP) -> str:
+    """
+    本体DBのスナップショットを作成し、current として公開する
+
+    Args:
+        keep: 残しておく世代数
+
+    Returns:
+        公開したスナップショットのパス
+    """
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    started = time.time()
+    published_at = datetime.now()
+    name = f"stock_data_{published_at.strftime('%Y%m%d_%H%M%S')}.db"
+    final_path = os.path.join(SNAPSHOT_DIR, name)
+    tmp_path = final_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    src = get_connection()
+    dst = sqlite3.connect(tmp_path)
+    try:
+        src.backup(dst, pages=BACKUP_STEP_PAGES)
+        data_date = dst.execute("SELECT MAX(date) FROM daily_prices").fetchone()[0]
+        set_metadata(dst, 'snapshot_published_at', published_at.isoformat())
+        set_metadata(dst, 'snapshot_data_date', data_date)
+        # 読み手は immutable で開くため、WALを持たない単一ファイルにしておく
+        dst.execute("PRAGMA journal_mode=DELETE")
+        dst.commit()
+    except Exception:
+        dst.close()
+        os.remove(tmp_path)
+        raise
+    finally:
+        src.close()
+    dst.close()
+
+    os.replace(tmp_path, final_path)
+    _swap_link(name)
+    removed = prune_snapshots(keep)
+
+    size_mb = os.path.getsize(final_path) / 1024 / 1024
+    print(f"  -> スナップショット公開: {name} (データ日付 {data_date}, {size_mb:.1f}MB, "
+          f"{time.time() - started:.1f}秒, 削除 {len(removed)}件)")
+    return final_path
+
+
+def snapshot_status():
+    """公開中のスナップショットと保持している世代を表示する"""
+    current = get_snapshot_path()
+    if current is None:
+        print("スナップショットは未公開です（Botは本体DBを直接読みます）")
+        return
+    for path in _list_snapshots():
+        mark = '*' if os.path.samefile(path, current) else ' '
+        print(f" {mark} {os.path.basename(path)}  {os.path.getsize(path) / 1024 / 1024:.1f}MB")
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Publish read-only database snapshots for the bot')
+    sub = parser.add_subparsers(dest='command', required=True)
+    publish = sub.add_parser('publish', help='Back up the main DB and swap the current snapshot')
+    publish.add_argument('--keep', type=int, default=DEFAULT_KEEP, help=f'Snapshots to keep (default: {DEFAULT_KEEP})')
+    sub.add_parser('status', help='Show published snapshots')
+    args = parser.parse_args()
+
+    if args.command == 'publish':
+        publish_snapshot(args.keep)
+    else:
+        snapshot_status()
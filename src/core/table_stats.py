@@ -0,0 +1,145 @@
+"""
+テーブル統計 (table_stats)
+
+check_db や run_batch_update.sh が状態確認のたびに COUNT(*) / MAX(date) で全件走査しないよう、
+バッチ完了時にテーブルごとの行数・最古/最新日付を table_stats に記録する。
+ローダは各データセットの取り込みに成功するたびに最終取り込み日 (last_ingested_date) を更新する。
+DB/WALのファイルサイズは db_metadata (db_size_bytes / wal_size_bytes) に記録する。
+
+読み手 (check_db, Botの /dbstatus) は table_stats を読むだけなので、DBの大きさによらず一定時間で返る。
+
+Usage:
+    PYTHONPATH=. python src/core/table_stats.py refresh
+    PYTHONPATH=. python src/core/table_stats.py show
+"""
+import os
+import sys
+import sqlite3
+from datetime import datetime
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from src.core.db_manager import DB_PATH, get_connection, get_metadata, set_metadata
+
+# 統計を取るテーブルと、最古/最新の判定に使う日付カラム
+STATS_TABLES = {
+    'companies': None,
+    'daily_prices': 'date',
+    'financial_versions': 'valid_from',
+    'weekly_margin': 'date',
+    'daily_indices': 'date',
+    'analysis_history': 'analyzed_at',
+}
+
+STATS_COLUMNS = ['table_name', 'row_count', 'min_date', 'max_date', 'last_ingested_date', 'updated_at']
+
+
+def mark_ingested(conn: sqlite3.Connection, table: str, date_str: str):
+    """データセットの最終取り込み日を更新する（過去日の再取り込みでは戻さない。コミットは呼び出し側）"""
+    conn.execute("""
+        INSERT INTO table_stats (table_name, last_ingested_date, updated_at) VALUES (?, ?, ?)
+        ON CONFLICT(table_name) DO UPDATE SET
+            last_ingested_date = MAX(COALESCE(last_ingested_date, ''), excluded.last_ingested_date)
+    """, (table, date_str, datetime.now().isoformat()))
+
+
+def load_table_stats(conn: sqlite3.Connection) -> dict:
+    """
+    記録済みの統計を読み込む（table_stats 未作成の旧DBでは空）
+
+    Returns:
+        {'tables': {table: {row_count, min_date, ...}}, 'db_size': int, 'wal_size': int, 'updated_at': str}
+    """
+    try:
+        rows = conn.execute(f"SELECT {', '.join(STATS_COLUMNS)} FROM table_stats ORDER BY table_name").fetchall()
+    except sqlite3.OperationalError:
+        rows = []
+    return {
+        'tables': {row[0]: dict(zip(STATS_COLUMNS, row)) for row in rows},
+        'db_size': int(get_metadata(conn, 'db_size_bytes', 0)),
+        'wal_size': int(get_metadata(conn, 'wal_size_bytes', 0)),
+        'updated_at': get_metadata(conn, 'table_stats_updated_at'),
+    }
+
+
+def refresh_table_stats(conn: sqlite3.Connection, tables: list = None) -> dict:
+    """
+    行数・最古/最新日付を数え直して table_stats に書き込む（バッチの最後に1回だけ実行する）
+
+    Returns:
+        更新後の統計 (load_table_stats と同じ形式)
+    """
+    now = datetime.now().isoformat()
+    existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    for table in tables or STATS_TABLES:
+        if table not in existing:
+            continue
+        date_col = STATS_TABLES.get(table)
+        if date_col:
+            row_count, min_date, max_date = conn.execute(
+                f"SELECT COUNT(*), MIN({date_col}), MAX({date_col}) FROM {table}"
+            ).fetchone()
+        else:
+            row_count, min_date, max_date = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0], None, None
+        conn.execute("""
+            INSERT INTO table_stats (table_name, row_count, min_date, max_date, updated_at) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(table_name) DO UPDATE SET
+                row_count = excluded.row_count, min_date = excluded.min_date,
+                max_date = excluded.max_date, updated_at = excluded.updated_at
+        """, (table, row_count, min_date, max_date, now))
+
+    wal_path = DB_PATH + '-wal'
+    set_metadata(conn, 'db_size_bytes', os.path.getsize(DB_PATH) if os.path.exists(DB_PATH) else 0)
+    set_metadata(conn, 'wal_size_bytes', os.path.getsize(wal_path) if os.path.exists(wal_path) else 0)
+    set_metadata(conn, 'table_stats_updated_at', now)
+    conn.commit()
+    return load_table_stats(conn)
+
+
+def _fmt_size(size: int) -> str:
+    return f"{size / 1024 / 1024:.1f}MB"
+
+
+def format_table_stats(stats: dict, before: dict = None) -> list:
+    """
+    統計を表示用の行に整形する
+
+    Args:
+        before: 比較対象の統計（指定するとテーブルごとの増減を付ける）
+    """
+    if not stats['tables']:
+        return ["統計が未作成です（バッチ完了時、または table_stats.py refresh で作成されます）"]
+
+    lines = []
+    for table, s in stats['tables'].items():
+        count = f"{s['row_count']:,}行" if s['row_count'] is not None else '-'
+        if before is not None:
+            prev = before['tables'].get(table, {}).get('row_count') or 0
+            count += f" ({(s['row_count'] or 0) - prev:+,})"
+        period = f" {s['min_date']}〜{s['max_date']}" if s['max_date'] else ''
+        ingested = f" 最終取込 {s['last_ingested_date']}" if s['last_ingested_date'] else ''
+        lines.append(f"{table}: {count}{period}{ingested}")
+    lines.append(f"DB: {_fmt_size(stats['db_size'])}, WAL: {_fmt_size(stats['wal_size'])} (集計 {stats['updated_at']})")
+    return lines
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Maintain and show the table_stats summary')
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('refresh', help='Recount rows and date ranges (full scan)')
+    sub.add_parser('show', help='Show recorded stats')
+    args = parser.parse_args()
+
+    conn = get_connection()
+    try:
+        if args.command == 'refresh':
+            before = load_table_stats(conn)
+            stats = refresh_table_stats(conn)
+            lines = format_table_stats(stats, before)
+        else:
+            lines = format_table_stats(load_table_stats(conn))
+        for line in lines:
+            print(f"  {line}")
+    finally:
+        conn.close()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# src.core.* を PYTHONPATH 無しで読み込めるようにする
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
@@ -0,0 +1,58 @@
+import sqlite3
+
+import pytest
+
+from src.core import archive
+from src.core.archive import MAX_ATTACHED_YEARS, attach_archives
+from src.core.db_manager import create_tables
+
+YEARS = list(range(2010, 2010 + MAX_ATTACHED_YEARS + 3))
+
+
+@pytest.fixture
+def conn(tmp_path, monkeypatch):
+    monkeypatch.setattr(archive, 'ARCHIVE_DIR', str(tmp_path / 'archive'))
+    (tmp_path / 'archive').mkdir()
+    for year in YEARS:
+        arc = sqlite3.connect(archive.archive_path(year))
+        create_tables(arc)
+        arc.executemany("INSERT INTO daily_prices (code, date, close) VALUES (?, ?, ?)",
+                        [('1301', f'{year}0105', float(year)), ('1332', f'{year}0105', float(year))])
+        arc.commit()
+        arc.close()
+
+    conn = sqlite3.connect(str(tmp_path / 'stock.db'))
+    create_tables(conn)
+    conn.execute("INSERT INTO daily_prices (code, date, close) VALUES ('1301', '20250602', 2025.0)")
+    conn.commit()
+    yield conn
+    conn.close()
+
+
+def _attached(conn):
+    return [row[1] for row in conn.execute("PRAGMA database_list") if row[1].startswith('arc_')]
+
+
+def test_attach_more_years_than_the_limit(conn):
+    years = attach_archives(conn, tables=['daily_prices'], code='1301')
+
+    assert years == YEARS
+    assert len(_attached(conn)) < MAX_ATTACHED_YEARS
+    dates = [row[0] for row in conn.execute(
+        "SELECT date FROM daily_prices_all WHERE code = '1301' ORDER BY date")]
+    assert dates == [f'{year}0105' for year in YEARS] + ['20250602']
+
+
+def test_overflow_without_code_copies_all_rows(conn):
+    attach_archives(conn, tables=['daily_prices'])
+
+    assert conn.execute("SELECT COUNT(*) FROM daily_prices_all").fetchone()[0] == len(YEARS) * 2 + 1
+
+
+def test_attach_only_the_requested_years(conn):
+    attach_archives(conn, tables=['daily_prices'])
+    years = attach_archives(conn, '20120101', tables=['daily_prices'], end_date='20131231')
+
+    assert years == [2012, 2013]
+    assert _attached(conn) == ['arc_2012', 'arc_2013']
+    assert conn.execute("SELECT COUNT(*) FROM daily_prices_all").fetchone()[0] == 5
@@ -0,0 +1,67 @@
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.core.bulk_writer import PRICE_COLUMNS, bulk_upsert
+from src.core.db_manager import create_tables
+
+
+def _prices(rows):
+    return pd.DataFrame(rows, columns=PRICE_COLUMNS)
+
+
+ROWS = [
+    ('1301', '20250602', 100.0, 110.0, 95.0, 105.0, 1000.0, 105000.0, np.nan),
+    ('1332', '20250602', 500.0, 510.0, 490.0, 505.0, 2000.0, 1010000.0, 3.0e9),
+    ('1333', '20250602', 300.0, 300.0, 300.0, 300.0, 0.0, 0.0, 1.0e9),
+]
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(':memory:')
+    create_tables(conn)
+    yield conn
+    conn.close()
+
+
+def _stored(conn):
+    return conn.execute(f"SELECT {', '.join(PRICE_COLUMNS)} FROM daily_prices ORDER BY code").fetchall()
+
+
+def test_insert_then_identical_reimport(conn):
+    assert bulk_upsert(conn, 'daily_prices', _prices(ROWS), PRICE_COLUMNS) == \
+        {'inserted': 3, 'updated': 0, 'unchanged': 0}
+    conn.commit()
+    # NaN は NULL として格納される
+    assert _stored(conn)[0] == ROWS[0][:-1] + (None,)
+
+    assert bulk_upsert(conn, 'daily_prices', _prices(ROWS), PRICE_COLUMNS) == \
+        {'inserted': 0, 'updated': 0, 'unchanged': 3}
+    assert len(_stored(conn)) == 3
+
+
+def test_changed_rows_are_updated(conn):
+    bulk_upsert(conn, 'daily_prices', _prices(ROWS), PRICE_COLUMNS)
+    conn.commit()
+
+    changed = [
+        # NULL → 値
+        ROWS[0][:-1] + (2.0e9,),
+        # 値 → NULL (NaN)
+        ROWS[1][:-1] + (np.nan,),
+        # 変化なし
+        ROWS[2],
+        # 新規
+        ('1334', '20250602', 50.0, 55.0, 45.0, 52.0, 10.0, 520.0, np.nan),
+    ]
+    assert bulk_upsert(conn, 'daily_prices', _prices(changed), PRICE_COLUMNS) == \
+        {'inserted': 1, 'updated': 2, 'unchanged': 1}
+    assert [row[-1] for row in _stored(conn)] == [2.0e9, None, 1.0e9, None]
+
+    changed_close = [ROWS[2][:5] + (301.0,) + ROWS[2][6:]]
+    assert bulk_upsert(conn, 'daily_prices', _prices(changed_close), PRICE_COLUMNS) == \
+        {'inserted': 0, 'updated': 1, 'unchanged': 0}
+    assert _stored(conn)[2][5] == 301.0
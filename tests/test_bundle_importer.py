@@ -0,0 +1,62 @@
+import io
+import os
+import zipfile
+
+from src.core.bundle_importer import BundleReader, scan_bundles
+
+
+def _zip_bytes(files: dict, compression=zipfile.ZIP_DEFLATED) -> bytes:
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', compression) as zf:
+        for name, content in files.items():
+            zf.writestr(name, content)
+    return buf.getvalue()
+
+
+def _bundle(tmp_path):
+    stored = _zip_bytes({'japan-all-stock-prices-2_20250602.csv': b'stored-0602',
+                         'japan-all-stock-prices-2_20250603.csv': b'stored-0603'})
+    deflated = _zip_bytes({'japan-all-stock-prices-2_20250604.csv': b'deflated-0604' * 100})
+    path = tmp_path / 'bundle.zip'
+    with zipfile.ZipFile(path, 'w') as zf:
+        zf.writestr(zipfile.ZipInfo('2025/stored.zip'), stored, compress_type=zipfile.ZIP_STORED)
+        zf.writestr(zipfile.ZipInfo('2025/deflated.zip'), deflated, compress_type=zipfile.ZIP_DEFLATED)
+        zf.writestr('japan-all-stock-prices-2_20250605.csv', b'top-0605')
+    return str(path)
+
+
+def test_nested_zips_are_read_without_loading_them_whole(tmp_path):
+    path = _bundle(tmp_path)
+    reader = BundleReader()
+    members = scan_bundles([path], reader=reader)
+
+    assert sorted(date for _, date in members) == ['20250602', '20250603', '20250604', '20250605']
+    stored_chain = (path, '2025/stored.zip')
+    deflated_chain = (path, '2025/deflated.zip')
+    # 無圧縮の入れ子は外側のファイルの範囲を開き、圧縮された入れ子だけ一時ファイルに書き出す
+    assert deflated_chain in reader._spilled and stored_chain not in reader._spilled
+    spilled = reader._spilled[deflated_chain]
+
+    reader.expect(members.values())
+    contents = {date: reader.read(location) for (_, date), location in sorted(members.items())}
+
+    assert contents == {'20250602': b'stored-0602', '20250603': b'stored-0603',
+                        '20250604': b'deflated-0604' * 100, '20250605': b'top-0605'}
+    # 読み終えた入れ子のZIPは閉じて一時ファイルを消す
+    assert not os.path.exists(spilled)
+    assert set(reader._opened) == {(path,)}
+    reader.close()
+    assert reader._opened == {}
+
+
+def test_unexpected_nested_zip_is_released(tmp_path):
+    path = _bundle(tmp_path)
+    reader = BundleReader()
+    members = scan_bundles([path], reader=reader)
+    spilled = reader._spilled[(path, '2025/deflated.zip')]
+
+    reader.expect([location for (_, date), location in members.items() if date == '20250605'])
+
+    assert not os.path.exists(spilled)
+    assert set(reader._opened) == {(path,)}
+    reader.close()
@@ -0,0 +1,42 @@
+import os
+import sqlite3
+
+from src.core.db_maintenance import run_checkpoint, run_incremental_vacuum
+from src.core.db_manager import create_tables
+
+
+def _open(path):
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+
+def test_new_database_uses_incremental_auto_vacuum(tmp_path):
+    conn = _open(str(tmp_path / 'stock.db'))
+    create_tables(conn)
+
+    assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    conn.executemany("INSERT INTO daily_prices (code, date, close) VALUES (?, ?, ?)",
+                     [(str(code), '20250602', 1.0) for code in range(5000)])
+    conn.commit()
+    conn.execute("DELETE FROM daily_prices")
+    conn.commit()
+    assert run_incremental_vacuum(conn, budget=5.0, incremental=False) > 0
+    conn.close()
+
+
+def test_incremental_checkpoint_truncates_wal(tmp_path):
+    path = str(tmp_path / 'stock.db')
+    conn = _open(path)
+    create_tables(conn)
+    conn.executemany("INSERT INTO daily_prices (code, date, close) VALUES (?, ?, ?)",
+                     [(str(code), '20250602', 1.0) for code in range(1000)])
+    conn.commit()
+    assert os.path.getsize(path + '-wal') > 0
+
+    checkpoint = run_checkpoint(conn, incremental=True)
+
+    assert checkpoint['mode'] == 'PASSIVE+TRUNCATE'
+    assert checkpoint['busy'] == 0
+    assert os.path.getsize(path + '-wal') == 0
+    conn.close()
@@ -0,0 +1,33 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+pytest.importorskip('discord')
+
+from src.bot import discord_bot  # noqa: E402
+from src.core import db_manager  # noqa: E402
+from src.core.async_db import AsyncDB  # noqa: E402
+
+
+def test_client_close_flushes_queued_history(tmp_path, monkeypatch):
+    path = str(tmp_path / 'stock.db')
+    conn = sqlite3.connect(path)
+    db_manager.create_tables(conn)
+    conn.close()
+    monkeypatch.setattr(db_manager, 'DB_PATH', path)
+    db = AsyncDB()
+    monkeypatch.setattr(discord_bot, 'db', db)
+
+    async def scenario():
+        client = discord_bot.StockBotClient(intents=discord_bot.intents)
+        await db.start()
+        await db.log_analysis_history('7203', 'トヨタ自動車', 'user#0001')
+        await client.close()
+
+    asyncio.run(scenario())
+
+    conn = sqlite3.connect(path)
+    assert conn.execute("SELECT stock_code, user_name FROM analysis_history").fetchall() == [('7203', 'user#0001')]
+    conn.close()
+    assert db._writer._shutdown
@@ -0,0 +1,81 @@
+import sqlite3
+
+import pytest
+
+from src.core.db_manager import create_tables
+from src.core.financial_versions import FIN_COLUMNS, migrate_daily_financials
+
+# (code, date, market_cap, shares_outstanding, per_forecast, pbr_actual, eps_forecast, bps_actual,
+#  dividend_yield, min_investment)
+LEGACY_ROWS = [
+    ('1305', '20250611', 1000.0, 1000000.0, 10.0, 1.0, 100.0, 1000.0, 1.83, 100000.0),
+    ('1305', '20250612', 1003.0, 1000000.0, 10.03, 1.0, 100.0, 1000.0, 1.83, 100300.0),
+    # 株価の行が無く、基礎値 (EPS) が変わった日
+    ('1305', '20250613', 1003.0, 1000000.0, 8.36, 1.0, 120.0, 1000.0, 1.83, 100300.0),
+]
+PRICES = [
+    ('1305', '20250611', 1000.0),
+    ('1305', '20250612', 1003.0),
+]
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(':memory:')
+    conn.execute("CREATE TABLE daily_financials ({})".format(', '.join(FIN_COLUMNS)))
+    conn.executemany("INSERT INTO daily_financials VALUES ({})".format(', '.join('?' * len(FIN_COLUMNS))),
+                     LEGACY_ROWS)
+    create_tables(conn)
+    conn.executemany("INSERT INTO daily_prices (code, date, close) VALUES (?, ?, ?)", PRICES)
+    conn.commit()
+    yield conn
+    conn.close()
+
+
+def _object_type(conn, name):
+    row = conn.execute("SELECT type FROM sqlite_master WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else None
+
+
+def test_create_tables_does_not_migrate(conn):
+    assert _object_type(conn, 'daily_financials') == 'table'
+    assert conn.execute("SELECT COUNT(*) FROM financial_versions").fetchone()[0] == 0
+
+
+def test_migration_keeps_legacy_table(conn):
+    result = migrate_daily_financials(conn)
+
+    assert result == {'source_rows': 3, 'versions': 2}
+    assert _object_type(conn, 'daily_financials') == 'view'
+    assert _object_type(conn, 'daily_financials_legacy') == 'table'
+    assert conn.execute("SELECT COUNT(*) FROM daily_financials_legacy").fetchone()[0] == 3
+    assert migrate_daily_financials(conn) is None
+
+
+def test_view_returns_anchor_values(conn):
+    migrate_daily_financials(conn)
+    rows = conn.execute("""
+        SELECT date, per_forecast, dividend_yield, eps_forecast FROM daily_financials
+        WHERE code = '1305' ORDER BY date
+    """).fetchall()
+
+    # 版の開始日はCSVの値、それ以外の日は終値からの再計算値（配当利回りは丸めで 1.83 → 1.84 にずれうる）
+    assert rows[0] == ('20250611', 10.0, 1.83, 100.0)
+    assert rows[1][0] == '20250612'
+    assert rows[1][1] == 10.03
+    assert rows[1][2] == 1.82
+    # 株価の行が無い版の開始日もアンカー値で返す
+    assert rows[2] == ('20250613', 8.36, 1.83, 120.0)
+
+
+def test_migration_prefers_existing_versions(conn):
+    conn.execute("""
+        INSERT INTO financial_versions (code, valid_from, eps_forecast, per_forecast)
+        VALUES ('1305', '20250612', 110.0, 9.12)
+    """)
+    migrate_daily_financials(conn)
+
+    versions = conn.execute("""
+        SELECT valid_from, valid_to, eps_forecast FROM financial_versions WHERE code = '1305' ORDER BY valid_from
+    """).fetchall()
+    assert versions == [('20250611', '20250612', 100.0), ('20250612', None, 110.0)]
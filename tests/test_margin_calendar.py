@@ -0,0 +1,22 @@
+from src.core.ingest_manifest import STATUS_DONE, STATUS_NOT_FOUND
+from src.core.margin_calendar import probe_days
+
+
+def _entry(file_date, status, updated_at='2025-07-01T00:00:00'):
+    return {'file_date': file_date, 'status': status, 'updated_at': updated_at}
+
+
+def test_probe_days_after_confirmed_miss():
+    manifest = {
+        # 2025-06-02 の週: 2営業日目が 404 確定、3営業日目も 404 確定
+        ('margin', '20250603'): _entry('20250603', STATUS_NOT_FOUND),
+        ('margin', '20250604'): _entry('20250604', STATUS_NOT_FOUND),
+        # 2025-06-09 の週: 取り込み済み
+        ('margin', '20250610'): _entry('20250610', STATUS_NOT_FOUND),
+        ('margin', '20250611'): _entry('20250611', STATUS_DONE),
+        # 2025-06-16 の週: 当日の 404 は公表前かもしれないので確定扱いしない
+        ('margin', '20250617'): _entry('20250617', STATUS_NOT_FOUND, '2025-06-17T18:00:00'),
+    }
+
+    assert probe_days(manifest, '20250601', '20250630') == ['20250605', '20250606']
+    assert probe_days(manifest, '20250601', '20250605') == ['20250605']
@@ -0,0 +1,61 @@
+import sqlite3
+
+import pytest
+
+pq = pytest.importorskip('pyarrow.parquet')
+
+from src.core import parquet_export  # noqa: E402
+from src.core.db_manager import create_tables  # noqa: E402
+
+DATES = ['20250530', '20250602', '20250630', '20250701']
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    path = str(tmp_path / 'stock.db')
+    conn = sqlite3.connect(path)
+    create_tables(conn)
+    conn.executemany("INSERT INTO daily_prices (code, date, close) VALUES (?, ?, ?)",
+                     [(code, date, float(i)) for i, date in enumerate(DATES) for code in ('1332', '1301')])
+    conn.executemany("INSERT INTO daily_indices (code, name, date, close) VALUES (?, ?, ?, ?)",
+                     [('0000', '日経平均', date, 100.0) for date in DATES])
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(parquet_export, 'get_snapshot_path', lambda: path)
+    return path
+
+
+def _read(out_dir, table, ym):
+    return pq.read_table(str(out_dir / table / f"year={ym[:4]}" / f"month={ym[4:]}" / 'part-0.parquet')).to_pylist()
+
+
+def test_export_writes_each_month_in_one_pass(db_path, tmp_path, monkeypatch):
+    # 月の境目が fetchmany のバッチの途中・境目に来る場合も確認する
+    monkeypatch.setattr(parquet_export, 'BATCH_ROWS', 3)
+    out_dir = tmp_path / 'parquet'
+    summary = parquet_export.export_parquet(str(out_dir), ['daily_prices'])
+
+    assert summary == {'daily_prices': {'partitions': 3, 'rows': 8}}
+    june = _read(out_dir, 'daily_prices', '202506')
+    assert [(r['date'], r['code']) for r in june] == [
+        ('20250602', '1301'), ('20250602', '1332'), ('20250630', '1301'), ('20250630', '1332'),
+    ]
+    assert len(_read(out_dir, 'daily_prices', '202505')) == 2
+    assert len(_read(out_dir, 'daily_prices', '202507')) == 2
+
+    assert parquet_export.export_parquet(str(out_dir), ['daily_prices']) == \
+        {'daily_prices': {'partitions': 0, 'rows': 0}}
+
+
+def test_text_only_change_marks_partition_dirty(db_path, tmp_path):
+    out_dir = tmp_path / 'parquet'
+    parquet_export.export_parquet(str(out_dir), ['daily_indices'])
+
+    conn = sqlite3.connect(db_path)
+    conn.execute("UPDATE daily_indices SET name = '日経225' WHERE date = '20250630'")
+    conn.commit()
+    conn.close()
+
+    assert parquet_export.export_parquet(str(out_dir), ['daily_indices']) == \
+        {'daily_indices': {'partitions': 1, 'rows': 2}}
+    assert [r['name'] for r in _read(out_dir, 'daily_indices', '202506')] == ['日経平均', '日経225']
@@ -0,0 +1,29 @@
+import pandas as pd
+import pytest
+
+from src.core import query_cache
+from src.core.query_cache import QueryCache, cached_query
+
+
+@pytest.fixture(autouse=True)
+def cache(monkeypatch):
+    cache = QueryCache(1024 * 1024)
+    monkeypatch.setattr(query_cache, '_cache', cache)
+    monkeypatch.setattr(query_cache, '_data_version', lambda: '1')
+    return cache
+
+
+@cached_query
+def _margin(code):
+    return pd.DataFrame({'Ratio': [1.0, 2.0, 3.0]})
+
+
+def test_callers_can_modify_cached_frames(cache):
+    first = _margin('1301')
+    first.loc[first['Ratio'] > 1.5, 'Ratio'] = 0.0
+
+    second = _margin('1301')
+    assert cache.hits == 1
+    assert second['Ratio'].tolist() == [1.0, 2.0, 3.0]
+    second.loc[:, 'Ratio'] = 9.0
+    assert _margin('1301')['Ratio'].tolist() == [1.0, 2.0, 3.0]
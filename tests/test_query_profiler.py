@@ -0,0 +1,46 @@
+import sqlite3
+
+import pytest
+
+from src.core import query_profiler
+from src.core.query_profiler import ProfilingConnection, QueryProfiler, fingerprint
+
+
+@pytest.fixture
+def profiler(tmp_path, monkeypatch):
+    profiler = QueryProfiler(str(tmp_path / 'profile.jsonl'))
+    monkeypatch.setattr(query_profiler, '_profiler', profiler)
+    return profiler
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(':memory:', factory=ProfilingConnection)
+    conn.execute("CREATE TABLE t (code TEXT PRIMARY KEY, value REAL)")
+    yield conn
+    conn.close()
+
+
+def test_connection_execute_is_recorded(profiler, conn):
+    sql = "SELECT code, value FROM t WHERE code = ?"
+    conn.executemany("INSERT INTO t VALUES (?, ?)", [('1301', 1.0), ('1332', 2.0)])
+    rows = conn.execute(sql, ('1301',)).fetchall()
+
+    assert rows == [('1301', 1.0)]
+    entry = profiler.stats[fingerprint(sql)]
+    assert entry['calls'] == 1
+    assert entry['rows'] == 1
+    assert entry['params_shapes'] == ['tuple[1]']
+    assert entry['plan']
+
+    insert = profiler.stats[fingerprint("INSERT INTO t VALUES (?, ?)")]
+    assert insert['params_shapes'] == ['many[2x2]']
+    assert insert['rows'] == 2
+
+
+def test_connection_execute_without_parameters_and_script(profiler, conn):
+    conn.execute("SELECT COUNT(*) FROM t").fetchone()
+    conn.executescript("CREATE TABLE u (x); DROP TABLE u;")
+
+    assert profiler.stats[fingerprint("SELECT COUNT(*) FROM t")]['params_shapes'] == ['none']
+    assert profiler.stats[fingerprint("CREATE TABLE u (x); DROP TABLE u;")]['params_shapes'] == ['script']
@@ -0,0 +1,88 @@
+import sqlite3
+
+import pytest
+
+from src.core.db_manager import create_tables
+from src.core.financial_versions import VERSION_COLUMNS, apply_daily_financials
+from src.core.sharded_backfill import carry_ingested_dates, stitch_financial_versions
+from src.core.table_stats import mark_ingested
+
+# 日付ごとの (code, close, eps_forecast)。1301 は期間中に EPS が変わり、1332 は変わらない
+DAYS = {
+    '20250602': [('1301', 1000.0, 100.0), ('1332', 500.0, 50.0)],
+    '20250603': [('1301', 1010.0, 100.0), ('1332', 505.0, 50.0)],
+    '20250604': [('1301', 1020.0, 120.0), ('1332', 510.0, 50.0)],
+    '20250605': [('1301', 1030.0, 120.0), ('1332', 515.0, 50.0)],
+}
+SHARD_RANGES = [('20250602', '20250603'), ('20250604', '20250605')]
+
+
+def _load(path, dates):
+    conn = sqlite3.connect(path)
+    create_tables(conn)
+    for date_str in dates:
+        rows = DAYS[date_str]
+        conn.executemany("INSERT INTO daily_prices (code, date, close) VALUES (?, ?, ?)",
+                         [(code, date_str, close) for code, close, _ in rows])
+        apply_daily_financials(conn, date_str, [
+            (code, date_str, close * 1000 / 1e6, 1000.0, round(close / eps, 2), None, eps, None,
+             round(15.0 / close * 100, 2), close * 100)
+            for code, close, eps in rows
+        ])
+        for table in ('daily_prices', 'financial_versions'):
+            mark_ingested(conn, table, date_str)
+    conn.commit()
+    return conn
+
+
+def _chain(conn):
+    cols = ', '.join(VERSION_COLUMNS)
+    return conn.execute(f"SELECT {cols} FROM main.financial_versions ORDER BY code, valid_from").fetchall()
+
+
+@pytest.fixture
+def merged(tmp_path):
+    aliases = []
+    for i, (start, end) in enumerate(SHARD_RANGES):
+        path = str(tmp_path / f'shard_{i}.db')
+        _load(path, [d for d in DAYS if start <= d <= end]).close()
+        aliases.append((f'shard_{i}', path))
+
+    conn = _load(str(tmp_path / 'main.db'), [])
+    for alias, path in aliases:
+        conn.execute("ATTACH DATABASE ? AS " + alias, (path,))
+    yield conn, [alias for alias, _ in aliases]
+    conn.close()
+
+
+def test_stitch_is_idempotent(merged, tmp_path):
+    conn, aliases = merged
+    start_date, end_date = SHARD_RANGES[0][0], SHARD_RANGES[-1][1]
+
+    first = stitch_financial_versions(conn, aliases, start_date, end_date)
+    conn.commit()
+    chain = _chain(conn)
+    second = stitch_financial_versions(conn, aliases, start_date, end_date)
+    conn.commit()
+
+    assert first == second
+    assert first['merged'] == 1
+    assert _chain(conn) == chain
+    # 1つのローダで順に取り込んだ場合と同じ版になる
+    plain = _load(str(tmp_path / 'plain.db'), list(DAYS))
+    assert chain == _chain(plain)
+    assert [(row[0], row[1], row[2]) for row in chain] == [
+        ('1301', '20250602', '20250604'), ('1301', '20250604', None), ('1332', '20250602', None),
+    ]
+    plain.close()
+
+
+def test_carry_ingested_dates(merged):
+    conn, aliases = merged
+    mark_ingested(conn, 'daily_prices', '20250613')
+    conn.commit()
+
+    assert carry_ingested_dates(conn, aliases) == {'daily_prices': '20250605', 'financial_versions': '20250605'}
+    dates = dict(conn.execute("SELECT table_name, last_ingested_date FROM table_stats").fetchall())
+    # 本体の方が新しい場合は戻さない
+    assert dates == {'daily_prices': '20250613', 'financial_versions': '20250605'}
@@ -0,0 +1,331 @@
+"""
+株・プラスのローカル代替サーバー（オフラインでの取り込みベンチマーク・障害注入用）
+
+株・プラス (csvex.com) と同じURL構成でCSVを配信するHTTPサーバー。ローダの接続先を環境変数
+KABU_PLUS_BASE_URL で切り替えると、認証情報もネットワークも無い環境で取り込みの速度と耐障害性を再現よく測れる。
+
+    <ベースURL>japan-all-stock-prices-2/daily/japan-all-stock-prices-2_YYYYMMDD.csv
+    <ベースURL>tosho-stock-margin-transactions-2/weekly/tosho-stock-margin-transactions-2_YYYYMMDD.csv  など
+
+    - ベーシック認証 (--user / --password、既定は .env の KABU_PLUS_USER / KABU_PLUS_PASSWORD)
+    - 合成データ: 日付ごとに決まった内容（同じ日付には毎回同じCSV）。休場日と信用残の非公表日は 404
+      （--margin-offset で信用残の公表日を週の別の営業日にずらせる）
+    - 記録データ: --archive に生CSVのアーカイブ (data/raw) を指定すると、その内容を配信する（無い日付は 404）
+    - ETag / Last-Modified を返し、条件付きGETには 304 で応える
+    - 遅延 (--latency / --jitter) と、リクエストごとの確率での 404 / 429 / 500 / 本文の途中切断を注入できる
+    - GET /_stats でステータスごとの応答数を返す（認証不要）
+
+Usage:
+    PYTHONPATH=. python tools/kabuplus_stub_server.py [--port 8765] [--latency 50] [--rate-429 0.05] [--seed 1]
+    KABU_PLUS_BASE_URL=http://127.0.0.1:8765/ PYTHONPATH=. python src/core/batch_loader.py --from 20250601 --to 20250630
+"""
+import os
+import re
+import sys
+import json
+import time
+import base64
+import random
+import hashlib
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src.core.batch_loader import DATASET_FILES, KABU_PLUS_USER, KABU_PLUS_PASSWORD
+from src.core.margin_calendar import is_market_day, is_publication_day
+from src.core.raw_archive import archive_path, load_raw
+
+ENCODING = 'cp932'
+
+# 合成データの銘柄数（全銘柄のファイルと同程度）と指数の数
+DEFAULT_CODES = 3800
+DEFAULT_INDICES = 60
+
+# 実際のCSVと同じヘッダー（ローダが読まないカラムも含む）
+PRICE_HEADER = ("SC,名称,市場,業種,日付,株価,前日比,前日比（％）,前日終値,始値,高値,安値,VWAP,出来高,出来高率,"
+                "売買代金（千円）,時価総額（百万円）,値幅下限,値幅上限,高値日付,年初来高値,年初来高値乖離率,安値日付,年初来安値,年初来安値乖離率")
+FINANCIAL_HEADER = ("SC,名称,市場,業種,時価総額（百万円）,発行済株式数,配当利回り（予想）,1株配当（予想）,PER（予想）,PBR（実績）,"
+                    "EPS（予想）,BPS（実績）,最低購入額,単元株,高値日付,年初来高値,安値日付,年初来安値,最低投資金額")
+MARGIN_HEADER = ("SC,公表日,信用取引区分,信用売残,信用売残 前週比,信用買残,信用買残 前週比,貸借倍率,"
+                 "制度信用売残,制度信用売残 前週比,制度信用買残,制度信用買残 前週比,"
+                 "一般信用売残,一般信用売残 前週比,一般信用買残,一般信用買残 前週比")
+INDEX_HEADER = ("SC,指数名,日付,終値,前日比,前日比（％）,前日終値,時価総額（指数用・浮動株ベース）,時価総額前日比（同左）,"
+                "前日時価総額（同左）,平均時価総額（同左）,基準時価総額,銘柄数,売買単位換算後株式数")
+
+MARKETS = ['東証P', '東証S', '東証G']
+INDUSTRIES = ['水産・農林業', '建設業', '食料品', '化学', '医薬品', '機械', '電気機器', '輸送用機器', '小売業', '銀行業',
+              '情報・通信業', 'サービス業']
+
+# URLのパス → データセット（ベースURLの後ろの部分だけで判定する）
+_PATH_PATTERNS = {
+    dataset: re.compile(rf"(?:^|/){re.escape(directory)}/{re.escape(prefix)}_(\d{{8}})\.csv$")
+    for dataset, (directory, prefix) in DATASET_FILES.items()
+}
+
+
+def _base_price(i: int) -> float:
+    return float(100 + (i * 7919) % 9900)
+
+
+def _close(i: int, date_str: str) -> float:
+    """銘柄・日付ごとに決まった終値（基準値の ±10% の範囲で日々動く）"""
+    rng = random.Random(f"{i}:{date_str}")
+    return round(_base_price(i) * (1 + rng.uniform(-0.1, 0.1)), 1)
+
+
+def _rows_prices(date_str: str, codes: int) -> list:
+    rows = []
+    for i in range(codes):
+        code = 1300 + i
+        close = _close(i, date_str)
+        rng = random.Random(f"p{i}:{date_str}")
+        open_ = round(close * (1 + rng.uniform(-0.02, 0.02)), 1)
+        high, low = max(open_, close) + 1, min(open_, close) - 1
+        volume = rng.randrange(1_000, 5_000_000, 100)
+        shares = 1_000_000 * (1 + i % 50)
+        rows.append(f"{code},銘柄{code},{MARKETS[i % 3]},{INDUSTRIES[i % len(INDUSTRIES)]},{date_str},{close},"
+                    f"{round(close - open_, 1)},0.00,{open_},{open_},{high},{low},{close},{volume},0.01,"
+                    f"{round(volume * close / 1000)},{round(close * shares / 1_000_000)},-,-,-,-,-,-,-,-")
+    return rows
+
+
+def _rows_financials(date_str: str, codes: int) -> list:
+    """財務指標（EPS・BPS は四半期ごと、発行済株式数は年ごとに変わり、財務指標の版が増える）"""
+    quarter = int(date_str[:4]) * 4 + (int(date_str[4:6]) - 1) // 3
+    rows = []
+    for i in range(codes):
+        code = 1300 + i
+        close = _close(i, date_str)
+        shares = 1_000_000 * (1 + i % 50) + 1_000 * (int(date_str[:4]) % 3)
+        eps = round(_base_price(i) / (10 + (quarter + i) % 8), 2)
+        bps = round(_base_price(i) / (0.8 + ((quarter + i) % 5) / 10), 2)
+        dividend = round(_base_price(i) * 0.02, 1)
+        unit = 100
+        rows.append(f"{code},銘柄{code},{MARKETS[i % 3]},{INDUSTRIES[i % len(INDUSTRIES)]},"
+                    f"{round(close * shares / 1_000_000)},{shares},{round(dividend / close * 100, 2)},{dividend},"
+                    f"{round(close / eps, 2)},{round(close / bps, 2)},{eps},{bps},{close * unit},{unit},-,-,-,-,"
+                    f"{close * unit}")
+    return rows
+
+
+def _rows_margin(date_str: str, codes: int) -> list:
+    rows = []
+    for i in range(codes):
+        rng = random.Random(f"m{i}:{date_str}")
+        sell, buy = rng.randrange(0, 500_000, 100), rng.randrange(100, 2_000_000, 100)
+        sell_ins, buy_ins = sell * 3 // 4, buy * 3 // 4
+        rows.append(f"{1300 + i},{date_str},合計,{sell},0,{buy},0,{round(buy / sell, 2) if sell else '-'},"
+                    f"{sell_ins},0,{buy_ins},0,{sell - sell_ins},0,{buy - buy_ins},0")
+    return rows
+
+
+def _rows_indices(date_str: str, count: int) -> list:
+    rows = []
+    for i in range(count):
+        rng = random.Random(f"x{i}:{date_str}")
+        close = round(1000 * (1 + i % 7) * (1 + rng.uniform(-0.05, 0.05)), 2)
+        rows.append(f"{i + 1:04d},指数{i + 1},{date_str},{close},0,{round(rng.uniform(-2, 2), 2)},{close},"
+                    f"{round(close * 1e6)},0,0,0,0,{100 + i},{rng.randrange(1_000_000, 9_000_000)}")
+    return rows
+
+
+_GENERATORS = {
+    'prices': (PRICE_HEADER, _rows_prices),
+    'financials': (FINANCIAL_HEADER, _rows_financials),
+    'margin': (MARGIN_HEADER, _rows_margin),
+    'indices': (INDEX_HEADER, _rows_indices),
+}
+
+
+@lru_cache(maxsize=256)
+def synthetic_csv(dataset: str, date_str: str, codes: int = DEFAULT_CODES, indices: int = DEFAULT_INDICES,
+                  margin_offset: int = None):
+    """合成したCSV本文（休場日・信用残の非公表日は None。margin_offset は信用残の公表日が週の何営業日目か）"""
+    offsets = {margin_offset} if margin_offset else None
+    if not is_market_day(date_str) or (dataset == 'margin' and not is_publication_day(date_str, offsets)):
+        return None
+    header, generate = _GENERATORS[dataset]
+    rows = generate(date_str, indices if dataset == 'indices' else codes)
+    return ('\r\n'.join([header] + rows) + '\r\n').encode(ENCODING)
+
+
+class StubConfig:
+    """サーバーの設定と応答の集計（ハンドラのスレッド間で共有する）"""
+
+    def __init__(self, user: str, password: str, archive: str = None, codes: int = DEFAULT_CODES,
+                 indices: int = DEFAULT_INDICES, latency: float = 0.0, jitter: float = 0.0,
+                 rate_404: float = 0.0, rate_429: float = 0.0, rate_500: float = 0.0, rate_truncate: float = 0.0,
+                 truncate_mode: str = 'abort', retry_after: float = 1.0, seed: int = None, margin_offset: int = None):
+        self.authorization = 'Basic ' + base64.b64encode(f"{user}:{password}".encode()).decode()
+        self.archive = archive
+        self.codes = codes
+        self.indices = indices
+        self.latency = latency
+        self.jitter = jitter
+        self.rates = {'404': rate_404, '429': rate_429, '500': rate_500, 'truncate': rate_truncate}
+        self.truncate_mode = truncate_mode
+        self.retry_after = retry_after
+        self.margin_offset = margin_offset
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = Counter()
+        self.bytes = 0
+
+    def roll(self, fault: str) -> bool:
+        """その障害を注入するか（確率は --rate-*）"""
+        rate = self.rates[fault]
+        with self.lock:
+            return rate > 0 and self.random.random() < rate
+
+    def delay(self) -> float:
+        with self.lock:
+            return max(self.latency + self.random.uniform(-self.jitter, self.jitter), 0) / 1000
+
+    def record(self, status, size: int = 0):
+        with self.lock:
+            self.counts[str(status)] += 1
+            self.bytes += size
+
+    def body(self, dataset: str, date_str: str):
+        if self.archive:
+            filename = f"{DATASET_FILES[dataset][1]}_{date_str}.csv"
+            return load_raw(archive_path(dataset, filename, date_str, self.archive))
+        return synthetic_csv(dataset, date_str, self.codes, self.indices, self.margin_offset)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    server_version = 'KabuPlusStub/1.0'
+    protocol_version = 'HTTP/1.1'
+
+    @property
+    def config(self) -> StubConfig:
+        return self.server.config
+
+    def log_message(self, format, *args):
+        pass
+
+    def _empty(self, status: int, headers: dict = None, label=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        self.config.record(label or status)
+
+    def do_GET(self):
+        if self.path == '/_stats':
+            with self.config.lock:
+                body = json.dumps({'responses': dict(self.config.counts), 'bytes': self.config.bytes}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        time.sleep(self.config.delay())
+        if self.headers.get('Authorization') != self.config.authorization:
+            return self._empty(401, {'WWW-Authenticate': 'Basic realm="kabu.plus"'})
+
+        path = self.path.split('?', 1)[0]
+        match = next(((dataset, m.group(1)) for dataset, pattern in _PATH_PATTERNS.items()
+                      for m in [pattern.search(path)] if m), None)
+        if match is None:
+            return self._empty(404)
+        if self.config.roll('429'):
+            return self._empty(429, {'Retry-After': f"{self.config.retry_after:g}"})
+        if self.config.roll('500'):
+            return self._empty(500)
+        dataset, date_str = match
+        body = self.config.body(dataset, date_str)
+        if body is None or self.config.roll('404'):
+            return self._empty(404)
+
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        # データ日付の夕方に公開されたものとする
+        modified = datetime.strptime(date_str + '18', '%Y%m%d%H').replace(tzinfo=timezone.utc)
+        validators = {'ETag': etag, 'Last-Modified': format_datetime(modified, usegmt=True)}
+        if self.headers.get('If-None-Match') == etag:
+            return self._empty(304, validators)
+        if self.headers.get('If-Modified-Since') and not self.headers.get('If-None-Match'):
+            try:
+                if parsedate_to_datetime(self.headers['If-Modified-Since']) >= modified:
+                    return self._empty(304, validators)
+            except (TypeError, ValueError):
+                pass
+
+        length = len(body)
+        truncated = self.config.roll('truncate')
+        if truncated:
+            with self.config.lock:
+                cut = self.config.random.randrange(1, length) if length > 1 else 0
+            # abort: 本来の長さを送ってから切断する（受信側は不完全な応答として検知できる）
+            # short: 切った長さを正しい長さとして送る（行の途中で終わる、検知できない壊れ方）
+            body = body[:cut]
+            if self.config.truncate_mode == 'short':
+                length = cut
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv')
+        self.send_header('Content-Length', str(length))
+        for key, value in validators.items():
+            self.send_header(key, value)
+        if truncated and self.config.truncate_mode == 'abort':
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(body)
+        self.config.record('200-truncated' if truncated else 200, len(body))
+
+
+def serve(host: str, port: int, config: StubConfig):
+    """サーバーを起動し、Ctrl-C で止めると応答の集計を表示する"""
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.daemon_threads = True
+    server.config = config
+    source = f"アーカイブ {config.archive}" if config.archive else f"合成データ {config.codes}銘柄"
+    print(f"=== 株・プラス代替サーバー: http://{host}:{port}/ ({source}) ===")
+    print(f"  遅延 {config.latency:g}±{config.jitter:g}ms, 障害 "
+          + ', '.join(f"{k} {v:.0%}" for k, v in config.rates.items()))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"\n--- 応答: {dict(config.counts)}, {config.bytes / 1024 / 1024:.1f}MB ---")
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Local Kabu+ stand-in server for offline ingestion benchmarks and fault injection')
+    parser.add_argument('--host', default='127.0.0.1', help='Bind address (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8765, help='Port (default: 8765)')
+    parser.add_argument('--user', default=KABU_PLUS_USER or 'stub', help='Basic auth user (default: KABU_PLUS_USER or "stub")')
+    parser.add_argument('--password', default=KABU_PLUS_PASSWORD or 'stub',
+                        help='Basic auth password (default: KABU_PLUS_PASSWORD or "stub")')
+    parser.add_argument('--archive', help='Serve recorded CSVs from a raw archive directory (e.g. data/raw) instead of synthetic data')
+    parser.add_argument('--codes', type=int, default=DEFAULT_CODES, help=f'Synthetic stocks per file (default: {DEFAULT_CODES})')
+    parser.add_argument('--indices', type=int, default=DEFAULT_INDICES, help=f'Synthetic indices per file (default: {DEFAULT_INDICES})')
+    parser.add_argument('--latency', type=float, default=0.0, help='Response latency in milliseconds (default: 0)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random +/- latency in milliseconds (default: 0)')
+    parser.add_argument('--rate-404', type=float, default=0.0, help='Probability of an injected 404 (default: 0)')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='Probability of a 429 with Retry-After (default: 0)')
+    parser.add_argument('--rate-500', type=float, default=0.0, help='Probability of a 500 (default: 0)')
+    parser.add_argument('--rate-truncate', type=float, default=0.0, help='Probability of a truncated body (default: 0)')
+    parser.add_argument('--truncate-mode', choices=['abort', 'short'], default='abort',
+                        help='abort = close before Content-Length is reached, short = send a consistent but cut body (default: abort)')
+    parser.add_argument('--retry-after', type=float, default=1.0, help='Retry-After seconds sent with 429 (default: 1)')
+    parser.add_argument('--seed', type=int, default=None, help='Random seed for fault injection and latency')
+    parser.add_argument('--margin-offset', type=int, default=None,
+                        help='Publish margin data on this business day of the week instead of the 2nd (e.g. 3)')
+    args = parser.parse_args()
+
+    serve(args.host, args.port, StubConfig(
+        args.user, args.password, args.archive, args.codes, args.indices, args.latency, args.jitter,
+        args.rate_404, args.rate_429, args.rate_500, args.rate_truncate, args.truncate_mode, args.retry_after, args.seed,
+        args.margin_offset))